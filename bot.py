@@ -2,35 +2,46 @@ import base64
 import os
 import json
 import logging
+import secrets
 import sqlite3
 import uuid
 import threading
 import time
 import asyncio
-import requests
 from datetime import datetime
 from dotenv import load_dotenv
 import telebot
 from telebot.types import InlineKeyboardMarkup, InlineKeyboardButton, CallbackQuery, Message
-from excel_export import export_database_to_excel, cleanup_old_exports
+from excel_export import cleanup_old_exports, save_watermark, EXPORT_FORMATS
+from export_jobs import ExportJobRunner
 import os
 
 
 try:
     from config import STAR_PRICE, MAIN_MENU_IMAGE, WELCOME_MES, logger, REFERRAL_REWARD, \
-    ADMIN_ID, DB_NAME
+    ADMIN_ID, WEBHOOK_URL, WEBHOOK_PATH, WEBHOOK_SECRET, WEBHOOK_HOST, WEBHOOK_PORT, \
+    WEBHOOK_WORKERS, YOOKASSA_WEBHOOK_ENABLED, YOOKASSA_WEBHOOK_PATH, TON_DEPOSIT_ADDRESS, TON_API_KEY
     from db import (
         init_db, get_user, create_user, update_balance, add_transaction,
-        get_pending_payment, update_payment_status,
+        get_pending_payment, close_payment,
         set_session_data, get_session_data, delete_session_data,
-        get_setting, set_setting, get_referral_count, get_ton_rate_updated_at,
-        set_ton_rate, set_ton_rate_updated_at, get_ton_rate  # ДОБАВЛЕН get_referral_count
+        get_referral_count, get_ton_rate_updated_at,
+        set_ton_rate, set_ton_rate_updated_at, get_ton_rate,  # ДОБАВЛЕН get_referral_count
+        evict_idle_sessions, complete_payment,
+        get_unmatched_deposits, search_unmatched_deposits, assign_unmatched_deposits,
+        get_unknown_star_orders, resolve_star_order
 )
-    from fragment_api import load_fragment_token, authenticate_fragment, send_stars
-    from yookassa import create_yookassa_payment, check_payment_status
+    from fragment_api import token_manager, TOKEN_ERROR
+    from order_queue import StarOrderQueue
+    from payment_reconciler import PaymentReconciler
+    from ton_scanner import TonDepositScanner
+    from utils import CaptionAnimator, memoize
+    import webhook
+    from yookassa import create_yookassa_payment, check_payment_status, process_notification
+    from http_client import get_session
     from keyboards import (
         main_menu_keyboard, buy_stars_options_keyboard, buy_stars_quantity_keyboard,
-        back_to_main_keyboard
+        deposit_keyboard, back_to_main_keyboard
     )
 except ImportError as e:
 
@@ -47,17 +58,11 @@ load_dotenv()
 
 BOT_TOKEN = os.getenv('BOT_TOKEN')
 
-TON_DEPOSIT_ADDRESS = os.getenv('TON_DEPOSIT_ADDRESS')  # Адрес кошелька для приема
-TON_API_KEY = os.getenv('TON_API_KEY')  # Ключ от toncenter.com
-TON_API_BASE_URL = 'https://toncenter.com'
-
 TON_RATE_API = "https://api.coingecko.com/api/v3/simple/price?ids=the-open-network&vs_currencies=rub"
 
 # Инициализация бота
 bot = telebot.TeleBot(BOT_TOKEN)
 
-animation_running = False
-
 # Добавьте эту функцию после импортов и перед обработчиками
 def safe_edit_message_caption(bot, chat_id, message_id, new_caption, new_reply_markup=None, parse_mode=None):
     """Безопасно редактирует caption сообщения, проверяя изменения."""
@@ -79,28 +84,6 @@ def safe_edit_message_caption(bot, chat_id, message_id, new_caption, new_reply_m
             # Пробрасываем другие ошибки
             logger.error(f"Ошибка редактирования сообщения: {e}")
             raise e
-# --- Анимация загрузки ---
-def animate_caption(bot, call):
-    global animation_running
-    dots = 1
-    while animation_running:
-        caption = "🔄 Отправляю звезды" + "." * dots
-        try:
-            bot.edit_message_caption(
-                chat_id=call.message.chat.id,
-                message_id=call.message.message_id,
-                caption=caption,
-                reply_markup=None
-            )
-        except Exception as e:
-            if "message is not modified" not in str(e):
-                logger.warning(f"Ошибка при обновлении сообщения анимации: {e}")
-            break
-
-        dots = (dots % 3) + 1
-        time.sleep(1)
-
-
 # --- Обработчики команд ---
 @bot.message_handler(commands=['start', 'menu'])
 def start_or_menu(message: Message):
@@ -156,7 +139,7 @@ def start_or_menu(message: Message):
 
 @bot.message_handler(commands=['export'])
 def handle_export_command(message: Message):
-    """Обработчик команды /export для экспорта БД в Excel."""
+    """Обработчик команды /export для экспорта БД в Excel или CSV."""
     user_id = message.from_user.id
 
     # Проверяем, что команду вызвал админ
@@ -164,52 +147,106 @@ def handle_export_command(message: Message):
         bot.reply_to(message, "❌ У вас нет прав для выполнения этой команды.")
         return
 
+    # /export - книга Excel, /export csv - ZIP-архив с CSV (быстрее на больших таблицах),
+    # /export delta [csv] - только строки, измененные с прошлой выгрузки delta
+    args = [arg.lower() for arg in message.text.split()[1:]]
+    incremental = 'delta' in args
+    formats = [arg for arg in args if arg != 'delta']
+    fmt = formats[0] if formats else 'xlsx'
+    if fmt not in EXPORT_FORMATS or len(formats) > 1:
+        bot.reply_to(message, f"❌ Использование: /export [{' | '.join(EXPORT_FORMATS)}] [delta]")
+        return
+
+    if export_runner.active_job():
+        bot.reply_to(message, "⏳ Экспорт уже выполняется. Остановить: /export_cancel")
+        return
+
     try:
         # Отправляем сообщение о начале процесса
-        processing_msg = bot.reply_to(message, "🔄 Начинаю экспорт базы данных в Excel...")
+        processing_msg = bot.reply_to(message, "🔄 Начинаю экспорт базы данных...")
+
+        # Экспорт выполняется в отдельном процессе, обработчик сразу освобождается
+        job = export_runner.start(fmt, {
+            'chat_id': message.chat.id,
+            'message_id': processing_msg.message_id,
+            'reply_to': message.message_id
+        }, incremental=incremental)
+        if job is None:
+            bot.edit_message_text(
+                chat_id=message.chat.id,
+                message_id=processing_msg.message_id,
+                text="⏳ Экспорт уже выполняется. Остановить: /export_cancel"
+            )
 
-        # Выполняем экспорт
-        filename = export_database_to_excel()
+    except Exception as e:
+        logger.error(f"Ошибка при выполнении команды /export: {e}")
+        bot.reply_to(message, f"❌ Произошла ошибка при экспорте: {e}")
 
-        if filename and os.path.exists(filename):
-            # Отправляем файл
+
+@bot.message_handler(commands=['export_cancel'])
+def handle_export_cancel_command(message: Message):
+    """Обработчик команды /export_cancel: останавливает текущий экспорт."""
+    if str(message.from_user.id) != ADMIN_ID:
+        bot.reply_to(message, "❌ У вас нет прав для выполнения этой команды.")
+        return
+
+    if export_runner.cancel():
+        bot.reply_to(message, "⏹ Останавливаю экспорт...")
+    else:
+        bot.reply_to(message, "ℹ️ Сейчас экспорт не выполняется.")
+
+
+def show_export_progress(job, done, total, title):
+    context = job['context']
+    bot.edit_message_text(
+        chat_id=context['chat_id'],
+        message_id=context['message_id'],
+        text=f"🔄 Экспорт базы данных: лист {done + 1}/{total} - {title}..."
+    )
+
+
+def finish_export(job, filename, status):
+    """Отправляет готовый файл экспорта (или сообщает об отмене/ошибке) и удаляет его."""
+    context = job['context']
+    try:
+        if status == 'done' and os.path.exists(filename):
+            # Файл передается открытым потоком, а не читается в память целиком
             with open(filename, 'rb') as file:
                 bot.send_document(
-                    chat_id=message.chat.id,
+                    chat_id=context['chat_id'],
                     document=file,
-                    caption=f"📊 Экспорт базы данных завершен\nФайл: {filename}",
-                    reply_to_message_id=message.message_id
+                    caption=(
+                        f"📊 {'Изменения с прошлой выгрузки' if job['incremental'] else 'Экспорт базы данных завершен'}\n"
+                        f"Файл: {os.path.basename(filename)}"
+                    ),
+                    reply_to_message_id=context['reply_to']
                 )
 
-            # УДАЛЯЕМ файл после успешной отправки
-            try:
-                os.remove(filename)
-                logger.info(f"✅ Файл экспорта удален: {filename}")
-            except Exception as delete_error:
-                logger.error(f"❌ Ошибка удаления файла {filename}: {delete_error}")
+            # Файл доставлен - следующая выгрузка изменений начнется с этой отметки
+            if job['incremental']:
+                save_watermark(job['watermark'])
 
             # Удаляем сообщение о процессе
-            bot.delete_message(chat_id=message.chat.id, message_id=processing_msg.message_id)
-
+            bot.delete_message(chat_id=context['chat_id'], message_id=context['message_id'])
         else:
-            bot.edit_message_text(
-                chat_id=message.chat.id,
-                message_id=processing_msg.message_id,
-                text="❌ Не удалось создать файл экспорта."
-            )
+            text = "⏹ Экспорт отменен." if status == 'cancelled' else "❌ Не удалось создать файл экспорта."
+            bot.edit_message_text(chat_id=context['chat_id'], message_id=context['message_id'], text=text)
 
     except Exception as e:
-        logger.error(f"Ошибка при выполнении команды /export: {e}")
+        logger.error(f"Ошибка отправки файла экспорта: {e}")
+        bot.send_message(context['chat_id'], f"❌ Произошла ошибка при экспорте: {e}")
 
-        # Пытаемся удалить файл даже в случае ошибки отправки
+    finally:
+        # УДАЛЯЕМ файл после отправки (и в случае ошибки)
         try:
-            if 'filename' in locals() and filename and os.path.exists(filename):
+            if filename and os.path.exists(filename):
                 os.remove(filename)
-                logger.info(f"✅ Файл экспорта удален после ошибки: {filename}")
+                logger.info(f"✅ Файл экспорта удален: {filename}")
         except Exception as delete_error:
-            logger.error(f"❌ Ошибка удаления файла после ошибки отправки: {delete_error}")
+            logger.error(f"❌ Ошибка удаления файла {filename}: {delete_error}")
 
-        bot.reply_to(message, f"❌ Произошла ошибка при экспорте: {e}")
+
+export_runner = ExportJobRunner(on_progress=show_export_progress, on_finished=finish_export)
 
 
 @bot.message_handler(commands=['stats'])
@@ -223,50 +260,36 @@ def handle_stats_command(message: Message):
         return
 
     try:
-        from db import get_setting
-        import sqlite3
-
-        conn = sqlite3.connect(DB_NAME)
-        cursor = conn.cursor()
-
-        # Быстрая статистика
-        cursor.execute("SELECT COUNT(*) FROM users")
-        total_users = cursor.fetchone()[0]
-
-        cursor.execute("SELECT COUNT(*) FROM users WHERE referrer_id IS NOT NULL")
-        users_with_referrer = cursor.fetchone()[0]
-
-        cursor.execute("SELECT SUM(balance) FROM users")
-        total_balance = cursor.fetchone()[0] or 0
-
-        cursor.execute("SELECT COUNT(*) FROM transactions WHERE type = 'stars_purchase' AND status = 'completed'")
-        stars_transactions = cursor.fetchone()[0]
-
-        cursor.execute("SELECT COUNT(*) FROM payments WHERE status = 'succeeded'")
-        successful_payments = cursor.fetchone()[0]
+        from db import get_user_cache_stats
+        from stats import collect_summary
 
-        cursor.execute("SELECT SUM(amount) FROM payments WHERE status = 'succeeded'")
-        total_payments = cursor.fetchone()[0] or 0
-
-        ton_rate = get_setting('ton_rub_rate', 'N/A')
-        last_rate_update = get_setting('ton_rate_updated_at', 'N/A')
-
-        conn.close()
+        stats = collect_summary()
+        ton_rate = stats['ton_rate'] or 'N/A'
+        last_rate_update = stats['ton_rate_updated_at'] or 'N/A'
+        user_cache = get_user_cache_stats()
 
         stats_message = (
             "📊 *Статистика бота*\n\n"
             f"👥 *Пользователи:*\n"
-            f"• Всего: {total_users}\n"
-            f"• С реферерами: {users_with_referrer}\n"
-            f"• Общий баланс: {total_balance:.2f} руб\n\n"
+            f"• Всего: {stats['total_users']}\n"
+            f"• С реферерами: {stats['users_with_referrer']}\n"
+            f"• Общий баланс: {stats['total_balance']:.2f} руб\n\n"
             f"💫 *Звезды:*\n"
-            f"• Покупок звезд: {stars_transactions}\n\n"
+            f"• Покупок звезд: {stats['stars_purchases']}\n\n"
             f"💳 *Платежи:*\n"
-            f"• Успешных: {successful_payments}\n"
-            f"• Общая сумма: {total_payments:.2f} руб\n\n"
+            f"• Успешных: {stats['successful_payments']}\n"
+            f"• Общая сумма: {stats['payments_amount']:.2f} руб\n\n"
+            f"📅 *Сегодня (UTC):*\n"
+            f"• Новых пользователей: {stats['today']['new_users']}\n"
+            f"• Покупок звезд: {stats['today']['stars_purchases']}\n"
+            f"• Платежей: {stats['today']['successful_payments']} на {stats['today']['payments_amount']:.2f} руб\n\n"
             f"🪙 *Курс TON:*\n"
             f"• Текущий: {ton_rate} RUB\n"
-            f"• Обновлен: {last_rate_update[:16] if last_rate_update != 'N/A' else 'N/A'}"
+            f"• Обновлен: {last_rate_update[:16] if last_rate_update != 'N/A' else 'N/A'}\n\n"
+            f"🗄 *Кэш пользователей:*\n"
+            f"• Записей: {user_cache['size']} из {user_cache['maxsize']}\n"
+            f"• Попаданий: {user_cache['hits']}, промахов: {user_cache['misses']} "
+            f"({user_cache['hit_rate']:.0%})"
         )
 
         bot.reply_to(message, stats_message, parse_mode='Markdown')
@@ -275,6 +298,283 @@ def handle_stats_command(message: Message):
         logger.error(f"Ошибка при выполнении команды /stats: {e}")
         bot.reply_to(message, f"❌ Ошибка получения статистики: {e}")
 
+
+@bot.message_handler(commands=['stats_check'])
+def handle_stats_check_command(message: Message):
+    """Обработчик команды /stats_check: пересчитывает счетчики /stats и показывает расхождения."""
+    if str(message.from_user.id) != ADMIN_ID:
+        bot.reply_to(message, "❌ У вас нет прав для выполнения этой команды.")
+        return
+
+    try:
+        from db import rebuild_stats_counters, rebuild_stats_rollups
+
+        drift = rebuild_stats_counters()
+        # Срезы /report проверяются тем же проходом; корзина пишется вместо дня
+        drift += [(f'{metric} ({grain})', bucket, before, after)
+                  for grain, bucket, metric, before, after in rebuild_stats_rollups()]
+        if not drift:
+            bot.reply_to(message, "✅ Счетчики статистики совпадают с данными.")
+            return
+
+        lines = [
+            f"• {name}{f' [{day}]' if day else ''}: {before:g} → {after:g}"
+            for name, day, before, after in drift[:20]
+        ]
+        if len(drift) > 20:
+            lines.append(f"… и еще {len(drift) - 20}")
+        logger.warning(f"⚠️ Расхождение счетчиков статистики: {drift}")
+        bot.reply_to(message, "⚠️ Найдены расхождения, счетчики пересчитаны:\n" + "\n".join(lines))
+
+    except Exception as e:
+        logger.error(f"Ошибка при выполнении команды /stats_check: {e}")
+        bot.reply_to(message, f"❌ Ошибка проверки статистики: {e}")
+
+
+def _percent(ratio):
+    return f"{ratio:.0%}" if ratio is not None else "—"
+
+
+@bot.message_handler(commands=['report'])
+def handle_report_command(message: Message):
+    """Обработчик команды /report [today|Nh|Nd]: тренды по почасовым/посуточным срезам."""
+    if str(message.from_user.id) != ADMIN_ID:
+        bot.reply_to(message, "❌ У вас нет прав для выполнения этой команды.")
+        return
+
+    args = message.text.split(maxsplit=1)
+    try:
+        from stats import collect_report, parse_report_period, sparkline
+        grain, buckets = parse_report_period(args[1] if len(args) > 1 else None)
+    except ValueError as e:
+        bot.reply_to(message, f"❌ {e}\nИспользование: /report [today | 24h | 7d | 30d]")
+        return
+
+    try:
+        report = collect_report(grain, buckets)
+        totals, series = report['totals'], report['series']
+        unit = 'час' if grain == 'hour' else 'день'
+        stars = [values['stars_sold'] for _, values in series]
+        peak_bucket, peak_values = max(series, key=lambda item: item[1]['stars_sold'])
+        deposits = [values['deposits_yookassa_amount'] + values['deposits_ton_amount'] for _, values in series]
+
+        report_message = (
+            f"📈 *Отчет: {args[1].strip() if len(args) > 1 else '24h'}* "
+            f"({'по часам' if grain == 'hour' else 'по дням'}, UTC, с {series[0][0]})\n\n"
+            f"💫 *Звезды:*\n"
+            f"• Заказов: {int(totals['stars_orders'])}, звезд: {int(totals['stars_sold'])}\n"
+            f"• Выручка: {totals['stars_revenue']:.2f} руб\n"
+            f"• В среднем за {unit}: {totals['stars_sold'] / len(series):.1f} звезд, "
+            f"пик: {int(peak_values['stars_sold'])} ({peak_bucket})\n"
+            f"`{sparkline(stars)}`\n\n"
+            f"💰 *Пополнения:* {report['deposits_amount']:.2f} руб\n"
+            f"• ЮKassa: {int(totals['deposits_yookassa'])} на {totals['deposits_yookassa_amount']:.2f} руб "
+            f"({_percent(1 - report['ton_share'] if report['ton_share'] is not None else None)})\n"
+            f"• TON: {int(totals['deposits_ton'])} на {totals['deposits_ton_amount']:.2f} руб "
+            f"({_percent(report['ton_share'])})\n"
+            f"`{sparkline(deposits)}`\n\n"
+            f"🔁 *Конверсия:*\n"
+            f"• Пополнения → покупки звезд: {_percent(report['spend_ratio'])}\n"
+            f"• Оплачено счетов ЮKassa: {int(totals['payments_succeeded'])} из "
+            f"{int(totals['payments_created'])} ({_percent(report['checkout_ratio'])})"
+        )
+        bot.reply_to(message, report_message, parse_mode='Markdown')
+
+    except Exception as e:
+        logger.error(f"Ошибка при выполнении команды /report: {e}")
+        bot.reply_to(message, f"❌ Ошибка построения отчета: {e}")
+
+def _format_unmatched(rows):
+    return "\n".join(
+        f"#{row['id']} • {row['ton_amount']:.4f} TON ({row['rub_amount']:.2f} руб) • "
+        f"{row['sender'] or '—'} • «{row['comment'] or ''}» • {row['tx_time'] or row['created_at']}"
+        for row in rows
+    )
+
+
+def _parse_deposit_ids(args):
+    """Разбирает номера депозитов для /assign: '12 15-18 20' -> {12, 15, 16, 17, 18, 20}."""
+    ids = set()
+    for arg in args:
+        first, _, last = arg.partition('-')
+        first, last = int(first), int(last or first)
+        if last < first or last - first >= 1000:
+            raise ValueError(f"неверный диапазон: {arg}")
+        ids.update(range(first, last + 1))
+    return ids
+
+
+@bot.message_handler(commands=['unmatched'])
+def handle_unmatched_command(message: Message):
+    """Обработчик команды /unmatched: депозиты TON, которые не удалось сопоставить с пользователем."""
+    if str(message.from_user.id) != ADMIN_ID:
+        bot.reply_to(message, "❌ У вас нет прав для выполнения этой команды.")
+        return
+
+    try:
+        rows, total, total_ton = get_unmatched_deposits()
+        if not rows:
+            bot.reply_to(message, "✅ Неопознанных депозитов TON нет.")
+            return
+
+        bot.reply_to(
+            message,
+            f"❓ Неопознанных депозитов: {total} на {total_ton:.4f} TON"
+            f"{f' (показаны последние {len(rows)})' if total > len(rows) else ''}\n\n"
+            f"{_format_unmatched(rows)}\n\n"
+            "Поиск: /unmatched_search <сумма TON | адрес | комментарий>\n"
+            "Зачислить: /assign <user_id> <номер | номер-номер> ..."
+        )
+
+    except Exception as e:
+        logger.error(f"Ошибка при выполнении команды /unmatched: {e}")
+        bot.reply_to(message, f"❌ Ошибка получения неопознанных депозитов: {e}")
+
+
+@bot.message_handler(commands=['unmatched_search'])
+def handle_unmatched_search_command(message: Message):
+    """Обработчик команды /unmatched_search: поиск неопознанных депозитов по сумме, адресу или комментарию."""
+    if str(message.from_user.id) != ADMIN_ID:
+        bot.reply_to(message, "❌ У вас нет прав для выполнения этой команды.")
+        return
+
+    args = message.text.split(maxsplit=1)
+    if len(args) < 2:
+        bot.reply_to(message, "Использование: /unmatched_search <сумма TON | адрес | комментарий>")
+        return
+
+    try:
+        rows = search_unmatched_deposits(args[1].strip())
+        if not rows:
+            bot.reply_to(message, "🔍 Ничего не найдено.")
+            return
+        bot.reply_to(message, f"🔍 Найдено: {len(rows)}\n\n{_format_unmatched(rows)}")
+
+    except Exception as e:
+        logger.error(f"Ошибка при выполнении команды /unmatched_search: {e}")
+        bot.reply_to(message, f"❌ Ошибка поиска: {e}")
+
+
+@bot.message_handler(commands=['assign'])
+def handle_assign_command(message: Message):
+    """Обработчик команды /assign <user_id> <номер | номер-номер> ...: зачисление неопознанных депозитов."""
+    if str(message.from_user.id) != ADMIN_ID:
+        bot.reply_to(message, "❌ У вас нет прав для выполнения этой команды.")
+        return
+
+    args = message.text.split()
+    try:
+        if len(args) < 3:
+            raise ValueError("не указаны пользователь и номера депозитов")
+        user_id = int(args[1])
+        deposit_ids = _parse_deposit_ids(args[2:])
+    except ValueError as e:
+        bot.reply_to(message, f"❌ {e}\nИспользование: /assign <user_id> <номер | номер-номер> ...")
+        return
+
+    try:
+        result = assign_unmatched_deposits(deposit_ids, user_id)
+        if result is None:
+            bot.reply_to(message, f"❌ Пользователь {user_id} не найден.")
+            return
+
+        rows, balance, learned = result
+        if not rows:
+            bot.reply_to(message, "⚠️ Открытых депозитов с такими номерами нет (уже зачислены?).")
+            return
+
+        ton_amount = sum(row['ton_amount'] for row in rows)
+        rub_amount = sum(row['rub_amount'] for row in rows)
+        skipped = len(deposit_ids) - len(rows)
+        bot.reply_to(
+            message,
+            f"✅ Пользователю {user_id} зачислено {len(rows)} депозит(ов): "
+            f"{ton_amount:.4f} TON на {rub_amount:.2f} руб, баланс {balance:.2f} руб\n"
+            f"Депозиты без комментария с этих адресов будут зачисляться автоматически: "
+            f"{', '.join(learned) if learned else 'нет (адреса общие или не указаны)'}"
+            + (f"\nПропущено номеров: {skipped}" if skipped > 0 else "")
+        )
+
+        try:
+            bot.send_message(
+                user_id,
+                f"✅ Зачислено {len(rows)} депозит(ов) TON на {rub_amount:.2f} руб\n"
+                f"Ваш новый баланс: {balance:.2f} руб"
+            )
+        except Exception as e:
+            logger.error(f"Ошибка отправки уведомления пользователю {user_id}: {e}")
+
+    except Exception as e:
+        logger.error(f"Ошибка при выполнении команды /assign: {e}")
+        bot.reply_to(message, f"❌ Ошибка зачисления: {e}")
+
+@bot.message_handler(commands=['unknown_orders'])
+def handle_unknown_orders_command(message: Message):
+    """Обработчик команды /unknown_orders: заказы звезд с неизвестным результатом отправки."""
+    if str(message.from_user.id) != ADMIN_ID:
+        bot.reply_to(message, "❌ У вас нет прав для выполнения этой команды.")
+        return
+
+    try:
+        orders = get_unknown_star_orders()
+        if not orders:
+            bot.reply_to(message, "✅ Заказов, ожидающих проверки, нет.")
+            return
+
+        lines = [
+            f"#{order['id']} • {order['stars']} ⭐ для @{order['target_username']} • user {order['user_id']} • "
+            f"{order['cost']:.2f} руб в резерве • {order['error'] or 'прерван перезапуском'}"
+            for order in orders
+        ]
+        bot.reply_to(
+            message,
+            "⚠️ Заказы с неизвестным результатом отправки:\n\n" + "\n".join(lines) +
+            "\n\nПроверьте отправку в Fragment и закройте заказ:\n"
+            "/resolve_order <номер> sent - звезды отправлены, списать резерв\n"
+            "/resolve_order <номер> refund - не отправлены, вернуть средства"
+        )
+
+    except Exception as e:
+        logger.error(f"Ошибка при выполнении команды /unknown_orders: {e}")
+        bot.reply_to(message, f"❌ Ошибка получения заказов: {e}")
+
+
+@bot.message_handler(commands=['resolve_order'])
+def handle_resolve_order_command(message: Message):
+    """Обработчик команды /resolve_order <номер> sent|refund: ручное закрытие заказа unknown."""
+    if str(message.from_user.id) != ADMIN_ID:
+        bot.reply_to(message, "❌ У вас нет прав для выполнения этой команды.")
+        return
+
+    args = message.text.split()
+    if len(args) != 3 or not args[1].isdigit() or args[2] not in ('sent', 'refund'):
+        bot.reply_to(message, "Использование: /resolve_order <номер> sent | refund")
+        return
+
+    sent = args[2] == 'sent'
+    try:
+        order = resolve_star_order(int(args[1]), sent)
+        if order is None:
+            bot.reply_to(message, f"⚠️ Заказа #{args[1]} в статусе проверки нет (уже закрыт?).")
+            return
+
+        result = "резерв списан" if sent else f"{order['cost']:.2f} руб возвращены на баланс"
+        bot.reply_to(message, f"✅ Заказ #{order['id']} закрыт: {result}")
+        try:
+            bot.send_message(
+                order['user_id'],
+                f"✅ {order['stars']} ⭐ для @{order['target_username']} отправлены!" if sent else
+                f"↩️ Заказ {order['stars']} ⭐ для @{order['target_username']} не выполнен, "
+                f"{order['cost']:.2f} руб возвращены на баланс."
+            )
+        except Exception as e:
+            logger.error(f"Ошибка отправки уведомления пользователю {order['user_id']}: {e}")
+
+    except Exception as e:
+        logger.error(f"Ошибка при выполнении команды /resolve_order: {e}")
+        bot.reply_to(message, f"❌ Ошибка закрытия заказа: {e}")
+
+
 # --- Обработчики колбэков (Меню и Профиль) ---
 @bot.callback_query_handler(func=lambda call: call.data == 'buy_stars')
 def buy_stars_selection_menu(call: CallbackQuery):
@@ -286,21 +586,6 @@ def buy_stars_selection_menu(call: CallbackQuery):
     )
 
 
-def deposit_keyboard(user_data):
-    keyboard = InlineKeyboardMarkup()
-    amounts = [50, 100, 500, 1000]
-    for amount in amounts:
-        keyboard.row(InlineKeyboardButton(f"{amount} руб (ЮKassa)", callback_data=f'deposit_{amount}'))
-
-    # Добавляем TON пополнение
-    keyboard.row(InlineKeyboardButton("🪙 Пополнить TON", callback_data='deposit_ton'))
-
-    # Добавляем кнопку для ввода кастомной суммы (ЮKassa)
-    keyboard.row(InlineKeyboardButton("✍️ Другая сумма (ЮKassa)", callback_data='deposit_custom'))
-    keyboard.row(InlineKeyboardButton("↩️ Назад", callback_data='main_menu'))
-    return keyboard
-
-
 @bot.callback_query_handler(func=lambda call: call.data == 'deposit')
 def deposit_menu(call: CallbackQuery):
     user_id = call.from_user.id
@@ -329,12 +614,21 @@ def show_profile(call: CallbackQuery):
     )
 
 
+BOT_INFO_TTL = 24 * 3600
+
+
+@memoize(ttl=BOT_INFO_TTL)
+def get_bot_info():
+    """Данные бота (id, username): запрашиваются при старте и берутся из кэша."""
+    return bot.get_me()
+
+
 @bot.callback_query_handler(func=lambda call: call.data == 'referrals_menu')
 def show_referrals_menu(call: CallbackQuery):
     user_id = call.from_user.id
 
-    # Получаем никнейм бота для генерации ссылки
-    bot_username = bot.get_me().username
+    # Никнейм бота для генерации ссылки (из кэша, без запроса к Telegram)
+    bot_username = get_bot_info().username
     referral_link = f"https://t.me/{bot_username}?start=r{user_id}"
 
     # Получаем количество рефералов
@@ -471,7 +765,6 @@ def process_friend_username(message: Message):
 def handle_star_purchase(call: CallbackQuery):
     stars = int(call.data.split('_')[1])
     user_id = call.from_user.id
-    user_data = get_user(user_id)
     cost = stars * STAR_PRICE
 
     # Получаем целевой username из БД
@@ -484,61 +777,110 @@ def handle_star_purchase(call: CallbackQuery):
         main_menu_callback(call)
         return
 
-    if user_data['balance'] < cost:
+    # Анимация запускается до постановки в очередь: иначе воркер может успеть
+    # вызвать notify_order_result (и остановить анимацию) раньше ее запуска
+    caption_animator.start(call.message.chat.id, call.message.message_id)
+
+    # Резервируем стоимость и ставим заказ в очередь: проверка баланса и списание атомарны
+    try:
+        order_id = order_queue.enqueue(
+            user_id, cost, stars, target_username,
+            call.message.chat.id, call.message.message_id
+        )
+    except Exception:
+        caption_animator.stop(call.message.chat.id, call.message.message_id)
+        raise
+    if order_id is None:
+        caption_animator.stop(call.message.chat.id, call.message.message_id)
         bot.answer_callback_query(call.id, f"❌ Недостаточно средств на балансе. Нужно {cost:.2f} руб.", show_alert=True)
         return
 
-    # Запуск анимации
-    global animation_running
-    animation_running = True
-    animation_thread = threading.Thread(target=animate_caption, args=(bot, call))
-    animation_thread.start()
+    # Получатель уже сохранен в заказе, сессия больше не нужна
+    delete_session_data(user_id)
+    # Результат заказа придет в notify_order_result
+
 
-    try:
-        token = load_fragment_token() or authenticate_fragment()
-        if not token:
-            animation_running = False
-            bot.edit_message_caption(
-                chat_id=call.message.chat.id,
-                message_id=call.message.message_id,
-                caption="❌ Ошибка системы. Не удалось получить токен Fragment API. Попробуйте позже.",
-                reply_markup=back_to_main_keyboard()
-            )
-            return
+def notify_order_result(order, success, message):
+    """Показывает пользователю результат заказа из очереди и уведомляет администратора."""
+    caption_animator.stop(order['chat_id'], order['message_id'])
 
-        success, message = send_stars(token, target_username, stars)
+    stars = order['stars']
+    target_username = order['target_username']
 
-        animation_running = False
-        animation_thread.join()
+    if message == TOKEN_ERROR:
+        bot.edit_message_caption(
+            chat_id=order['chat_id'],
+            message_id=order['message_id'],
+            caption="❌ Ошибка системы. Не удалось получить токен Fragment API. Попробуйте позже.",
+            reply_markup=back_to_main_keyboard()
+        )
+        return
 
+    try:
         if success:
-            update_balance(user_data['user_id'], -cost)
-            add_transaction(user_data['user_id'], stars, 'stars_purchase', target_user=target_username)
-            user_data_new = get_user(user_id)
+            bot.send_message(ADMIN_ID, f"✅ Отправлены {stars} ⭐ пользователю @{target_username}...")
+        else:
+            bot.send_message(ADMIN_ID, f"❌ Ошибка отправки {stars} ⭐ пользователю @{target_username}. \n\nТекст ошибки: {message}")
+    except Exception as e:
+        logger.error(f"Ошибка отправки уведомления администратору: {e}")
 
-            bot.edit_message_caption(
-                chat_id=call.message.chat.id,
-                message_id=call.message.message_id,
-                caption=f"✅ Успешно отправлено {stars} звезд пользователю **@{target_username}**!\n"
-                        f"💰 Ваш новый баланс: {user_data_new['balance']:.2f} руб",
-                reply_markup=back_to_main_keyboard(),
-                parse_mode='Markdown'
-            )
+    if success:
+        user_data_new = get_user(order['user_id'])
+
+        bot.edit_message_caption(
+            chat_id=order['chat_id'],
+            message_id=order['message_id'],
+            caption=f"✅ Успешно отправлено {stars} звезд пользователю **@{target_username}**!\n"
+                    f"💰 Ваш новый баланс: {user_data_new['balance']:.2f} руб",
+            reply_markup=back_to_main_keyboard(),
+            parse_mode='Markdown'
+        )
+    else:
+        if "not enough funds" in message.lower() or "баланс" in message.lower():
+            error_message = "❌ У нас закончились звезды. Попробуйте позже."
         else:
-            if "not enough funds" in message.lower() or "баланс" in message.lower():
-                error_message = "❌ У нас закончились звезды. Попробуйте позже."
-            else:
-                error_message = f"❌ Ошибка при отправке: {message}"
+            error_message = f"❌ Ошибка при отправке: {message}"
+
+        bot.edit_message_caption(
+            chat_id=order['chat_id'],
+            message_id=order['message_id'],
+            caption=error_message,
+            reply_markup=back_to_main_keyboard()
+        )
+
 
+def notify_interrupted_orders(orders):
+    """Сообщает администратору о заказах, прерванных перезапуском бота или ошибкой обработки."""
+    lines = [
+        f"• #{order['id']}: {order['stars']} ⭐ для @{order['target_username']} (user {order['user_id']})"
+        for order in orders
+    ]
+    try:
+        bot.send_message(
+            ADMIN_ID,
+            "⚠️ Заказы прерваны, средства остаются в резерве. "
+            "Проверьте отправку в Fragment вручную:\n\n" + "\n".join(lines) +
+            "\n\nЗакрыть заказ: /resolve_order <номер> sent | refund"
+        )
+    except Exception as e:
+        logger.error(f"Ошибка отправки уведомления администратору: {e}")
+
+    for order in orders:
+        caption_animator.stop(order['chat_id'], order['message_id'])
+        try:
             bot.edit_message_caption(
-                chat_id=call.message.chat.id,
-                message_id=call.message.message_id,
-                caption=error_message,
+                chat_id=order['chat_id'],
+                message_id=order['message_id'],
+                caption="⏳ Заказ на проверке у администратора. Средства зарезервированы и будут "
+                        "списаны после подтверждения отправки или возвращены на баланс.",
                 reply_markup=back_to_main_keyboard()
             )
-    finally:
-        # Очищаем состояние после завершения
-        delete_session_data(user_id)
+        except Exception as e:
+            logger.error(f"Ошибка обновления сообщения заказа #{order['id']}: {e}")
+
+
+caption_animator = CaptionAnimator(bot)
+order_queue = StarOrderQueue(on_result=notify_order_result, on_interrupted=notify_interrupted_orders)
 
 
 @bot.callback_query_handler(func=lambda call: call.data == 'deposit_ton')
@@ -561,6 +903,9 @@ def handle_ton_deposit(call: CallbackQuery):
     else:
         update_info = ""
 
+    # Пользователь, скорее всего, сейчас переведет TON - мониторинг проверяет кошелек чаще
+    ton_scanner.expect_deposit(user_id)
+
     # URL для быстрой оплаты
     payment_url = f'ton://transfer/{TON_DEPOSIT_ADDRESS}?text={user_id}'
 
@@ -711,8 +1056,10 @@ def process_custom_deposit_amount(message: Message):
 
 
 def process_deposit(call, amount: float, deposit_type='yookassa'):
-    bot_username = bot.get_me().username
-    payment_url = create_yookassa_payment(amount, call.from_user.id, bot_username)
+    bot_username = get_bot_info().username
+    payment_url = create_yookassa_payment(
+        amount, call.from_user.id, bot_username, call.message.chat.id, call.message.message_id
+    )
 
     if payment_url:
         keyboard = InlineKeyboardMarkup()
@@ -760,44 +1107,104 @@ def handle_check_payment(call: CallbackQuery):
         return
 
     if payment_info['status'] == 'succeeded':
-        # Обновление статуса платежа
-        update_payment_status(payment_id, 'succeeded')
-
-        # Обновление баланса и добавление транзакции
-        update_balance(user_id, amount)
-        add_transaction(user_id, amount, 'deposit', 'completed')
-
-        user_data = get_user(user_id)
+        # Статус, баланс и транзакция обновляются одним коммитом и ровно один раз,
+        # даже если параллельно пришло уведомление ЮKassa
+        if not complete_payment(payment_id):
+            bot.answer_callback_query(call.id, "✅ Платеж уже зачислен на баланс", show_alert=True)
+            return
 
         # Отправляем уведомление администратору об успешном пополнении
         send_admin_deposit_notification(call.from_user, amount, 'yookassa', 'completed')
 
-        bot.edit_message_caption(
-            chat_id=call.message.chat.id,
-            message_id=call.message.message_id,
-            caption=f"✅ Платеж успешно завершен!\n"
-                    f"💳 Сумма: **{amount:.2f} руб**\n"
-                    f"💰 Новый баланс: **{user_data['balance']:.2f} руб**",
-            reply_markup=back_to_main_keyboard(),
-            parse_mode='Markdown'
-        )
+        show_payment_success(call.message.chat.id, call.message.message_id, user_id, amount)
 
-    elif payment_info['status'] == 'pending':
+    elif payment_info['status'] == 'canceled':
+        # Закрывается только ожидающий платеж - как в сверке и уведомлениях ЮKassa
+        close_payment(payment_id, 'canceled')
         bot.answer_callback_query(
             call.id,
-            "⌛ Платеж еще не прошел. Попробуйте проверить позже.",
+            f"❌ Платеж не прошел. Статус: {payment_info['status']}",
             show_alert=True
         )
     else:
-        # Платеж не прошел (например, canceled, expired, etc.)
-        update_payment_status(payment_id, payment_info['status'])
+        # pending / waiting_for_capture - ЮKassa еще не завершила платеж
         bot.answer_callback_query(
             call.id,
-            f"❌ Платеж не прошел. Статус: {payment_info['status']}",
+            "⌛ Платеж еще не прошел. Попробуйте проверить позже.",
             show_alert=True
         )
 
 
+def show_payment_success(chat_id, message_id, user_id, amount):
+    """Показывает пользователю зачисленный платеж ЮKassa."""
+    user_data = get_user(user_id)
+    caption = (
+        f"✅ Платеж успешно завершен!\n"
+        f"💳 Сумма: **{amount:.2f} руб**\n"
+        f"💰 Новый баланс: **{user_data['balance']:.2f} руб**"
+    )
+    if message_id:
+        bot.edit_message_caption(
+            chat_id=chat_id,
+            message_id=message_id,
+            caption=caption,
+            reply_markup=back_to_main_keyboard(),
+            parse_mode='Markdown'
+        )
+    else:
+        bot.send_message(user_id, caption, parse_mode='Markdown')
+
+
+def notify_payment_credited(payment):
+    """Сообщает администратору и пользователю о платеже ЮKassa, зачисленном без нажатия «Я оплатил»."""
+    user_data = get_user(payment['user_id'])
+    user_info = type('MockUser', (object,), {
+        'id': payment['user_id'],
+        'username': user_data['username'] if user_data else None,
+        'first_name': f"User{payment['user_id']}"
+    })()
+    send_admin_deposit_notification(user_info, payment['amount'], 'yookassa', 'completed')
+    try:
+        show_payment_success(payment['chat_id'], payment['message_id'], payment['user_id'], payment['amount'])
+    except Exception as e:
+        logger.error(f"Не удалось обновить сообщение о платеже {payment['yookassa_id']}: {e}")
+
+
+def notify_payment_closed(payment, status):
+    if not payment['message_id']:
+        return
+    try:
+        bot.edit_message_caption(
+            chat_id=payment['chat_id'],
+            message_id=payment['message_id'],
+            caption=f"❌ Платеж не прошел. Статус: {status}",
+            reply_markup=back_to_main_keyboard()
+        )
+    except Exception as e:
+        logger.error(f"Не удалось обновить сообщение о платеже {payment['yookassa_id']}: {e}")
+
+
+payment_reconciler = PaymentReconciler(on_credited=notify_payment_credited, on_closed=notify_payment_closed)
+
+
+def handle_yookassa_notification(environ, body):
+    """HTTP-обработчик уведомлений ЮKassa: зачисляет платеж без нажатия «Я оплатил»."""
+    try:
+        event = json.loads(body)
+    except ValueError:
+        return '400 Bad Request', {'ok': False}
+
+    # Исключение (например, API ЮKassa недоступен) вернет 500, и ЮKassa повторит уведомление
+    result, payment = process_notification(event)
+
+    if result == 'credited':
+        notify_payment_credited(payment)
+    elif result == 'canceled':
+        notify_payment_closed(payment, 'canceled')
+
+    return '200 OK', {'ok': True, 'result': result}
+
+
 # --- ФУНКЦИИ ФОНОВОГО МОНИТОРИНГА TON (ОБНОВЛЕННЫЕ) ---
 # bot.py - добавить эти функции
 
@@ -839,7 +1246,7 @@ def get_ton_rub_rate():
 def fetch_fresh_ton_rate():
     """Получает свежий курс TON от API."""
     try:
-        response = requests.get(TON_RATE_API, timeout=5)
+        response = get_session('coingecko').get(TON_RATE_API)
         response.raise_for_status()
         data = response.json()
         rate = data.get('the-open-network', {}).get('rub')
@@ -869,119 +1276,58 @@ async def update_ton_rate_periodically():
         await asyncio.sleep(600)  # 10 минут
 
 
-async def check_deposits():
-    if not TON_DEPOSIT_ADDRESS or not TON_API_KEY:
-        logger.error("TON_DEPOSIT_ADDRESS или TON_API_KEY не заданы. Мониторинг не запущен.")
-        return
+async def evict_idle_sessions_periodically():
+    """Периодическое вытеснение неактивных сессий из памяти каждые 5 минут."""
+    while True:
+        await asyncio.sleep(300)
+        try:
+            evicted = evict_idle_sessions()
+            if evicted:
+                logger.info(f"🧹 Вытеснено неактивных сессий: {evicted}")
+        except Exception as e:
+            logger.error(f"Ошибка очистки сессий: {e}")
+
+
+def notify_ton_deposit(deposit):
+    """Уведомляет пользователя и администратора о зачисленном депозите TON.
 
-    # --- Чтение last_lt из БД вместо файла ---
-    last_lt_str = get_setting('last_lt', '0')
+    Вызывается из очереди уведомлений сканера; username и итоговый баланс уже
+    есть в deposit, в БД за ними не ходим.
+    """
+    uid, ton_amount, rub_amount = deposit['user_id'], deposit['ton_amount'], deposit['rub_amount']
+
+    # Отправляем уведомление администратору о TON пополнении
     try:
-        last_lt = int(last_lt_str)
-    except ValueError:
-        logger.error(f"Некорректное значение last_lt в БД: '{last_lt_str}'. Используется 0.")
-        last_lt = 0
+        from_user_info = type('MockUser', (object,), {
+            'id': uid,
+            'username': deposit['username'],
+            'first_name': f"User{uid}"  # Заглушка, так как нет реального объекта пользователя
+        })()
+        send_admin_deposit_notification(from_user_info, rub_amount, 'ton', 'completed', ton_amount)
+    except Exception as e:
+        logger.error(f"Ошибка отправки уведомления администратору: {e}")
 
-    logger.info(f"Запуск мониторинга TON. Последний LT: {last_lt}")
+    try:
+        bot.send_message(
+            uid,
+            '✅ Депозит через TON подтвержден!\n'
+            f'Сумма: *+{ton_amount:.4f} TON* ({rub_amount:.2f} руб)\n'
+            f'Ваш новый баланс: {deposit["balance"]:.2f} руб',
+            parse_mode='Markdown'
+        )
+    except Exception as e:
+        logger.error(f"Error sending message to user {uid}: {e}")
 
-    while True:
-        await asyncio.sleep(10)
-        try:
-            ton_rub_rate = get_ton_rub_rate()
-            if not ton_rub_rate:
-                continue
-
-            api_url = (
-                f'{TON_API_BASE_URL}/api/v2/getTransactions?'
-                f'address={TON_DEPOSIT_ADDRESS}&limit=100&'
-                f'archival=true&api_key={TON_API_KEY}'
-            )
 
-            resp = requests.get(api_url, timeout=10).json()
-
-            if not resp.get('ok'):
-                logger.error(f"Ошибка ответа TON API: {resp.get('error', 'Неизвестная ошибка')}")
-                continue
-
-            current_max_lt = last_lt
-
-            # Обрабатываем транзакции в обратном порядке (от новых к старым)
-            for tx in reversed(resp.get('result', [])):
-                lt = int(tx['transaction_id']['lt'])
-
-                if lt > current_max_lt:
-                    current_max_lt = lt
-
-                if lt <= last_lt:
-                    continue
-
-                in_msg = tx.get('in_msg')
-                if not in_msg:
-                    continue
-
-                value_nano = int(in_msg.get('value', 0))
-
-                if value_nano > 0:
-                    uid_str = ''
-                    # Пытаемся получить user_id из поля 'message' (обычно там комментарий)
-                    uid_str = in_msg.get('message', '').strip()
-
-                    if not uid_str.isdigit():
-                        logger.warning(f"Пропущена транзакция: {lt}. Некорректный uid в комментарии: '{uid_str}'")
-                        continue
-
-                    uid = int(uid_str)
-                    ton_amount = value_nano / 1e9
-
-                    # Конвертация TON в RUB
-                    rub_amount = round(ton_amount * ton_rub_rate, 2)
-
-                    if rub_amount < 1.0:  # Игнорируем слишком маленькие суммы
-                        continue
-
-                    user_data = get_user(uid)
-                    if not user_data:
-                        logger.warning(f"Пропущена транзакция: {lt}. Пользователь {uid} не найден.")
-                        continue
-
-                    # Пополнение баланса в РУБЛЯХ
-                    update_balance(uid, rub_amount)
-                    # target_user используем для хранения информации о TON транзакции
-                    add_transaction(uid, rub_amount, 'deposit_ton', 'completed', target_user=f'{ton_amount:.4f} TON')
-
-                    logger.info(f"✅ Депозит TON подтвержден! User: {uid}, TON: {ton_amount}, RUB: {rub_amount}")
-
-                    # Отправляем уведомление администратору о TON пополнении
-                    try:
-                        from_user_info = type('MockUser', (object,), {
-                            'id': uid,
-                            'username': user_data['username'],
-                            'first_name': f"User{uid}"  # Заглушка, так как нет реального объекта пользователя
-                        })()
-                        send_admin_deposit_notification(from_user_info, rub_amount, 'ton', 'completed', ton_amount)
-                    except Exception as e:
-                        logger.error(f"Ошибка отправки уведомления администратору: {e}")
-
-                    try:
-                        bot.send_message(
-                            uid,
-                            '✅ Депозит через TON подтвержден!\n'
-                            f'Сумма: *+{ton_amount:.4f} TON* ({rub_amount:.2f} руб)\n'
-                            f'Ваш новый баланс: {get_user(uid)["balance"]:.2f} руб',
-                            parse_mode='Markdown'
-                        )
-                    except Exception as e:
-                        logger.error(f"Error sending message to user {uid}: {e}")
-
-            # --- Сохранение максимального LT в БД ---
-            if current_max_lt > last_lt:
-                last_lt = current_max_lt
-                set_setting('last_lt', last_lt)  # <--- Запись в БД
-
-        except requests.exceptions.Timeout:
-            logger.error("TON API запрос таймаут.")
-        except Exception as e:
-            logger.error(f"Критическая ошибка в TON мониторинге: {e}")
+ton_scanner = TonDepositScanner(TON_DEPOSIT_ADDRESS, TON_API_KEY, get_ton_rub_rate, on_credited=notify_ton_deposit)
+
+
+async def check_deposits():
+    if not TON_DEPOSIT_ADDRESS or not TON_API_KEY:
+        logger.error("TON_DEPOSIT_ADDRESS или TON_API_KEY не заданы. Мониторинг не запущен.")
+        return
+
+    await ton_scanner.run()
 
 
 def run_async_loop():
@@ -994,11 +1340,52 @@ def run_async_loop():
 
 
 def run_async_rate_updater():
-    """Запуск асинхронного обновления курса в отдельном потоке."""
+    """Запуск асинхронного обновления курса, очистки сессий и сверки платежей в отдельном потоке."""
     time.sleep(2)  # Небольшая задержка после старта
     loop = asyncio.new_event_loop()
     asyncio.set_event_loop(loop)
-    loop.run_until_complete(update_ton_rate_periodically())
+    loop.run_until_complete(asyncio.gather(
+        update_ton_rate_periodically(),
+        evict_idle_sessions_periodically(),
+        payment_reconciler.run()
+    ))
+
+
+def run_order_queue():
+    """Запуск очереди заказов Fragment в отдельном потоке."""
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    loop.run_until_complete(order_queue.run())
+
+
+def run_webhook():
+    """Прием апдейтов через webhook: HTTP-сервер кладет их в очередь с пулом воркеров."""
+    # Обработчики выполняются прямо в воркерах очереди, а не во внутреннем пуле TeleBot:
+    # так размер пула задается WEBHOOK_WORKERS, а метрики задержки честные
+    bot.threaded = False
+
+    # Без секрета апдейт от имени администратора мог бы прислать кто угодно
+    secret = WEBHOOK_SECRET
+    if not secret:
+        secret = secrets.token_urlsafe(32)
+        logger.warning("⚠️ WEBHOOK_SECRET не задан: сгенерирован случайный секрет, GET /metrics недоступен")
+
+    update_queue = webhook.UpdateQueue(bot, WEBHOOK_WORKERS)
+    update_queue.start()
+    webhook.register_telegram_routes(update_queue, WEBHOOK_PATH, secret)
+
+    try:
+        bot.remove_webhook()
+        bot.set_webhook(url=f"{WEBHOOK_URL.rstrip('/')}{WEBHOOK_PATH}", secret_token=secret)
+        logger.info(f"✅ Webhook установлен: {WEBHOOK_URL.rstrip('/')}{WEBHOOK_PATH}")
+    except Exception as e:
+        logger.error(f"❌ Не удалось установить webhook: {e}")
+
+    logger.info(f"Бот запущен (webhook, воркеров: {WEBHOOK_WORKERS})...")
+    try:
+        webhook.serve(WEBHOOK_HOST, WEBHOOK_PORT)
+    except Exception as e:
+        logger.error(f"Критическая ошибка: {e}")
 
 
 def main():
@@ -1012,6 +1399,13 @@ def main():
     except Exception as e:
         logger.error(f"Ошибка очистки старых файлов экспорта: {e}")
 
+    try:
+        bot_info = get_bot_info()
+        logger.info(f"Бот @{bot_info.username} (id {bot_info.id})")
+    except Exception as e:
+        # Повторная попытка будет при первом обращении к get_bot_info()
+        logger.error(f"Не удалось получить данные бота: {e}")
+
     logger.info("Получение начального курса TON...")
     initial_rate = get_ton_rub_rate()
     if initial_rate:
@@ -1030,24 +1424,36 @@ def main():
     # Проверка и обновление токена Fragment API
     logger.info("Проверка и обновление токена Fragment API...")
     try:
-        token = load_fragment_token()
-        if not token:
-            logger.info("Токен не найден. Запуск аутентификации...")
-            token = authenticate_fragment()
-            if token:
-                logger.info("✅ Аутентификация Fragment API прошла успешно!")
-            else:
-                logger.error("❌ Не удалось получить токен Fragment API. Отправка звезд будет невозможна.")
+        # Менеджер берет токен из файла, если он еще действует, иначе авторизуется
+        # и дальше сам обновляет токен до истечения
+        if token_manager.get_token():
+            logger.info("✅ Токен Fragment API готов.")
         else:
-            logger.info("✅ Существующий токен Fragment API найден.")
+            logger.error("❌ Не удалось получить токен Fragment API. Отправка звезд будет невозможна.")
     except Exception as e:
         logger.error(f"Ошибка работы с Fragment API: {e}")
 
-    logger.info("Бот запущен...")
-    try:
-        bot.infinity_polling()
-    except Exception as e:
-        logger.error(f"Критическая ошибка: {e}")
+    order_thread = threading.Thread(target=run_order_queue, daemon=True)
+    order_thread.start()
+    logger.info("Запущена очередь заказов звезд.")
+
+    if YOOKASSA_WEBHOOK_ENABLED:
+        webhook.add_route('POST', YOOKASSA_WEBHOOK_PATH, handle_yookassa_notification)
+        logger.info(f"Прием уведомлений ЮKassa: {YOOKASSA_WEBHOOK_PATH}")
+
+    if WEBHOOK_URL:
+        run_webhook()
+    else:
+        if YOOKASSA_WEBHOOK_ENABLED:
+            # В режиме polling HTTP-сервер нужен только для уведомлений ЮKassa
+            http_thread = threading.Thread(target=webhook.serve, args=(WEBHOOK_HOST, WEBHOOK_PORT), daemon=True)
+            http_thread.start()
+
+        logger.info("Бот запущен (polling)...")
+        try:
+            bot.infinity_polling()
+        except Exception as e:
+            logger.error(f"Критическая ошибка: {e}")
 
 
 if __name__ == "__main__":
@@ -26,21 +26,52 @@ BOT_TOKEN = os.getenv('BOT_TOKEN')
 ADMIN_ID = os.getenv('ADMIN_ID')
 DB_NAME = 'bot_database.db'
 
+# Webhook (если WEBHOOK_URL не задан, бот работает через polling)
+WEBHOOK_URL = os.getenv('WEBHOOK_URL')  # Публичный адрес, например https://example.com
+WEBHOOK_PATH = os.getenv('WEBHOOK_PATH', '/telegram')
+WEBHOOK_SECRET = os.getenv('WEBHOOK_SECRET')
+WEBHOOK_HOST = os.getenv('WEBHOOK_HOST', '0.0.0.0')
+WEBHOOK_PORT = int(os.getenv('WEBHOOK_PORT', '8080'))
+WEBHOOK_WORKERS = int(os.getenv('WEBHOOK_WORKERS', '8'))  # Потоков обработки апдейтов
+
 # ЮKassa
 YOOKASSA_SHOP_ID = os.getenv('YOOKASSA_SHOP_ID')
 YOOKASSA_SECRET_KEY = os.getenv('YOOKASSA_SECRET_KEY')
 YOOKASSA_API_URL = "https://api.yookassa.ru/v3/payments"
+# Прием HTTP-уведомлений ЮKassa (payment.succeeded / payment.canceled) на WEBHOOK_HOST:WEBHOOK_PORT
+YOOKASSA_WEBHOOK_ENABLED = os.getenv('YOOKASSA_WEBHOOK_ENABLED', '0') == '1'
+YOOKASSA_WEBHOOK_PATH = os.getenv('YOOKASSA_WEBHOOK_PATH', '/yookassa')
+# Перепроверять статус платежа через API ЮKassa перед зачислением (отключать только для локальных тестов)
+YOOKASSA_WEBHOOK_VERIFY = os.getenv('YOOKASSA_WEBHOOK_VERIFY', '1') == '1'
+# Фоновая сверка ожидающих платежей ЮKassa
+YOOKASSA_RECONCILE_INTERVAL = int(os.getenv('YOOKASSA_RECONCILE_INTERVAL', '60'))  # Секунд между проходами
+YOOKASSA_RECONCILE_CONCURRENCY = int(os.getenv('YOOKASSA_RECONCILE_CONCURRENCY', '5'))  # Запросов к API одновременно
+
+# Папка накопительного архива инкрементальных выгрузок (/export delta); если не задана, архив не ведется
+EXPORT_ARCHIVE_DIR = os.getenv('EXPORT_ARCHIVE_DIR')
 
 # TON Wallet Configuration
 TON_DEPOSIT_ADDRESS = os.getenv('TON_DEPOSIT_ADDRESS')
 TON_API_KEY = os.getenv('TON_API_KEY')
-TON_API_BASE_URL = 'https://toncenter.com'
+TON_API_BASE_URL = os.getenv('TON_API_BASE_URL', 'https://toncenter.com').rstrip('/')  # Для локальной замены toncenter
+TON_POLL_INTERVAL = int(os.getenv('TON_POLL_INTERVAL', '10'))  # Секунд между проверками после новых транзакций
+TON_POLL_FAST_INTERVAL = int(os.getenv('TON_POLL_FAST_INTERVAL', '3'))  # Пока пользователь ждет депозит
+TON_POLL_MAX_INTERVAL = int(os.getenv('TON_POLL_MAX_INTERVAL', '120'))  # Предел замедления, когда ничего не приходит
+TON_EXPECT_WINDOW = int(os.getenv('TON_EXPECT_WINDOW', '900'))  # Сколько секунд ждать депозит после открытия экрана TON
+TON_SCAN_PAGE_SIZE = 100  # Транзакций на страницу getTransactions (максимум toncenter)
+# Общие адреса (биржи, кастодиальные кошельки вроде @wallet) через запятую: депозиты с них
+# никогда не сопоставляются с пользователем по адресу отправителя
+TON_SHARED_SENDERS = frozenset(filter(None, (
+    address.strip() for address in os.getenv('TON_SHARED_SENDERS', '').split(',')
+)))
 
 # Fragment API
 FRAGMENT_API_URL = "https://api.fragment-api.com/v1"
 FRAGMENT_API_KEY = os.getenv("FRAGMENT_API_KEY")
 FRAGMENT_PHONE = os.getenv("FRAGMENT_PHONE")
 FRAGMENT_MNEMONICS = os.getenv("FRAGMENT_MNEMONICS")
+FRAGMENT_CONCURRENCY = int(os.getenv("FRAGMENT_CONCURRENCY", "3"))  # Одновременных заказов в Fragment
+FRAGMENT_RATE_LIMIT = float(os.getenv("FRAGMENT_RATE_LIMIT", "1"))  # Заказов в секунду
 
 # Проверка наличия токена бота
 if not BOT_TOKEN:
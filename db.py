@@ -1,10 +1,69 @@
 import sqlite3
-from config import DB_NAME, logger
+import threading
+from config import DB_NAME, TON_SHARED_SENDERS, logger
+from cache import TTLCache
+
+
+# --- Долгоживущие соединения с БД ---
+# SQLite-соединение нельзя безопасно делить между потоками, поэтому каждый поток
+# (воркеры TeleBot, потоки мониторинга TON и курса) держит своё соединение
+# и переиспользует его вместе с кэшем подготовленных запросов.
+STATEMENT_CACHE_SIZE = 256
+BUSY_TIMEOUT = 30
+
+_local = threading.local()
+_connections = {}  # поток -> соединение
+_connections_lock = threading.Lock()
+# Растет при каждом close_connections: соединение потока, открытое в прошлом
+# поколении, уже закрыто, и при следующем обращении поток откроет новое
+_generation = 0
+
+
+def _open_connection():
+    conn = sqlite3.connect(
+        DB_NAME,
+        timeout=BUSY_TIMEOUT,
+        cached_statements=STATEMENT_CACHE_SIZE,
+        check_same_thread=False  # нужно только для закрытия из другого потока
+    )
+    # WAL: читатели не блокируют писателя, fsync только на checkpoint
+    conn.execute('PRAGMA journal_mode=WAL')
+    conn.execute('PRAGMA synchronous=NORMAL')
+    return conn
+
+
+def get_connection():
+    """Возвращает соединение текущего потока, открывая его при первом обращении."""
+    conn = getattr(_local, 'conn', None)
+    if conn is None or _local.generation != _generation:
+        conn = _open_connection()
+        with _connections_lock:
+            # Закрываем соединения завершившихся потоков
+            for thread in [t for t in _connections if not t.is_alive()]:
+                _connections.pop(thread).close()
+            _connections[threading.current_thread()] = conn
+            _local.conn, _local.generation = conn, _generation
+    return conn
+
+
+def close_connections():
+    """Закрывает соединения всех потоков (при остановке бота и в утилитах).
+
+    Потоки, которые обратятся к БД после этого, откроют новые соединения,
+    а не получат закрытое.
+    """
+    global _generation
+    with _connections_lock:
+        for conn in _connections.values():
+            conn.close()
+        _connections.clear()
+        _generation += 1
+    _local.__dict__.clear()
 
 
 # Инициализация базы данных
 def init_db():
-    conn = sqlite3.connect(DB_NAME)
+    conn = get_connection()
     cursor = conn.cursor()
 
     # Таблица пользователей
@@ -66,92 +125,854 @@ def init_db():
     )
     ''')
 
+    # Резервы баланса под покупки, ожидающие ответа Fragment
+    cursor.execute('''
+    CREATE TABLE IF NOT EXISTS balance_holds (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        user_id INTEGER,
+        amount REAL,
+        transaction_id INTEGER,
+        status TEXT DEFAULT 'held',  -- held / settled / released
+        created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+        FOREIGN KEY (user_id) REFERENCES users (user_id),
+        FOREIGN KEY (transaction_id) REFERENCES transactions (id)
+    )
+    ''')
+
     conn.commit()
-    conn.close()
+
+    apply_migrations(conn)
     logger.info("✅ База данных инициализирована.")
 
 
+# Таблицы, в которых время изменения строки ведется триггерами:
+# таблица -> (первичный ключ, колонки, изменение которых обновляет updated_at; None - любые)
+# Служебная отметка payments.checked_at не считается изменением платежа.
+UPDATED_AT_TABLES = {
+    'users': ('user_id', None),
+    'transactions': ('id', None),
+    'payments': ('id', 'user_id, amount, yookassa_id, status, chat_id, message_id'),
+    'settings': ('key', None),
+}
+
+
+def _add_updated_at_tracking(cursor, tables=UPDATED_AT_TABLES):
+    for table, (key, columns) in tables.items():
+        cursor.execute(f'ALTER TABLE {table} ADD COLUMN updated_at TIMESTAMP')
+        cursor.execute(f'PRAGMA table_info({table})')
+        has_created_at = any(column[1] == 'created_at' for column in cursor.fetchall())
+        backfill = 'COALESCE(created_at, CURRENT_TIMESTAMP)' if has_created_at else 'CURRENT_TIMESTAMP'
+        cursor.execute(f'UPDATE {table} SET updated_at = {backfill}')
+
+        # ALTER TABLE не допускает DEFAULT CURRENT_TIMESTAMP, поэтому время ставят триггеры
+        cursor.execute(f'''
+            CREATE TRIGGER IF NOT EXISTS trg_{table}_updated_at_insert AFTER INSERT ON {table}
+            BEGIN
+                UPDATE {table} SET updated_at = CURRENT_TIMESTAMP WHERE {key} = NEW.{key};
+            END
+        ''')
+        cursor.execute(f'''
+            CREATE TRIGGER IF NOT EXISTS trg_{table}_updated_at_update
+            AFTER UPDATE {f'OF {columns} ' if columns else ''}ON {table}
+            WHEN NEW.updated_at IS OLD.updated_at
+            BEGIN
+                UPDATE {table} SET updated_at = CURRENT_TIMESTAMP WHERE {key} = NEW.{key};
+            END
+        ''')
+        cursor.execute(f'CREATE INDEX IF NOT EXISTS idx_{table}_updated_at ON {table} (updated_at)')
+
+
+def _add_balance_holds_updated_at(cursor):
+    _add_updated_at_tracking(cursor, {'balance_holds': ('id', None)})
+
+
+# Материализованные счетчики статистики (таблица stats_counters) ведут триггеры,
+# поэтому их не обходит ни одна функция записи. Строка с day = '' - итог за все
+# время, остальные - вклад строк, созданных в этот день (UTC, по created_at).
+# счетчик -> (таблица, вклад строки R, колонки, от которых вклад зависит, вести ли по дням)
+STATS_COUNTERS = {
+    'users_total': ('users', '1', (), True),
+    'users_with_referrer': ('users', 'R.referrer_id IS NOT NULL', ('referrer_id',), True),
+    'balance_total': ('users', 'COALESCE(R.balance, 0)', ('balance',), False),
+    'stars_purchases': (
+        'transactions', "R.type = 'stars_purchase' AND R.status = 'completed'", ('type', 'status'), True
+    ),
+    'stars_purchases_amount': (
+        'transactions', "CASE WHEN R.type = 'stars_purchase' AND R.status = 'completed' THEN COALESCE(R.amount, 0) ELSE 0 END",
+        ('type', 'status', 'amount'), True
+    ),
+    'payments_succeeded': ('payments', "R.status = 'succeeded'", ('status',), True),
+    'payments_succeeded_amount': (
+        'payments', "CASE WHEN R.status = 'succeeded' THEN COALESCE(R.amount, 0) ELSE 0 END", ('status', 'amount'), True
+    ),
+}
+
+
+def _counter_upsert(name, day, value, condition):
+    return f"""
+        INSERT INTO stats_counters (name, day, value) SELECT '{name}', {day}, {value} WHERE {condition}
+        ON CONFLICT (name, day) DO UPDATE SET value = ROUND(value + excluded.value, 2);"""
+
+
+def _create_stats_counters(cursor):
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS stats_counters (
+            name TEXT NOT NULL,
+            day TEXT NOT NULL DEFAULT '',  -- '' - за все время, иначе YYYY-MM-DD
+            value REAL NOT NULL DEFAULT 0,
+            PRIMARY KEY (name, day)
+        )
+    ''')
+
+    for table in dict.fromkeys(spec[0] for spec in STATS_COUNTERS.values()):
+        counters = [(name, spec) for name, spec in STATS_COUNTERS.items() if spec[0] == table]
+        on_insert, on_delete, on_update = [], [], []
+        watched = {'created_at'}
+        for name, (_, expr, columns, daily) in counters:
+            new, old = expr.replace('R.', 'NEW.'), expr.replace('R.', 'OLD.')
+            watched.update(columns)
+            on_insert.append(_counter_upsert(name, "''", new, f'({new}) != 0'))
+            on_delete.append(_counter_upsert(name, "''", f'-({old})', f'({old}) != 0'))
+            on_update.append(_counter_upsert(name, "''", f'({new}) - ({old})', f'({new}) != ({old})'))
+            if daily:
+                on_insert.append(_counter_upsert(name, 'date(NEW.created_at)', new, f'({new}) != 0'))
+                on_delete.append(_counter_upsert(name, 'date(OLD.created_at)', f'-({old})', f'({old}) != 0'))
+                same_day = 'date(NEW.created_at) IS date(OLD.created_at)'
+                on_update.append(_counter_upsert(
+                    name, 'date(NEW.created_at)', f'({new}) - ({old})', f'{same_day} AND ({new}) != ({old})'
+                ))
+                on_update.append(_counter_upsert(
+                    name, 'date(OLD.created_at)', f'-({old})', f'NOT {same_day} AND ({old}) != 0'
+                ))
+                on_update.append(_counter_upsert(
+                    name, 'date(NEW.created_at)', new, f'NOT {same_day} AND ({new}) != 0'
+                ))
+
+        cursor.execute(f"CREATE TRIGGER IF NOT EXISTS trg_{table}_stats_insert AFTER INSERT ON {table} "
+                       f"BEGIN {''.join(on_insert)} END")
+        cursor.execute(f"CREATE TRIGGER IF NOT EXISTS trg_{table}_stats_delete AFTER DELETE ON {table} "
+                       f"BEGIN {''.join(on_delete)} END")
+        cursor.execute(f"CREATE TRIGGER IF NOT EXISTS trg_{table}_stats_update "
+                       f"AFTER UPDATE OF {', '.join(sorted(watched))} ON {table} "
+                       f"BEGIN {''.join(on_update)} END")
+
+    _rebuild_stats_counters(cursor)
+
+
+def _actual_stats_counters(cursor):
+    """Значения счетчиков, посчитанные заново по таблицам: {(счетчик, день): значение}."""
+    actual = {}
+    for name, (table, expr, _, daily) in STATS_COUNTERS.items():
+        cursor.execute(f'SELECT SUM({expr}) FROM {table} R')
+        actual[(name, '')] = round(cursor.fetchone()[0] or 0, 2)
+        if daily:
+            cursor.execute(f'SELECT date(R.created_at), SUM({expr}) FROM {table} R GROUP BY 1')
+            for day, value in cursor.fetchall():
+                if value:
+                    actual[(name, day or '')] = round(value, 2)
+    return actual
+
+
+def _rebuild_stats_counters(cursor):
+    """Пересчитывает счетчики с нуля. Возвращает расхождения [(счетчик, день, было, стало)]."""
+    cursor.execute('SELECT name, day, value FROM stats_counters')
+    stored = {(name, day): value for name, day, value in cursor.fetchall()}
+    actual = _actual_stats_counters(cursor)
+
+    drift = []
+    for key in sorted(set(stored) | set(actual)):
+        before, after = stored.get(key, 0), actual.get(key, 0)
+        if abs(before - after) > 0.001:
+            drift.append((key[0], key[1], before, after))
+
+    cursor.execute('DELETE FROM stats_counters')
+    cursor.executemany(
+        'INSERT INTO stats_counters (name, day, value) VALUES (?, ?, ?)',
+        [(name, day, value) for (name, day), value in actual.items()]
+    )
+    return drift
+
+
+
+# Почасовые и посуточные срезы для /report: {метрика: (таблица, выражение над R, колонки)}.
+# Строка попадает в корзину по своему created_at (UTC), поэтому запоздавшие
+# строки и смена статуса задним числом правят ту корзину, к которой относятся.
+# Сумма stars_purchase в transactions - это число звезд, выручка в рублях - в balance_holds.
+ROLLUP_GRAINS = {
+    'hour': "strftime('%Y-%m-%d %H:00', R.created_at)",
+    'day': 'date(R.created_at)',
+}
+
+ROLLUP_METRICS = {
+    'stars_orders': ('transactions', "R.type = 'stars_purchase' AND R.status = 'completed'", ('type', 'status')),
+    'stars_sold': (
+        'transactions', "CASE WHEN R.type = 'stars_purchase' AND R.status = 'completed' THEN COALESCE(R.amount, 0) ELSE 0 END",
+        ('type', 'status', 'amount')
+    ),
+    'stars_revenue': (
+        'balance_holds', "CASE WHEN R.status = 'settled' THEN COALESCE(R.amount, 0) ELSE 0 END", ('status', 'amount')
+    ),
+    'deposits_yookassa': ('transactions', "R.type = 'deposit' AND R.status = 'completed'", ('type', 'status')),
+    'deposits_yookassa_amount': (
+        'transactions', "CASE WHEN R.type = 'deposit' AND R.status = 'completed' THEN COALESCE(R.amount, 0) ELSE 0 END",
+        ('type', 'status', 'amount')
+    ),
+    'deposits_ton': ('transactions', "R.type = 'deposit_ton' AND R.status = 'completed'", ('type', 'status')),
+    'deposits_ton_amount': (
+        'transactions', "CASE WHEN R.type = 'deposit_ton' AND R.status = 'completed' THEN COALESCE(R.amount, 0) ELSE 0 END",
+        ('type', 'status', 'amount')
+    ),
+    'payments_created': ('payments', '1', ()),
+    'payments_succeeded': ('payments', "R.status = 'succeeded'", ('status',)),
+}
+
+
+def _rollup_upsert(grain, bucket, metric, value, condition):
+    return f"""
+        INSERT INTO stats_rollups (grain, bucket, metric, value) SELECT '{grain}', {bucket}, '{metric}', {value}
+        WHERE {condition}
+        ON CONFLICT (grain, bucket, metric) DO UPDATE SET value = ROUND(value + excluded.value, 2);"""
+
+
+def _create_stats_rollups(cursor):
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS stats_rollups (
+            grain TEXT NOT NULL,   -- hour / day
+            bucket TEXT NOT NULL,  -- 'YYYY-MM-DD HH:00' или 'YYYY-MM-DD' (UTC)
+            metric TEXT NOT NULL,
+            value REAL NOT NULL DEFAULT 0,
+            PRIMARY KEY (grain, bucket, metric)
+        )
+    ''')
+
+    for table in dict.fromkeys(spec[0] for spec in ROLLUP_METRICS.values()):
+        metrics = [(metric, spec) for metric, spec in ROLLUP_METRICS.items() if spec[0] == table]
+        on_insert, on_delete, on_update = [], [], []
+        watched = {'created_at'}
+        for metric, (_, expr, columns) in metrics:
+            new, old = expr.replace('R.', 'NEW.'), expr.replace('R.', 'OLD.')
+            watched.update(columns)
+            for grain, bucket in ROLLUP_GRAINS.items():
+                new_bucket, old_bucket = bucket.replace('R.', 'NEW.'), bucket.replace('R.', 'OLD.')
+                same_bucket = f'{new_bucket} IS {old_bucket}'
+                on_insert.append(_rollup_upsert(grain, new_bucket, metric, new, f'({new}) != 0'))
+                on_delete.append(_rollup_upsert(grain, old_bucket, metric, f'-({old})', f'({old}) != 0'))
+                on_update.append(_rollup_upsert(
+                    grain, new_bucket, metric, f'({new}) - ({old})', f'{same_bucket} AND ({new}) != ({old})'
+                ))
+                on_update.append(_rollup_upsert(
+                    grain, old_bucket, metric, f'-({old})', f'NOT {same_bucket} AND ({old}) != 0'
+                ))
+                on_update.append(_rollup_upsert(
+                    grain, new_bucket, metric, new, f'NOT {same_bucket} AND ({new}) != 0'
+                ))
+
+        cursor.execute(f"CREATE TRIGGER IF NOT EXISTS trg_{table}_rollup_insert AFTER INSERT ON {table} "
+                       f"BEGIN {''.join(on_insert)} END")
+        cursor.execute(f"CREATE TRIGGER IF NOT EXISTS trg_{table}_rollup_delete AFTER DELETE ON {table} "
+                       f"BEGIN {''.join(on_delete)} END")
+        cursor.execute(f"CREATE TRIGGER IF NOT EXISTS trg_{table}_rollup_update "
+                       f"AFTER UPDATE OF {', '.join(sorted(watched))} ON {table} "
+                       f"BEGIN {''.join(on_update)} END")
+
+    _rebuild_stats_rollups(cursor)
+
+
+def _actual_stats_rollups(cursor):
+    """Срезы, посчитанные заново по таблицам: {(срез, корзина, метрика): значение}."""
+    actual = {}
+    for metric, (table, expr, _) in ROLLUP_METRICS.items():
+        for grain, bucket in ROLLUP_GRAINS.items():
+            cursor.execute(f'SELECT {bucket}, SUM({expr}) FROM {table} R GROUP BY 1')
+            for key, value in cursor.fetchall():
+                if value and key is not None:
+                    actual[(grain, key, metric)] = round(value, 2)
+    return actual
+
+
+def _rebuild_stats_rollups(cursor):
+    """Пересчитывает срезы с нуля. Возвращает расхождения [(срез, корзина, метрика, было, стало)]."""
+    cursor.execute('SELECT grain, bucket, metric, value FROM stats_rollups')
+    stored = {(grain, bucket, metric): value for grain, bucket, metric, value in cursor.fetchall()}
+    actual = _actual_stats_rollups(cursor)
+
+    drift = []
+    for key in sorted(set(stored) | set(actual)):
+        before, after = stored.get(key, 0), actual.get(key, 0)
+        if abs(before - after) > 0.001:
+            drift.append((*key, before, after))
+
+    cursor.execute('DELETE FROM stats_rollups')
+    cursor.executemany(
+        'INSERT INTO stats_rollups (grain, bucket, metric, value) VALUES (?, ?, ?, ?)',
+        [(*key, value) for key, value in actual.items()]
+    )
+    return drift
+
+# --- Миграции схемы ---
+# Номер последней примененной миграции хранится в PRAGMA user_version.
+# Миграции применяются по порядку, каждая в своей транзакции; новые добавляются
+# только в конец списка. Шаг миграции - SQL-строка или функция, принимающая курсор.
+MIGRATIONS = [
+    # 1: индексы под выборки платежей, рефералов и статистики
+    [
+        'CREATE INDEX IF NOT EXISTS idx_payments_user_status_created ON payments (user_id, status, created_at)',
+        'CREATE INDEX IF NOT EXISTS idx_payments_yookassa_id ON payments (yookassa_id)',
+        'CREATE INDEX IF NOT EXISTS idx_users_referrer_id ON users (referrer_id)',
+        'CREATE INDEX IF NOT EXISTS idx_transactions_type_status ON transactions (type, status)',
+    ],
+    # 2: персистентная очередь заказов звезд
+    [
+        '''
+        CREATE TABLE IF NOT EXISTS star_orders (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            user_id INTEGER,
+            hold_id INTEGER,
+            target_username TEXT,
+            stars INTEGER,
+            cost REAL,
+            chat_id INTEGER,
+            message_id INTEGER,
+            status TEXT DEFAULT 'queued',  -- queued / processing / completed / failed / unknown
+            error TEXT,
+            attempts INTEGER DEFAULT 0,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            FOREIGN KEY (user_id) REFERENCES users (user_id),
+            FOREIGN KEY (hold_id) REFERENCES balance_holds (id)
+        )
+        ''',
+        'CREATE INDEX IF NOT EXISTS idx_star_orders_status ON star_orders (status, id)',
+    ],
+    # 3: сообщение с кнопкой оплаты, чтобы webhook ЮKassa мог его обновить
+    [
+        'ALTER TABLE payments ADD COLUMN chat_id INTEGER',
+        'ALTER TABLE payments ADD COLUMN message_id INTEGER',
+    ],
+    # 4: учет проверок ожидающих платежей фоновой сверкой
+    [
+        'ALTER TABLE payments ADD COLUMN checked_at TIMESTAMP',
+        'CREATE INDEX IF NOT EXISTS idx_payments_status_id ON payments (status, id)',
+    ],
+    # 5: колонка updated_at для инкрементального экспорта
+    [
+        _add_updated_at_tracking,
+    ],
+    # 6: покрывающие индексы для агрегатов статистики (сумма берется из индекса, без чтения строк)
+    [
+        'CREATE INDEX IF NOT EXISTS idx_transactions_type_status_amount ON transactions (type, status, amount)',
+        'DROP INDEX IF EXISTS idx_transactions_type_status',
+        'CREATE INDEX IF NOT EXISTS idx_payments_status_amount ON payments (status, amount)',
+    ],
+    # 7: счетчики статистики, которые ведут триггеры (/stats без проходов по таблицам)
+    [
+        _create_stats_counters,
+    ],
+    # 8: почасовые и посуточные срезы для /report
+    [
+        _create_stats_rollups,
+    ],
+    # 9: зачисленные депозиты TON - хэш транзакции защищает от повторного зачисления
+    [
+        '''
+        CREATE TABLE IF NOT EXISTS ton_deposits (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            tx_hash TEXT NOT NULL UNIQUE,
+            lt INTEGER NOT NULL UNIQUE,
+            user_id INTEGER,
+            sender TEXT,
+            ton_amount REAL,
+            rub_amount REAL,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,  -- строки не меняются, колонка для /export delta
+            FOREIGN KEY (user_id) REFERENCES users (user_id)
+        )
+        ''',
+        'CREATE INDEX IF NOT EXISTS idx_ton_deposits_user_id ON ton_deposits (user_id)',
+        'CREATE INDEX IF NOT EXISTS idx_ton_deposits_updated_at ON ton_deposits (updated_at)',
+    ],
+    # 10: неопознанные депозиты TON и выученное соответствие адрес отправителя -> пользователь
+    [
+        '''
+        CREATE TABLE IF NOT EXISTS unmatched_deposits (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            tx_hash TEXT NOT NULL UNIQUE,
+            lt INTEGER NOT NULL,
+            sender TEXT,
+            comment TEXT,
+            ton_amount REAL,
+            rub_amount REAL,  -- по курсу на момент поступления
+            status TEXT DEFAULT 'open',  -- open / assigned
+            assigned_user_id INTEGER,
+            tx_time TIMESTAMP,  -- время транзакции в сети (UTC)
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            FOREIGN KEY (assigned_user_id) REFERENCES users (user_id)
+        )
+        ''',
+        'CREATE INDEX IF NOT EXISTS idx_unmatched_deposits_sender ON unmatched_deposits (sender)',
+        'CREATE INDEX IF NOT EXISTS idx_unmatched_deposits_comment ON unmatched_deposits (comment)',
+        'CREATE INDEX IF NOT EXISTS idx_unmatched_deposits_status ON unmatched_deposits (status, id)',
+        'CREATE INDEX IF NOT EXISTS idx_unmatched_deposits_amount ON unmatched_deposits (status, ton_amount)',
+        'CREATE INDEX IF NOT EXISTS idx_unmatched_deposits_updated_at ON unmatched_deposits (updated_at)',
+        '''
+        CREATE TABLE IF NOT EXISTS ton_senders (
+            sender TEXT PRIMARY KEY,
+            user_id INTEGER,  -- NULL: с адреса пополняли разные пользователи (биржа), не сопоставляем
+            deposits INTEGER DEFAULT 0,
+            updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+        ''',
+        '''
+        INSERT OR IGNORE INTO ton_senders (sender, user_id, deposits)
+        SELECT sender, CASE WHEN COUNT(DISTINCT user_id) = 1 THEN MIN(user_id) END, COUNT(*)
+        FROM ton_deposits WHERE sender IS NOT NULL GROUP BY sender
+        ''',
+    ],
+    # 11: updated_at у резервов баланса, чтобы они попадали в /export delta
+    [
+        _add_balance_holds_updated_at,
+    ],
+    # 12: по адресу сопоставляются только подтвержденные админом (/assign) отправители
+    [
+        'ALTER TABLE ton_senders ADD COLUMN confirmed INTEGER DEFAULT 0',
+    ],
+]
+
+
+def get_schema_version(conn=None):
+    conn = conn or get_connection()
+    return conn.execute('PRAGMA user_version').fetchone()[0]
+
+
+def apply_migrations(conn=None):
+    """Применяет еще не примененные миграции. Возвращает итоговую версию схемы."""
+    conn = conn or get_connection()
+    version = get_schema_version(conn)
+
+    for number, steps in enumerate(MIGRATIONS[version:], start=version + 1):
+        cursor = conn.cursor()
+        # DDL не открывает транзакцию неявно, поэтому начинаем ее явно
+        cursor.execute('BEGIN IMMEDIATE')
+        try:
+            for step in steps:
+                if callable(step):
+                    step(cursor)
+                else:
+                    cursor.execute(step)
+            cursor.execute(f'PRAGMA user_version = {number}')
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            logger.error(f"❌ Ошибка применения миграции БД #{number}")
+            raise
+        logger.info(f"✅ Применена миграция БД #{number}")
+        version = number
+
+    return version
+
+
+# --- Кэш пользователей ---
+# Все функции, меняющие строку пользователя, обязаны вызвать _invalidate_user,
+# чтобы пользователь никогда не видел устаревший баланс.
+USER_CACHE_SIZE = 50000
+USER_CACHE_TTL = 300
+
+_users = TTLCache(maxsize=USER_CACHE_SIZE, ttl=USER_CACHE_TTL)
+
+
+def _invalidate_user(user_id):
+    _users.invalidate(user_id)
+
+
+def get_user_cache_stats():
+    """Возвращает размер и счетчики попаданий/промахов кэша пользователей."""
+    return _users.stats()
+
+
 def get_user(user_id):
-    conn = sqlite3.connect(DB_NAME)
+    cached = _users.get(user_id)
+    if cached is not None:
+        return dict(cached)
+
+    generation = _users.generation
+    conn = get_connection()
     cursor = conn.cursor()
     cursor.execute('SELECT * FROM users WHERE user_id = ?', (user_id,))
     user = cursor.fetchone()
-    conn.close()
 
     if user:
         # Обновленный возврат с учетом нового поля referrer_id
-        return {
+        user_data = {
             'user_id': user[0],
             'username': user[1],
             'balance': user[2],
             'referrer_id': user[3],  # Индекс 3 для referrer_id
             'created_at': user[4]   # Индекс 4 для created_at
         }
+        _users.set(user_id, user_data, generation)
+        return dict(user_data)
     return None
 
 
 def create_user(user_id, username, referrer_id=None):  # ДОБАВЛЕН referrer_id
-    conn = sqlite3.connect(DB_NAME)
-    cursor = conn.cursor()
-    # Обновленный запрос: добавлено поле referrer_id
-    cursor.execute(
-        'INSERT OR IGNORE INTO users (user_id, username, referrer_id) VALUES (?, ?, ?)',
-        (user_id, username, referrer_id)  # ПЕРЕДАЧА referrer_id
-    )
-    conn.commit()
-    conn.close()
+    conn = get_connection()
+    with conn:
+        cursor = conn.cursor()
+        # Обновленный запрос: добавлено поле referrer_id
+        cursor.execute(
+            'INSERT OR IGNORE INTO users (user_id, username, referrer_id) VALUES (?, ?, ?)',
+            (user_id, username, referrer_id)  # ПЕРЕДАЧА referrer_id
+        )
+    _invalidate_user(user_id)
 
     # Возвращаем True, если пользователь был создан (ROWCOUNT=1)
     return cursor.rowcount == 1
 
 def get_referral_count(user_id):
     """Возвращает количество пользователей, приглашенных данным пользователем."""
-    conn = sqlite3.connect(DB_NAME)
+    conn = get_connection()
     cursor = conn.cursor()
     cursor.execute(
         'SELECT COUNT(*) FROM users WHERE referrer_id = ?',
         (user_id,)
     )
     count = cursor.fetchone()[0]
-    conn.close()
     return count
 
 
 def update_balance(user_id, amount):
-    conn = sqlite3.connect(DB_NAME)
-    cursor = conn.cursor()
+    conn = get_connection()
+    with conn:
+        cursor = conn.cursor()
+        cursor.execute(
+            'UPDATE users SET balance = ROUND(balance + ?, 2) WHERE user_id = ?',
+            (amount, user_id)
+        )
+    _invalidate_user(user_id)
+
+
+def add_transaction(user_id, amount, transaction_type, status='completed', target_user=None):
+    conn = get_connection()
+    with conn:
+        cursor = conn.cursor()
+        cursor.execute(
+            'INSERT INTO transactions (user_id, amount, type, status, target_user) VALUES (?, ?, ?, ?, ?)',
+            (user_id, amount, transaction_type, status, target_user)
+        )
+
+
+# --- РЕЗЕРВИРОВАНИЕ БАЛАНСА ПОД ПОКУПКУ ЗВЕЗД ---
+# Вспомогательные функции работают внутри транзакции вызывающего кода.
+
+def _reserve_balance(cursor, user_id, cost, stars, target_user):
+    cursor.execute(
+        'UPDATE users SET balance = ROUND(balance - ?, 2) WHERE user_id = ? AND balance >= ?',
+        (cost, user_id, cost)
+    )
+    if cursor.rowcount != 1:
+        return None
+
+    cursor.execute(
+        'INSERT INTO transactions (user_id, amount, type, status, target_user) VALUES (?, ?, ?, ?, ?)',
+        (user_id, stars, 'stars_purchase', 'pending', target_user)
+    )
+    cursor.execute(
+        'INSERT INTO balance_holds (user_id, amount, transaction_id) VALUES (?, ?, ?)',
+        (user_id, cost, cursor.lastrowid)
+    )
+    return cursor.lastrowid
+
+
+def _settle_hold(cursor, hold_id):
+    cursor.execute(
+        "UPDATE balance_holds SET status = 'settled' WHERE id = ? AND status = 'held'",
+        (hold_id,)
+    )
+    if cursor.rowcount != 1:
+        return False
+
+    cursor.execute(
+        "UPDATE transactions SET status = 'completed' "
+        "WHERE id = (SELECT transaction_id FROM balance_holds WHERE id = ?)",
+        (hold_id,)
+    )
+    return True
+
+
+def _release_hold(cursor, hold_id):
+    """Возвращает user_id, которому вернули средства, или None."""
+    cursor.execute(
+        "UPDATE balance_holds SET status = 'released' WHERE id = ? AND status = 'held'",
+        (hold_id,)
+    )
+    if cursor.rowcount != 1:
+        return None
+
+    cursor.execute('SELECT user_id, amount, transaction_id FROM balance_holds WHERE id = ?', (hold_id,))
+    user_id, amount, transaction_id = cursor.fetchone()
     cursor.execute(
         'UPDATE users SET balance = ROUND(balance + ?, 2) WHERE user_id = ?',
         (amount, user_id)
     )
-    conn.commit()
-    conn.close()
+    cursor.execute(
+        "UPDATE transactions SET status = 'failed' WHERE id = ?",
+        (transaction_id,)
+    )
+    return user_id
 
 
-def add_transaction(user_id, amount, transaction_type, status='completed', target_user=None):
-    conn = sqlite3.connect(DB_NAME)
+def reserve_stars_purchase(user_id, cost, stars, target_user):
+    """Списывает стоимость в резерв и создает pending-транзакцию одним коммитом.
+
+    Возвращает id резерва или None, если средств на балансе недостаточно.
+    Условный UPDATE исключает двойное списание при параллельных нажатиях.
+    """
+    conn = get_connection()
+    with conn:
+        hold_id = _reserve_balance(conn.cursor(), user_id, cost, stars, target_user)
+    if hold_id is not None:
+        _invalidate_user(user_id)
+    return hold_id
+
+
+def settle_stars_purchase(hold_id):
+    """Подтверждает резерв после успешной отправки звезд. Возвращает True, если резерв был активен."""
+    conn = get_connection()
+    with conn:
+        return _settle_hold(conn.cursor(), hold_id)
+
+
+def release_stars_purchase(hold_id):
+    """Возвращает зарезервированную сумму на баланс, если отправка не удалась."""
+    conn = get_connection()
+    with conn:
+        user_id = _release_hold(conn.cursor(), hold_id)
+    if user_id is None:
+        return False
+    _invalidate_user(user_id)
+    return True
+
+
+# --- ОЧЕРЕДЬ ЗАКАЗОВ ЗВЕЗД ---
+# queued -> processing -> completed / failed. Заказы, застрявшие в processing
+# после перезапуска, переводятся в unknown: повторная отправка могла бы
+# отправить звезды дважды, поэтому такие заказы разбирает администратор.
+
+def _row_to_dict(cursor, row):
+    return {column[0]: value for column, value in zip(cursor.description, row)}
+
+
+def create_star_order(user_id, cost, stars, target_user, chat_id, message_id):
+    """Резервирует стоимость и ставит заказ в очередь одним коммитом.
+
+    Возвращает id заказа или None, если средств на балансе недостаточно.
+    """
+    conn = get_connection()
+    with conn:
+        cursor = conn.cursor()
+        hold_id = _reserve_balance(cursor, user_id, cost, stars, target_user)
+        if hold_id is None:
+            return None
+        cursor.execute(
+            '''
+            INSERT INTO star_orders (user_id, hold_id, target_username, stars, cost, chat_id, message_id)
+            VALUES (?, ?, ?, ?, ?, ?, ?)
+            ''',
+            (user_id, hold_id, target_user, stars, cost, chat_id, message_id)
+        )
+        order_id = cursor.lastrowid
+    _invalidate_user(user_id)
+    return order_id
+
+
+def claim_star_orders(limit):
+    """Переводит до limit заказов из очереди в обработку и возвращает их."""
+    conn = get_connection()
+    with conn:
+        cursor = conn.cursor()
+        cursor.execute(
+            "SELECT * FROM star_orders WHERE status = 'queued' ORDER BY id LIMIT ?",
+            (limit,)
+        )
+        orders = [_row_to_dict(cursor, row) for row in cursor.fetchall()]
+        cursor.executemany(
+            "UPDATE star_orders SET status = 'processing', attempts = attempts + 1, "
+            "updated_at = CURRENT_TIMESTAMP WHERE id = ?",
+            [(order['id'],) for order in orders]
+        )
+    return orders
+
+
+def finish_star_order(order_id, success, error=None, expected_status='processing'):
+    """Закрывает заказ и его резерв (подтверждение или возврат) одним коммитом.
+
+    expected_status - статус, из которого заказ можно закрыть: 'processing'
+    для очереди, 'unknown' для ручного разбора администратором.
+    """
+    conn = get_connection()
+    with conn:
+        cursor = conn.cursor()
+        cursor.execute(
+            "UPDATE star_orders SET status = ?, error = ?, updated_at = CURRENT_TIMESTAMP "
+            "WHERE id = ? AND status = ?",
+            ('completed' if success else 'failed', error, order_id, expected_status)
+        )
+        if cursor.rowcount != 1:
+            return False
+
+        cursor.execute('SELECT hold_id FROM star_orders WHERE id = ?', (order_id,))
+        hold_id = cursor.fetchone()[0]
+        user_id = None
+        if success:
+            _settle_hold(cursor, hold_id)
+        else:
+            user_id = _release_hold(cursor, hold_id)
+    if user_id is not None:
+        _invalidate_user(user_id)
+    return True
+
+
+def recover_star_orders():
+    """При старте помечает прерванные заказы как unknown и возвращает их список."""
+    conn = get_connection()
+    with conn:
+        cursor = conn.cursor()
+        cursor.execute("SELECT * FROM star_orders WHERE status = 'processing'")
+        orders = [_row_to_dict(cursor, row) for row in cursor.fetchall()]
+        cursor.execute(
+            "UPDATE star_orders SET status = 'unknown', updated_at = CURRENT_TIMESTAMP "
+            "WHERE status = 'processing'"
+        )
+    return orders
+
+
+def mark_star_order_unknown(order_id, error=None):
+    """Помечает заказ, обработка которого оборвалась ошибкой, как unknown. Резерв остается до разбора."""
+    conn = get_connection()
+    with conn:
+        cursor = conn.cursor()
+        cursor.execute(
+            "UPDATE star_orders SET status = 'unknown', error = ?, updated_at = CURRENT_TIMESTAMP "
+            "WHERE id = ? AND status = 'processing'",
+            (error, order_id)
+        )
+        return cursor.rowcount == 1
+
+
+def get_unknown_star_orders(limit=20):
+    """Заказы в статусе unknown (результат отправки неизвестен), старые первыми."""
+    conn = get_connection()
     cursor = conn.cursor()
     cursor.execute(
-        'INSERT INTO transactions (user_id, amount, type, status, target_user) VALUES (?, ?, ?, ?, ?)',
-        (user_id, amount, transaction_type, status, target_user)
+        "SELECT * FROM star_orders WHERE status = 'unknown' ORDER BY id LIMIT ?",
+        (limit,)
     )
-    conn.commit()
-    conn.close()
+    return [_row_to_dict(cursor, row) for row in cursor.fetchall()]
+
+
+def resolve_star_order(order_id, sent):
+    """Ручной разбор заказа unknown: sent=True списывает резерв, False - возвращает средства.
+
+    Возвращает заказ (dict) или None, если заказа в статусе unknown нет.
+    """
+    conn = get_connection()
+    cursor = conn.cursor()
+    cursor.execute("SELECT * FROM star_orders WHERE id = ? AND status = 'unknown'", (order_id,))
+    row = cursor.fetchone()
+    if row is None:
+        return None
+    order = _row_to_dict(cursor, row)
+    error = None if sent else 'возврат администратором'
+    if not finish_star_order(order_id, sent, error, expected_status='unknown'):
+        return None
+    return order
+
+
+def add_payment(user_id, amount, yookassa_id, status='pending', chat_id=None, message_id=None):
+    conn = get_connection()
+    with conn:
+        cursor = conn.cursor()
+        cursor.execute(
+            'INSERT INTO payments (user_id, amount, yookassa_id, status, chat_id, message_id) '
+            'VALUES (?, ?, ?, ?, ?, ?)',
+            (user_id, amount, yookassa_id, status, chat_id, message_id)
+        )
+
+
+def get_payment(yookassa_id):
+    conn = get_connection()
+    cursor = conn.cursor()
+    cursor.execute('SELECT * FROM payments WHERE yookassa_id = ?', (yookassa_id,))
+    row = cursor.fetchone()
+    return _row_to_dict(cursor, row) if row else None
+
+
+def complete_payment(yookassa_id):
+    """Зачисляет успешный платеж ровно один раз.
+
+    Статус pending -> succeeded, пополнение баланса и транзакция deposit
+    выполняются одним коммитом. Возвращает платеж (dict), если зачисление
+    произошло сейчас, или None, если платеж уже обработан или не найден.
+    """
+    conn = get_connection()
+    with conn:
+        cursor = conn.cursor()
+        cursor.execute(
+            "UPDATE payments SET status = 'succeeded' WHERE yookassa_id = ? AND status = 'pending'",
+            (yookassa_id,)
+        )
+        if cursor.rowcount != 1:
+            return None
+
+        cursor.execute('SELECT * FROM payments WHERE yookassa_id = ?', (yookassa_id,))
+        payment = _row_to_dict(cursor, cursor.fetchone())
+        cursor.execute(
+            'UPDATE users SET balance = ROUND(balance + ?, 2) WHERE user_id = ?',
+            (payment['amount'], payment['user_id'])
+        )
+        cursor.execute(
+            'INSERT INTO transactions (user_id, amount, type, status, target_user) VALUES (?, ?, ?, ?, ?)',
+            (payment['user_id'], payment['amount'], 'deposit', 'completed', None)
+        )
+    _invalidate_user(payment['user_id'])
+    return payment
 
 
-def add_payment(user_id, amount, yookassa_id, status='pending'):
-    conn = sqlite3.connect(DB_NAME)
+def get_pending_payments_batch(after_id=0, limit=200):
+    """Возвращает следующую пачку ожидающих платежей с id > after_id (по возрастанию id)."""
+    conn = get_connection()
     cursor = conn.cursor()
     cursor.execute(
-        'INSERT INTO payments (user_id, amount, yookassa_id, status) VALUES (?, ?, ?, ?)',
-        (user_id, amount, yookassa_id, status)
+        "SELECT * FROM payments WHERE status = 'pending' AND id > ? ORDER BY id LIMIT ?",
+        (after_id, limit)
     )
-    conn.commit()
-    conn.close()
+    return [_row_to_dict(cursor, row) for row in cursor.fetchall()]
+
+
+def mark_payments_checked(yookassa_ids):
+    conn = get_connection()
+    with conn:
+        conn.executemany(
+            'UPDATE payments SET checked_at = CURRENT_TIMESTAMP WHERE yookassa_id = ?',
+            [(yookassa_id,) for yookassa_id in yookassa_ids]
+        )
+
+
+def close_payment(yookassa_id, status):
+    """Переводит ожидающий платеж в конечный неуспешный статус. Возвращает True, если он был pending."""
+    conn = get_connection()
+    with conn:
+        cursor = conn.cursor()
+        cursor.execute(
+            "UPDATE payments SET status = ? WHERE yookassa_id = ? AND status = 'pending'",
+            (status, yookassa_id)
+        )
+        return cursor.rowcount == 1
 
 
 def get_pending_payment(user_id):
-    conn = sqlite3.connect(DB_NAME)
+    conn = get_connection()
     cursor = conn.cursor()
     cursor.execute(
         'SELECT yookassa_id, amount FROM payments '
@@ -160,54 +981,56 @@ def get_pending_payment(user_id):
         (user_id,)
     )
     payment = cursor.fetchone()
-    conn.close()
     return payment
 
 
 def update_payment_status(yookassa_id, status):
-    conn = sqlite3.connect(DB_NAME)
-    cursor = conn.cursor()
-    cursor.execute(
-        'UPDATE payments SET status = ? WHERE yookassa_id = ?',
-        (status, yookassa_id)
-    )
-    conn.commit()
-    conn.close()
+    conn = get_connection()
+    with conn:
+        cursor = conn.cursor()
+        cursor.execute(
+            'UPDATE payments SET status = ? WHERE yookassa_id = ?',
+            (status, yookassa_id)
+        )
 
 
 # --- НОВЫЕ ФУНКЦИИ ДЛЯ РАБОТЫ С СЕССИЯМИ/СОСТОЯНИЯМИ ---
+# Сессии живут в памяти. В таблицу sessions пишутся только состояния, которые
+# должны пережить перезапуск бота; остальные шаги диалога не трогают диск.
+PERSISTENT_SESSION_STATES = {'waiting_for_username', 'buying_stars'}
+SESSION_TTL = 30 * 60  # неактивные сессии вытесняются из памяти через 30 минут
 
-def set_session_data(user_id, data):
-    """Сохраняет или обновляет данные сессии пользователя."""
-    conn = sqlite3.connect(DB_NAME)
-    cursor = conn.cursor()
+# user_id -> {'data': dict, 'persisted': есть ли строка в таблице sessions}
+_sessions = TTLCache(maxsize=100000, ttl=SESSION_TTL)
 
-    state = data.get('state')
-    target_username = data.get('target_username')
-    message_id = data.get('message_id')
 
-    cursor.execute(
-        '''
-        INSERT OR REPLACE INTO sessions 
-        (user_id, state, target_username, message_id, updated_at) 
-        VALUES (?, ?, ?, ?, CURRENT_TIMESTAMP)
-        ''',
-        (user_id, state, target_username, message_id)
-    )
-    conn.commit()
-    conn.close()
+def _save_session_row(user_id, data):
+    conn = get_connection()
+    with conn:
+        cursor = conn.cursor()
 
+        state = data.get('state')
+        target_username = data.get('target_username')
+        message_id = data.get('message_id')
 
-def get_session_data(user_id):
-    """Получает данные сессии пользователя."""
-    conn = sqlite3.connect(DB_NAME)
+        cursor.execute(
+            '''
+            INSERT OR REPLACE INTO sessions 
+            (user_id, state, target_username, message_id, updated_at) 
+            VALUES (?, ?, ?, ?, CURRENT_TIMESTAMP)
+            ''',
+            (user_id, state, target_username, message_id)
+        )
+
+
+def _load_session_row(user_id):
+    conn = get_connection()
     cursor = conn.cursor()
     cursor.execute(
         'SELECT state, target_username, message_id FROM sessions WHERE user_id = ?',
         (user_id,)
     )
     row = cursor.fetchone()
-    conn.close()
 
     if row:
         return {
@@ -218,36 +1041,398 @@ def get_session_data(user_id):
     return {}
 
 
+def _delete_session_row(user_id):
+    conn = get_connection()
+    with conn:
+        cursor = conn.cursor()
+        cursor.execute('DELETE FROM sessions WHERE user_id = ?', (user_id,))
+
+
+def set_session_data(user_id, data):
+    """Сохраняет или обновляет данные сессии пользователя."""
+    data = {
+        'state': data.get('state'),
+        'target_username': data.get('target_username'),
+        'message_id': data.get('message_id')
+    }
+    previous = _sessions.get(user_id)
+    persist = data['state'] in PERSISTENT_SESSION_STATES
+
+    if persist:
+        _save_session_row(user_id, data)
+    elif previous is None or previous['persisted']:
+        # Старое долговременное состояние не должно воскреснуть после перезапуска
+        _delete_session_row(user_id)
+
+    _sessions.set(user_id, {'data': data, 'persisted': persist})
+
+
+def get_session_data(user_id):
+    """Получает данные сессии пользователя."""
+    entry = _sessions.get(user_id)
+    if entry is None:
+        data = _load_session_row(user_id)
+        entry = {'data': data, 'persisted': bool(data)}
+        _sessions.set(user_id, entry)
+    return dict(entry['data'])
+
+
 def delete_session_data(user_id):
     """Удаляет данные сессии пользователя."""
-    conn = sqlite3.connect(DB_NAME)
+    entry = _sessions.get(user_id)
+    if entry is None or entry['persisted']:
+        _delete_session_row(user_id)
+    # Пустая запись в кэше избавляет от повторных DELETE при каждом возврате в меню
+    _sessions.set(user_id, {'data': {}, 'persisted': False})
+
+
+def evict_idle_sessions():
+    """Вытесняет из памяти неактивные сессии. Возвращает количество вытесненных."""
+    return _sessions.evict_expired()
+
+
+# --- Счетчики статистики ---
+def get_stats_counters(day='', conn=None):
+    """Счетчики за все время (day='') или за день 'YYYY-MM-DD' (UTC): {счетчик: значение}."""
+    conn = conn or get_connection()
+    names = list(STATS_COUNTERS)
+    rows = conn.execute(
+        f"SELECT name, value FROM stats_counters WHERE day = ? AND name IN ({', '.join('?' * len(names))})",
+        (day, *names)
+    ).fetchall()
+    counters = dict.fromkeys(names, 0)
+    counters.update(rows)
+    return counters
+
+
+def rebuild_stats_counters():
+    """Пересчитывает счетчики по таблицам. Возвращает расхождения [(счетчик, день, было, стало)]."""
+    conn = get_connection()
     cursor = conn.cursor()
-    cursor.execute('DELETE FROM sessions WHERE user_id = ?', (user_id,))
-    conn.commit()
-    conn.close()
+    # Блокировка записи на время пересчета: иначе изменения между чтением и заменой потеряются
+    cursor.execute('BEGIN IMMEDIATE')
+    try:
+        drift = _rebuild_stats_counters(cursor)
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+    return drift
+
+
+def get_stats_rollups(grain, since, until=None, conn=None):
+    """Срезы за корзины [since, until) в порядке времени: [(корзина, {метрика: значение})].
+
+    grain - 'hour' или 'day'; since/until - строки в формате корзины (UTC).
+    Пустые корзины не возвращаются.
+    """
+    conn = conn or get_connection()
+    query = 'SELECT bucket, metric, value FROM stats_rollups WHERE grain = ? AND bucket >= ?'
+    params = [grain, since]
+    if until is not None:
+        query += ' AND bucket < ?'
+        params.append(until)
+    buckets = {}
+    for bucket, metric, value in conn.execute(query + ' ORDER BY bucket', params):
+        buckets.setdefault(bucket, dict.fromkeys(ROLLUP_METRICS, 0))[metric] = value
+    return list(buckets.items())
+
+
+def rebuild_stats_rollups():
+    """Пересчитывает срезы /report по таблицам. Возвращает расхождения [(срез, корзина, метрика, было, стало)]."""
+    conn = get_connection()
+    cursor = conn.cursor()
+    cursor.execute('BEGIN IMMEDIATE')
+    try:
+        drift = _rebuild_stats_rollups(cursor)
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+    return drift
+
+
+# --- Депозиты TON ---
+
+IN_CHUNK_SIZE = 500  # значений в одном IN (...): с запасом ниже лимита параметров SQLite
+
+
+def _fetch_in(cursor, query, values):
+    """Выполняет query с {placeholders} для IN-списка пачками и возвращает все строки."""
+    values = list(values)
+    rows = []
+    for start in range(0, len(values), IN_CHUNK_SIZE):
+        chunk = values[start:start + IN_CHUNK_SIZE]
+        cursor.execute(query.format(placeholders=', '.join('?' * len(chunk))), chunk)
+        rows.extend(cursor.fetchall())
+    return rows
+
+
+# Адрес, с которого пополняли разные пользователи, навсегда перестает сопоставляться.
+# Депозиты с комментарием только копят историю адреса; сопоставлять по нему начинаем
+# после того, как админ вручную зачислил депозит с этого адреса (confirmed = 1):
+# иначе депозит без комментария с биржи ушел бы тому, кто первым пополнил с нее.
+_LEARN_SENDER_SQL = '''
+    INSERT INTO ton_senders (sender, user_id, deposits, confirmed) VALUES (?, ?, 1, ?)
+    ON CONFLICT (sender) DO UPDATE SET
+        user_id = CASE WHEN user_id = excluded.user_id THEN user_id END,
+        deposits = deposits + 1,
+        confirmed = MAX(confirmed, excluded.confirmed),
+        updated_at = CURRENT_TIMESTAMP
+'''
+
+
+def _ton_deposit_rows(deposits, user_id=None):
+    """Строки для вставки в ton_deposits и transactions."""
+    deposit_rows, transaction_rows = [], []
+    for deposit in deposits:
+        uid = user_id or deposit['user_id']
+        deposit_rows.append((deposit['hash'], deposit['lt'], uid, deposit.get('sender'),
+                             deposit['ton_amount'], deposit['rub_amount']))
+        # target_user используем для хранения информации о TON транзакции
+        transaction_rows.append((uid, deposit['rub_amount'], 'deposit_ton', 'completed',
+                                 f"{deposit['ton_amount']:.4f} TON"))
+    return deposit_rows, transaction_rows
+
+
+def _write_ton_credits(cursor, deposits, user_id=None):
+    """Пишет зачисления пакетно: ton_deposits, балансы, транзакции и адреса отправителей.
+
+    user_id задается при ручном зачислении админом - тогда адреса отправителей
+    подтверждаются для сопоставления. Работает внутри транзакции вызывающего
+    кода. Возвращает {user_id: новый баланс}.
+    """
+    totals = {}
+    for deposit in deposits:
+        uid = user_id or deposit['user_id']
+        totals[uid] = totals.get(uid, 0) + deposit['rub_amount']
+
+    deposit_rows, transaction_rows = _ton_deposit_rows(deposits, user_id)
+    cursor.executemany(
+        'INSERT INTO ton_deposits (tx_hash, lt, user_id, sender, ton_amount, rub_amount) VALUES (?, ?, ?, ?, ?, ?)',
+        deposit_rows
+    )
+    cursor.executemany(
+        'UPDATE users SET balance = ROUND(balance + ?, 2) WHERE user_id = ?',
+        [(round(amount, 2), uid) for uid, amount in totals.items()]
+    )
+    cursor.executemany(
+        'INSERT INTO transactions (user_id, amount, type, status, target_user) VALUES (?, ?, ?, ?, ?)',
+        transaction_rows
+    )
+    cursor.executemany(
+        _LEARN_SENDER_SQL,
+        [(deposit['sender'], user_id or deposit['user_id'], int(user_id is not None)) for deposit in deposits
+         if deposit.get('sender') and deposit['sender'] not in TON_SHARED_SENDERS]
+    )
+    return dict(_fetch_in(cursor, 'SELECT user_id, balance FROM users WHERE user_id IN ({placeholders})', totals))
+
+
+def credit_ton_deposits(deposits, last_lt):
+    """Зачисляет все депозиты TON одного опроса и сохраняет last_lt одним коммитом.
+
+    deposits - список dict с hash, lt, sender, comment, user_id (None, если в
+    комментарии нет id), rub_amount и ton_amount по возрастанию lt. Депозит
+    без известного пользователя зачисляется по адресу отправителя, если
+    админ уже зачислял депозит с этого адреса вручную, с него пополнял только
+    один пользователь (ton_senders) и адрес не общий (TON_SHARED_SENDERS).
+    Иначе депозит сохраняется в unmatched_deposits для разбора админом.
+
+    Все записи пишутся пакетно (executemany) в одной транзакции, поэтому
+    транзакция сети с уже известным хэшем повторно не обрабатывается - даже
+    если last_lt откатился или пачку прочитали дважды. Возвращает
+    (зачисленные, неопознанные, повторы). Зачисленным добавляются matched_by
+    ('comment' или 'sender'), username и balance пользователя сразу после
+    этого депозита - для уведомлений без повторного чтения БД.
+    """
+    conn = get_connection()
+    cursor = conn.cursor()
+    # Блокировка записи сразу: между проверкой хэшей и вставкой никто не зачислит те же депозиты
+    cursor.execute('BEGIN IMMEDIATE')
+    try:
+        hashes = [deposit['hash'] for deposit in deposits]
+        seen = {row[0] for row in _fetch_in(
+            cursor, 'SELECT tx_hash FROM ton_deposits WHERE tx_hash IN ({placeholders})', hashes
+        )}
+        seen.update(row[0] for row in _fetch_in(
+            cursor, 'SELECT tx_hash FROM unmatched_deposits WHERE tx_hash IN ({placeholders})', hashes
+        ))
+        senders = dict(_fetch_in(
+            cursor,
+            'SELECT sender, user_id FROM ton_senders '
+            'WHERE confirmed = 1 AND user_id IS NOT NULL AND sender IN ({placeholders})',
+            {deposit['sender'] for deposit in deposits
+             if deposit.get('sender') and deposit['sender'] not in TON_SHARED_SENDERS}
+        ))
+        usernames = dict(_fetch_in(
+            cursor, 'SELECT user_id, username FROM users WHERE user_id IN ({placeholders})',
+            {deposit['user_id'] for deposit in deposits if deposit['user_id'] is not None}
+            | {user_id for user_id in senders.values() if user_id is not None}
+        ))
+
+        credited, unmatched, duplicates = [], [], []
+        for deposit in deposits:
+            if deposit['hash'] in seen:
+                duplicates.append(deposit)
+                continue
+            seen.add(deposit['hash'])
+            sender = deposit.get('sender')
+            if deposit['user_id'] in usernames:
+                deposit['matched_by'] = 'comment'
+            elif senders.get(sender) in usernames:
+                deposit['user_id'] = senders[sender]
+                deposit['matched_by'] = 'sender'
+            else:
+                unmatched.append(deposit)
+                continue
+            credited.append(deposit)
+            # Депозит другого пользователя с подтвержденного адреса делает его общим
+            # уже в этой пачке - так же, как это сделает _LEARN_SENDER_SQL
+            if sender in senders and senders[sender] != deposit['user_id']:
+                senders[sender] = None
+
+        balances = _write_ton_credits(cursor, credited)
+        cursor.executemany(
+            'INSERT INTO unmatched_deposits (tx_hash, lt, sender, comment, ton_amount, rub_amount, tx_time) '
+            'VALUES (?, ?, ?, ?, ?, ?, ?)',
+            [(deposit['hash'], deposit['lt'], deposit.get('sender'), deposit.get('comment'),
+              deposit['ton_amount'], deposit['rub_amount'], deposit.get('tx_time')) for deposit in unmatched]
+        )
+        # last_lt - только курсор чтения: не дает скачивать старые транзакции заново
+        cursor.execute('INSERT OR REPLACE INTO settings (key, value) VALUES (?, ?)', ('last_lt', str(last_lt)))
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+
+    # Баланс после каждого депозита: от итогового назад по пачке
+    running = dict(balances)
+    for deposit in reversed(credited):
+        deposit['username'] = usernames[deposit['user_id']]
+        deposit['balance'] = running[deposit['user_id']]
+        running[deposit['user_id']] = round(running[deposit['user_id']] - deposit['rub_amount'], 2)
+    for user_id in balances:
+        _invalidate_user(user_id)
+    return credited, unmatched, duplicates
+
+
+# --- Неопознанные депозиты TON ---
+
+UNMATCHED_COLUMNS = 'id, tx_hash, lt, sender, comment, ton_amount, rub_amount, tx_time, created_at'
+
+
+def get_unmatched_deposits(limit=20):
+    """Открытые неопознанные депозиты, новые первыми: (строки, всего, сумма TON)."""
+    conn = get_connection()
+    cursor = conn.cursor()
+    cursor.execute(
+        f"SELECT {UNMATCHED_COLUMNS} FROM unmatched_deposits WHERE status = 'open' ORDER BY id DESC LIMIT ?",
+        (limit,)
+    )
+    rows = [_row_to_dict(cursor, row) for row in cursor.fetchall()]
+    cursor.execute("SELECT COUNT(*), COALESCE(SUM(ton_amount), 0) FROM unmatched_deposits WHERE status = 'open'")
+    total, total_ton = cursor.fetchone()
+    return rows, total, total_ton
+
+
+def search_unmatched_deposits(query, limit=20):
+    """Ищет открытые неопознанные депозиты по сумме TON (±1%), адресу отправителя или комментарию.
+
+    Точное совпадение адреса или комментария ищется по индексам; если его нет,
+    адрес ищется по подстроке (админ часто видит его сокращенным).
+    """
+    conn = get_connection()
+    cursor = conn.cursor()
+    base = f"SELECT {UNMATCHED_COLUMNS} FROM unmatched_deposits WHERE status = 'open' AND "
+    try:
+        amount = float(query.replace(',', '.'))
+    except ValueError:
+        amount = None
+
+    if amount is not None:
+        cursor.execute(base + 'ton_amount BETWEEN ? AND ? ORDER BY id DESC LIMIT ?',
+                       (amount * 0.99, amount * 1.01, limit))
+        rows = cursor.fetchall()
+    else:
+        # Подзапросы по индексам sender и comment: с OR планировщик перебирает все открытые строки
+        cursor.execute(
+            base + 'id IN (SELECT id FROM unmatched_deposits WHERE sender = ? '
+                   'UNION ALL SELECT id FROM unmatched_deposits WHERE comment = ?) ORDER BY id DESC LIMIT ?',
+            (query, query, limit)
+        )
+        rows = cursor.fetchall()
+        if not rows:
+            cursor.execute(base + 'instr(sender, ?) > 0 ORDER BY id DESC LIMIT ?', (query, limit))
+            rows = cursor.fetchall()
+    return [_row_to_dict(cursor, row) for row in rows]
+
+
+def assign_unmatched_deposits(deposit_ids, user_id):
+    """Зачисляет открытые неопознанные депозиты пользователю одним коммитом.
+
+    Сумма в рублях - по курсу на момент поступления. Адреса отправителей
+    подтверждаются за пользователем, и следующие депозиты с них зачисляются
+    автоматически, пока с адреса не пополнит кто-то другой; общие адреса
+    (TON_SHARED_SENDERS) не запоминаются. Возвращает (зачисленные строки,
+    новый баланс, адреса, которые теперь сопоставляются с пользователем) или
+    None, если пользователь не найден; уже разобранные id пропускаются.
+    """
+    conn = get_connection()
+    cursor = conn.cursor()
+    cursor.execute('BEGIN IMMEDIATE')
+    try:
+        cursor.execute('SELECT balance FROM users WHERE user_id = ?', (user_id,))
+        user_row = cursor.fetchone()
+        if user_row is None:
+            conn.rollback()
+            return None
+
+        rows = [_row_to_dict(cursor, row) for row in _fetch_in(
+            cursor,
+            f"SELECT {UNMATCHED_COLUMNS} FROM unmatched_deposits WHERE status = 'open' AND id IN ({{placeholders}})",
+            set(deposit_ids)
+        )]
+        rows.sort(key=lambda row: row['lt'])
+        cursor.executemany(
+            "UPDATE unmatched_deposits SET status = 'assigned', assigned_user_id = ?, "
+            "updated_at = CURRENT_TIMESTAMP WHERE id = ?",
+            [(user_id, row['id']) for row in rows]
+        )
+        deposits = [dict(row, hash=row['tx_hash']) for row in rows]
+        balances = _write_ton_credits(cursor, deposits, user_id)
+        learned = sorted(sender for sender, sender_user_id in _fetch_in(
+            cursor, 'SELECT sender, user_id FROM ton_senders WHERE confirmed = 1 AND sender IN ({placeholders})',
+            {row['sender'] for row in rows if row['sender']}
+        ) if sender_user_id == user_id)
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+
+    _invalidate_user(user_id)
+    return rows, balances.get(user_id, user_row[0]), learned
+
 
 def get_setting(key, default=None):
     """Получает значение настройки по ключу."""
-    conn = sqlite3.connect(DB_NAME)
+    conn = get_connection()
     cursor = conn.cursor()
     cursor.execute('SELECT value FROM settings WHERE key = ?', (key,))
     row = cursor.fetchone()
-    conn.close()
     return row[0] if row else default
 
 
 def set_setting(key, value):
     """Сохраняет или обновляет значение настройки."""
-    conn = sqlite3.connect(DB_NAME)
-    cursor = conn.cursor()
-    cursor.execute(
-        '''
-        INSERT OR REPLACE INTO settings (key, value) VALUES (?, ?)
-        ''',
-        (key, str(value))
-    )
-    conn.commit()
-    conn.close()
+    conn = get_connection()
+    with conn:
+        cursor = conn.cursor()
+        cursor.execute(
+            '''
+            INSERT OR REPLACE INTO settings (key, value) VALUES (?, ?)
+            ''',
+            (key, str(value))
+        )
 
 
 def get_ton_rate():
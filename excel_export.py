@@ -1,13 +1,205 @@
 # excel_export.py
+import csv
+import gzip
+import io
+import shutil
 import sqlite3
-import pandas as pd
+import zipfile
 from datetime import datetime
 import os
-from config import DB_NAME, logger
+from openpyxl import Workbook
+from config import DB_NAME, EXPORT_ARCHIVE_DIR, logger
+from stats import collect_statistics, statistics_sheet
+
+CHUNK_SIZE = 5000  # строк, читаемых из БД за раз
+
+# (таблица, лист Excel / имя CSV-файла)
+# Все таблицы должны иметь колонку updated_at (для /export delta)
+EXPORT_TABLES = [
+    ('users', 'Пользователи'),
+    ('transactions', 'Транзакции'),
+    ('payments', 'Платежи'),
+    ('star_orders', 'Заказы звезд'),
+    ('balance_holds', 'Резервы баланса'),
+    ('ton_deposits', 'Депозиты TON'),
+    ('unmatched_deposits', 'Неопознанные TON'),
+    ('ton_senders', 'Адреса TON'),
+    ('sessions', 'Сессии'),
+    ('settings', 'Настройки'),
+]
+
+EXPORT_FORMATS = ('xlsx', 'csv')
+
+# Инкрементальный экспорт выгружает строки с updated_at в окне [отметка прошлой выгрузки,
+# текущее время - EXPORT_WINDOW_LAG). updated_at ставится в момент записи, а видна строка
+# станет только после коммита: транзакция, начатая до снимка экспорта, может закоммититься
+# позже со временем внутри окна. Отставание окна больше длительности любой транзакции
+# записи бота, поэтому такие строки уходят в следующую выгрузку, а не теряются.
+WATERMARK_SETTING = 'export_watermark'
+EXPORT_WINDOW_LAG = 60  # секунд
+
+
+class ExportCancelled(Exception):
+    """Экспорт остановлен по запросу (/export_cancel)."""
+
+
+def iter_table_chunks(conn, table, chunk_size=CHUNK_SIZE, window=None):
+    """Читает таблицу курсором: возвращает имена колонок и генератор пачек строк.
+
+    При заданном window=(since, until) читаются только строки с since <= updated_at < until.
+    """
+    if window is None:
+        cursor = conn.execute(f"SELECT * FROM {table}")
+    else:
+        cursor = conn.execute(
+            f"SELECT * FROM {table} WHERE updated_at >= ? AND updated_at < ? ORDER BY updated_at", window
+        )
+    columns = [column[0] for column in cursor.description]
+
+    def chunks():
+        while True:
+            rows = cursor.fetchmany(chunk_size)
+            if not rows:
+                break
+            yield rows
+
+    return columns, chunks()
+
+
+def export_window(conn):
+    """Окно (since, until) для инкрементальной выгрузки в текущем снимке БД."""
+    row = conn.execute("SELECT value FROM settings WHERE key = ?", (WATERMARK_SETTING,)).fetchone()
+    since = row[0] if row and row[0] else ''
+    until = conn.execute("SELECT datetime('now', ?)", (f'-{EXPORT_WINDOW_LAG} seconds',)).fetchone()[0]
+    return since, max(since, until)
+
+
+def save_watermark(watermark, db_path=DB_NAME):
+    """Сдвигает отметку инкрементального экспорта - только после того, как файл доставлен."""
+    conn = sqlite3.connect(db_path, timeout=30)
+    try:
+        with conn:
+            conn.execute(
+                "INSERT OR REPLACE INTO settings (key, value) VALUES (?, ?)", (WATERMARK_SETTING, watermark)
+            )
+    finally:
+        conn.close()
 
 
-def export_database_to_excel():
-    """Экспортирует все данные из БД в Excel файл и возвращает имя файла."""
+def _iter_export_tables(conn, progress=None, cancelled=None, window=None):
+    """Перебирает выгружаемые таблицы, сообщая progress(готово, всего, лист).
+
+    window - окно updated_at для инкрементального экспорта (None - все строки).
+    Между пачками строк проверяется cancelled(); если он вернул True,
+    бросается ExportCancelled.
+    """
+    total = len(EXPORT_TABLES) + 1  # + лист статистики
+
+    def checked(chunks):
+        for rows in chunks:
+            if cancelled and cancelled():
+                raise ExportCancelled()
+            yield rows
+
+    for index, (table, title) in enumerate(EXPORT_TABLES):
+        if progress:
+            progress(index, total, title)
+        columns, chunks = iter_table_chunks(conn, table, window=window)
+        yield table, title, columns, checked(chunks)
+
+    if cancelled and cancelled():
+        raise ExportCancelled()
+    if progress:
+        progress(total - 1, total, 'Статистика')
+
+
+def _write_xlsx(filename, conn, progress=None, cancelled=None, window=None):
+    # write_only-книга сбрасывает строки на диск по мере записи: память не растет с размером таблиц
+    workbook = Workbook(write_only=True)
+    for table, title, columns, chunks in _iter_export_tables(conn, progress, cancelled, window):
+        # Лист с заголовком создается и для пустой таблицы
+        sheet = workbook.create_sheet(title)
+        sheet.append(columns)
+        for rows in chunks:
+            for row in rows:
+                sheet.append(row)
+
+    # Сводная статистика
+    stats_data = generate_statistics(conn)
+    sheet = workbook.create_sheet('Статистика')
+    sheet.append(list(stats_data.keys()))
+    sheet.append(list(stats_data.values()))
+    workbook.save(filename)
+
+
+def _write_csv_archive(filename, conn, progress=None, cancelled=None, window=None):
+    # Каждая таблица - отдельный CSV внутри сжатого ZIP, запись идет потоком
+    with zipfile.ZipFile(filename, 'w', compression=zipfile.ZIP_DEFLATED) as archive:
+        for table, title, columns, chunks in _iter_export_tables(conn, progress, cancelled, window):
+            with archive.open(f"{table}.csv", 'w', force_zip64=True) as raw:
+                with io.TextIOWrapper(raw, encoding='utf-8-sig', newline='') as text:
+                    writer = csv.writer(text)
+                    writer.writerow(columns)
+                    for rows in chunks:
+                        writer.writerows(rows)
+
+        stats_data = generate_statistics(conn)
+        with archive.open('statistics.csv', 'w') as raw:
+            with io.TextIOWrapper(raw, encoding='utf-8-sig', newline='') as text:
+                writer = csv.writer(text)
+                writer.writerow(stats_data.keys())
+                writer.writerow(stats_data.values())
+
+
+def append_to_cumulative_archive(conn, window, archive_dir=EXPORT_ARCHIVE_DIR):
+    """Дописывает изменения в накопительный архив: по файлу <таблица>.csv.gz на таблицу.
+
+    Каждая выгрузка добавляется отдельным gzip-блоком, и файл читается как один
+    CSV (gzip/pandas склеивают блоки). Измененная строка встречается в архиве
+    несколько раз - актуальна последняя версия с тем же первичным ключом.
+    Блок сначала пишется во временный файл, чтобы прерванная выгрузка не
+    испортила архив.
+    """
+    os.makedirs(archive_dir, exist_ok=True)
+    for table, _ in EXPORT_TABLES:
+        columns, chunks = iter_table_chunks(conn, table, window=window)
+        path = os.path.join(archive_dir, f"{table}.csv.gz")
+        part_path = path + '.part'
+        rows_written = 0
+        with gzip.open(part_path, 'wt', encoding='utf-8', newline='') as part:
+            writer = csv.writer(part)
+            if not os.path.exists(path):
+                writer.writerow(columns)
+            for rows in chunks:
+                writer.writerows(rows)
+                rows_written += len(rows)
+
+        if rows_written or not os.path.exists(path):
+            with open(part_path, 'rb') as part, open(path, 'ab') as archive:
+                shutil.copyfileobj(part, archive)
+        os.remove(part_path)
+
+
+def export_database_to_excel(fmt='xlsx', db_path=DB_NAME, progress=None, cancelled=None, incremental=False):
+    """Экспортирует все данные из БД и возвращает (имя файла, новая отметка).
+
+    fmt='xlsx' - книга Excel (лист на таблицу), fmt='csv' - ZIP-архив с CSV.
+    Таблицы читаются пачками по CHUNK_SIZE строк и пишутся потоком, поэтому
+    расход памяти не зависит от числа строк. progress(готово, всего, лист)
+    вызывается перед каждым листом; если cancelled() вернул True, недописанный
+    файл удаляется и бросается ExportCancelled.
+
+    incremental=True выгружает только строки, добавленные или измененные с
+    прошлой инкрементальной выгрузки. Отметка при этом не сдвигается: ее
+    сохраняет save_watermark после доставки файла, иначе при неудачной отправке
+    изменения пропали бы из следующей выгрузки. Для полного экспорта отметка
+    None, при ошибке возвращается (None, None). Если задан EXPORT_ARCHIVE_DIR,
+    изменения дописываются и в накопительный архив.
+    """
+    if fmt not in EXPORT_FORMATS:
+        raise ValueError(f"Неизвестный формат экспорта: {fmt}")
+
+    filename = None
     try:
         # Создаем временную папку для экспорта (если нет)
         temp_dir = "temp_exports"
@@ -16,133 +208,59 @@ def export_database_to_excel():
 
         # Создаем имя файла с timestamp
         timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
-        filename = os.path.join(temp_dir, f"bot_database_export_{timestamp}.xlsx")
-
-        # Подключаемся к БД
-        conn = sqlite3.connect(DB_NAME)
-
-        # Создаем Excel writer
-        with pd.ExcelWriter(filename, engine='openpyxl') as writer:
-
-            # 1. Таблица пользователей
-            users_df = pd.read_sql_query("SELECT * FROM users", conn)
-            if not users_df.empty:
-                users_df.to_excel(writer, sheet_name='Пользователи', index=False)
+        extension = 'xlsx' if fmt == 'xlsx' else 'zip'
+        kind = 'delta_' if incremental else ''
+        filename = os.path.join(temp_dir, f"bot_database_export_{kind}{timestamp}.{extension}")
 
-            # 2. Таблица транзакций
-            transactions_df = pd.read_sql_query("SELECT * FROM transactions", conn)
-            if not transactions_df.empty:
-                transactions_df.to_excel(writer, sheet_name='Транзакции', index=False)
-
-            # 3. Таблица платежей
-            payments_df = pd.read_sql_query("SELECT * FROM payments", conn)
-            if not payments_df.empty:
-                payments_df.to_excel(writer, sheet_name='Платежи', index=False)
-
-            # 4. Таблица сессий
-            sessions_df = pd.read_sql_query("SELECT * FROM sessions", conn)
-            if not sessions_df.empty:
-                sessions_df.to_excel(writer, sheet_name='Сессии', index=False)
-
-            # 5. Таблица настроек
-            settings_df = pd.read_sql_query("SELECT * FROM settings", conn)
-            if not settings_df.empty:
-                settings_df.to_excel(writer, sheet_name='Настройки', index=False)
+        # Отдельное соединение только для чтения: в режиме WAL оно не мешает записи,
+        # а одна транзакция дает согласованный снимок всех таблиц
+        conn = sqlite3.connect(f"file:{db_path}?mode=ro", uri=True, isolation_level=None)
+        try:
+            conn.execute("BEGIN")
+            window = export_window(conn) if incremental else None
 
-            # 6. Сводная статистика
-            stats_data = generate_statistics(conn)
-            stats_df = pd.DataFrame([stats_data])
-            stats_df.to_excel(writer, sheet_name='Статистика', index=False)
+            if fmt == 'xlsx':
+                _write_xlsx(filename, conn, progress, cancelled, window)
+            else:
+                _write_csv_archive(filename, conn, progress, cancelled, window)
 
-        conn.close()
+            if incremental and EXPORT_ARCHIVE_DIR:
+                append_to_cumulative_archive(conn, window)
+        finally:
+            conn.close()
 
         logger.info(f"✅ База данных успешно экспортирована в {filename}")
-        return filename
+        return filename, window[1] if incremental else None
+
+    except ExportCancelled:
+        logger.info("⏹ Экспорт базы данных отменен")
+        _remove_partial_export(filename)
+        raise
 
     except Exception as e:
         logger.error(f"❌ Ошибка при экспорте базы данных: {e}")
 
         # Пытаемся удалить файл в случае ошибки
-        try:
-            if 'filename' in locals() and os.path.exists(filename):
-                os.remove(filename)
-        except:
-            pass
+        _remove_partial_export(filename)
+
+        return None, None
 
-        return None
+
+def _remove_partial_export(filename):
+    try:
+        if filename and os.path.exists(filename):
+            os.remove(filename)
+    except:
+        pass
 
 
 def generate_statistics(conn):
     """Генерирует сводную статистику по базе данных."""
-    stats = {}
-
     try:
-        # Общая статистика пользователей
-        users_stats = pd.read_sql_query("""
-            SELECT 
-                COUNT(*) as total_users,
-                COUNT(DISTINCT referrer_id) as users_with_referrals,
-                SUM(balance) as total_balance,
-                AVG(balance) as avg_balance
-            FROM users
-        """, conn)
-
-        if not users_stats.empty:
-            stats['Всего пользователей'] = users_stats.iloc[0]['total_users']
-            stats['Пользователей с рефералами'] = users_stats.iloc[0]['users_with_referrals']
-            stats['Общий баланс'] = round(users_stats.iloc[0]['total_balance'] or 0, 2)
-            stats['Средний баланс'] = round(users_stats.iloc[0]['avg_balance'] or 0, 2)
-
-        # Статистика транзакций
-        transactions_stats = pd.read_sql_query("""
-            SELECT 
-                type,
-                COUNT(*) as count,
-                SUM(amount) as total_amount
-            FROM transactions 
-            WHERE status = 'completed'
-            GROUP BY type
-        """, conn)
-
-        for _, row in transactions_stats.iterrows():
-            stats[f'Транзакций {row["type"]}'] = row['count']
-            stats[f'Сумма {row["type"]}'] = round(row['total_amount'] or 0, 2)
-
-        # Статистика платежей
-        payments_stats = pd.read_sql_query("""
-            SELECT 
-                status,
-                COUNT(*) as count,
-                SUM(amount) as total_amount
-            FROM payments 
-            GROUP BY status
-        """, conn)
-
-        for _, row in payments_stats.iterrows():
-            stats[f'Платежей {row["status"]}'] = row['count']
-            stats[f'Сумма платежей {row["status"]}'] = round(row['total_amount'] or 0, 2)
-
-        # Топ пользователей по балансу
-        top_users = pd.read_sql_query("""
-            SELECT username, balance 
-            FROM users 
-            WHERE balance > 0 
-            ORDER BY balance DESC 
-            LIMIT 5
-        """, conn)
-
-        for i, (_, row) in enumerate(top_users.iterrows(), 1):
-            stats[f'Топ {i} ({row["username"]})'] = round(row['balance'], 2)
-
-        # Дата последнего обновления
-        stats['Дата экспорта'] = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-
+        return statistics_sheet(collect_statistics(conn))
     except Exception as e:
         logger.error(f"Ошибка генерации статистики: {e}")
-        stats['Ошибка статистики'] = str(e)
-
-    return stats
-
+        return {'Ошибка статистики': str(e)}
 
 
 def cleanup_old_exports(max_files=5):
@@ -153,7 +271,8 @@ def cleanup_old_exports(max_files=5):
             return
 
         # Ищем файлы экспорта
-        export_files = [f for f in os.listdir(temp_dir) if f.startswith('bot_database_export_') and f.endswith('.xlsx')]
+        export_files = [f for f in os.listdir(temp_dir)
+                        if f.startswith('bot_database_export_') and f.endswith(('.xlsx', '.zip'))]
 
         if len(export_files) > max_files:
             # Сортируем по времени создания (старые первыми)
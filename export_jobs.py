@@ -0,0 +1,142 @@
+import itertools
+import multiprocessing
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+
+from config import logger
+from excel_export import export_database_to_excel, ExportCancelled
+
+# Заполняются в процессе экспорта инициализатором пула
+_progress_queue = None
+_cancel_event = None
+
+
+def _init_worker(progress_queue, cancel_event):
+    global _progress_queue, _cancel_event
+    _progress_queue = progress_queue
+    _cancel_event = cancel_event
+
+
+def _run_export(job_id, fmt, incremental):
+    def progress(done, total, title):
+        _progress_queue.put((job_id, done, total, title))
+
+    return export_database_to_excel(fmt, progress=progress, cancelled=_cancel_event.is_set,
+                                    incremental=incremental)
+
+
+class ExportJobRunner:
+    """Выполняет /export в отдельном процессе, по одному экспорту за раз.
+
+    Работа pandas/openpyxl идет в пуле из одного процесса и не занимает потоки
+    бота. Процесс сообщает о каждом листе через очередь, а поток-слушатель
+    передает это в on_progress(job, done, total, title). По завершении в
+    отдельном потоке вызывается on_finished(job, filename, status), где status -
+    'done', 'cancelled' или 'failed'; следующий экспорт можно запустить после
+    возврата из on_finished. Новая отметка инкрементального экспорта передается
+    в job['watermark'] - on_finished сохраняет ее после доставки файла.
+    """
+
+    def __init__(self, on_progress, on_finished):
+        self.on_progress = on_progress
+        self.on_finished = on_finished
+        # spawn: процесс не наследует потоки и блокировки бота
+        self._ctx = multiprocessing.get_context('spawn')
+        self._progress_queue = self._ctx.Queue()
+        self._cancel_event = self._ctx.Event()
+        self._executor = None
+        self._listener = None
+        self._lock = threading.Lock()
+        self._job = None
+        self._ids = itertools.count(1)
+
+    def _get_executor(self):
+        if self._executor is None:
+            self._executor = ProcessPoolExecutor(
+                max_workers=1, mp_context=self._ctx,
+                initializer=_init_worker, initargs=(self._progress_queue, self._cancel_event)
+            )
+        if self._listener is None:
+            self._listener = threading.Thread(target=self._listen_progress, daemon=True, name='export-progress')
+            self._listener.start()
+        return self._executor
+
+    def active_job(self):
+        return self._job
+
+    def start(self, fmt, context=None, incremental=False):
+        """Запускает экспорт. Возвращает задание (dict) или None, если экспорт уже идет."""
+        with self._lock:
+            if self._job is not None:
+                return None
+            self._cancel_event.clear()
+            job = {
+                'id': next(self._ids),
+                'fmt': fmt,
+                'incremental': incremental,
+                'context': context or {},
+                'watermark': None,
+                'started_at': time.monotonic(),
+                'cancel_requested': False
+            }
+            try:
+                future = self._get_executor().submit(_run_export, job['id'], fmt, incremental)
+            except BrokenProcessPool:
+                # Процесс экспорта упал ранее - создаем пул заново
+                self._executor = None
+                future = self._get_executor().submit(_run_export, job['id'], fmt, incremental)
+            self._job = job
+
+        logger.info(f"📤 Экспорт #{job['id']} ({fmt}{', изменения' if incremental else ''}) запущен")
+        future.add_done_callback(
+            lambda done: threading.Thread(target=self._finish, args=(job, done), daemon=True).start()
+        )
+        return job
+
+    def cancel(self):
+        """Просит текущий экспорт остановиться. Возвращает False, если экспорта нет."""
+        with self._lock:
+            if self._job is None:
+                return False
+            self._job['cancel_requested'] = True
+            self._cancel_event.set()
+            return True
+
+    def _listen_progress(self):
+        while True:
+            job_id, done, total, title = self._progress_queue.get()
+            job = self._job
+            if job is None or job['id'] != job_id or job['cancel_requested']:
+                continue
+            try:
+                self.on_progress(job, done, total, title)
+            except Exception as e:
+                logger.warning(f"Не удалось обновить прогресс экспорта #{job_id}: {e}")
+
+    def _finish(self, job, future):
+        filename = None
+        try:
+            filename, job['watermark'] = future.result()
+            status = 'done' if filename else 'failed'
+        except ExportCancelled:
+            status = 'cancelled'
+        except BrokenProcessPool as e:
+            logger.error(f"Процесс экспорта #{job['id']} аварийно завершился: {e}")
+            with self._lock:
+                self._executor = None
+            status = 'failed'
+        except Exception as e:
+            logger.error(f"Ошибка экспорта #{job['id']}: {e}")
+            status = 'failed'
+
+        elapsed = time.monotonic() - job['started_at']
+        logger.info(f"📤 Экспорт #{job['id']} завершен ({status}) за {elapsed:.1f} с")
+        try:
+            self.on_finished(job, filename, status)
+        except Exception as e:
+            logger.error(f"Ошибка обработки результата экспорта #{job['id']}: {e}")
+        finally:
+            with self._lock:
+                self._job = None
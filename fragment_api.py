@@ -1,10 +1,14 @@
+import asyncio
+import base64
 import json
 import os
-import telebot
-import config
+import threading
+import time
+
 import requests
+from urllib3.exceptions import NewConnectionError
 
-from bot import bot
+from http_client import get_session
 from config import (
     FRAGMENT_API_URL, FRAGMENT_API_KEY, FRAGMENT_PHONE,
     FRAGMENT_MNEMONICS, TOKEN_FILE, logger
@@ -43,7 +47,7 @@ def authenticate_fragment():
             "mnemonics": mnemonics_list,
             "version": "V4R2"
         }
-        res = requests.post(f"{FRAGMENT_API_URL}/auth/authenticate/", json=payload)
+        res = get_session('fragment').post(f"{FRAGMENT_API_URL}/auth/authenticate/", json=payload)
         if res.status_code == 200:
             token = res.json().get("token")
             save_fragment_token(token)
@@ -56,32 +60,212 @@ def authenticate_fragment():
         return None
 
 
-def send_stars(token, username, quantity):
+# --- Менеджер JWT-токена Fragment ---
+TOKEN_ERROR = "Не удалось получить токен Fragment API"
+TOKEN_REFRESH_MARGIN = 300  # обновлять токен за 5 минут до истечения
+TOKEN_MIN_REFRESH_DELAY = 60  # плановое обновление не чаще раза в минуту
+TOKEN_REFRESH_RETRY_DELAY = 30  # повтор неудавшегося обновления, пока старый токен еще действует
+
+
+def decode_token_expiry(token):
+    """Возвращает время истечения JWT (unix time) из поля exp или None."""
     try:
+        payload = token.split('.')[1]
+        payload += '=' * (-len(payload) % 4)
+        exp = json.loads(base64.urlsafe_b64decode(payload)).get('exp')
+        return float(exp) if exp else None
+    except Exception:
+        return None
+
+
+class FragmentTokenManager:
+    """Держит JWT Fragment в памяти и обновляет его до истечения.
+
+    Одновременные вызовы ждут одну авторизацию под общей блокировкой, а не
+    обращаются к /auth/authenticate/ каждый сам по себе.
+    """
+
+    def __init__(self, refresh_margin=TOKEN_REFRESH_MARGIN):
+        self.refresh_margin = refresh_margin
+        self._token = None
+        self._expires_at = None
+        self._refresh_at = None
+        self._file_checked = False
+        self._timer = None
+        self._lock = threading.Lock()
+
+    def _is_valid(self):
+        if not self._token:
+            return False
+        return self._expires_at is None or time.time() < min(self._refresh_at, self._expires_at)
+
+    def _set_token(self, token):
+        self._token = token
+        self._expires_at = decode_token_expiry(token) if token else None
+
+        if self._timer:
+            self._timer.cancel()
+            self._timer = None
+        if self._expires_at:
+            now = time.time()
+            # Токен, живущий меньше запаса, иначе обновлялся бы сразу же и по кругу:
+            # плановое обновление - не раньше середины срока и не чаще TOKEN_MIN_REFRESH_DELAY
+            self._schedule_refresh(max(
+                self._expires_at - self.refresh_margin,
+                now + (self._expires_at - now) / 2,
+                now + TOKEN_MIN_REFRESH_DELAY
+            ))
+
+    def _schedule_refresh(self, refresh_at):
+        if self._timer:
+            self._timer.cancel()
+        self._refresh_at = refresh_at
+        self._timer = threading.Timer(max(refresh_at - time.time(), 0), self._refresh_in_background)
+        self._timer.daemon = True
+        self._timer.start()
+
+    def _unexpired(self):
+        return bool(self._token) and (self._expires_at is None or time.time() < self._expires_at)
+
+    def _authenticate(self, keep_current):
+        """Авторизуется заново и возвращает новый токен.
+
+        Если авторизация не удалась (сеть, недоступен /auth/authenticate/), а
+        keep_current и текущий токен еще не истек, он остается в работе, а
+        обновление повторяется через TOKEN_REFRESH_RETRY_DELAY.
+        """
+        token = authenticate_fragment()
+        if not token and keep_current and self._unexpired():
+            logger.warning(
+                f"⚠️ Не удалось обновить токен Fragment, текущий действует еще "
+                f"{self._expires_at - time.time():.0f} с; повтор через {TOKEN_REFRESH_RETRY_DELAY} с"
+            )
+            self._schedule_refresh(time.time() + TOKEN_REFRESH_RETRY_DELAY)
+            return self._token
+        self._set_token(token)
+        return token
+
+    def _refresh_in_background(self):
+        logger.info("🔄 Плановое обновление токена Fragment...")
+        self.refresh(self._token, rejected=False)
+
+    def get_token(self):
+        """Возвращает действующий токен, при необходимости авторизуясь заново."""
+        if self._is_valid():
+            return self._token
+
+        with self._lock:
+            if self._is_valid():
+                return self._token
+
+            if not self._file_checked:
+                self._file_checked = True
+                self._set_token(load_fragment_token())
+                if self._is_valid():
+                    return self._token
+
+            return self._authenticate(keep_current=True)
+
+    def refresh(self, stale_token, rejected=True):
+        """Получает новый токен взамен stale_token.
+
+        rejected=True - токен отвергнут API (401) и при неудачной авторизации
+        отбрасывается; rejected=False - плановое обновление, при неудаче
+        неистекший токен остается. Если другой поток уже заменил stale_token,
+        повторной авторизации не будет.
+        """
+        with self._lock:
+            if self._token != stale_token and self._is_valid():
+                return self._token
+            self._file_checked = True
+            return self._authenticate(keep_current=not rejected)
+
+
+token_manager = FragmentTokenManager()
+
+
+class FragmentOrderUnknown(Exception):
+    """Заказ ушел в Fragment, но результат неизвестен (таймаут ответа, обрыв, 5xx).
+
+    Звезды могли быть отправлены, поэтому резерв нельзя возвращать без проверки.
+    """
+
+
+def _not_sent(error):
+    """Соединение так и не установлено - запрос точно не дошел до Fragment."""
+    if isinstance(error, requests.ConnectTimeout):
+        return True
+    reason = getattr(error.args[0], 'reason', None) if error.args else None
+    return isinstance(error, requests.ConnectionError) and isinstance(reason, NewConnectionError)
+
+
+def _post_order(token, data):
+    headers = {
+        "Authorization": f"JWT {token}",
+        "Content-Type": "application/json"
+    }
+    try:
+        res = get_session('fragment').post(f"{FRAGMENT_API_URL}/order/stars/", json=data, headers=headers)
+    except requests.RequestException as e:
+        if _not_sent(e):
+            raise
+        raise FragmentOrderUnknown(f"нет ответа Fragment: {e}") from e
+    if res.status_code >= 500:
+        raise FragmentOrderUnknown(f"Fragment ответил {res.status_code}: {res.text[:200]}")
+    return res
+
+
+def send_stars(username, quantity):
+    """Отправляет звезды. Возвращает (успех, сообщение).
+
+    (False, ...) - заказ точно не выполнен (ошибка токена, отказ 4xx, запрос
+    не ушел). Если запрос ушел, а результат неясен, бросает FragmentOrderUnknown.
+    """
+    try:
+        token = token_manager.get_token()
+        if not token:
+            return False, TOKEN_ERROR
+
         data = {
             "username": username,
             "quantity": quantity,
             "show_sender": "false"
         }
-        headers = {
-            "Authorization": f"JWT {token}",
-            "Content-Type": "application/json"
-        }
 
         logger.info(f"🔄 Отправка {quantity} ⭐ пользователю @{username}...")
-        res = requests.post(f"{FRAGMENT_API_URL}/order/stars/", json=data, headers=headers)
+        res = _post_order(token, data)
+
+        if res.status_code == 401:
+            # Токен отозван или истек раньше срока: одна повторная попытка с новым токеном.
+            # 401 означает, что заказ не принят, поэтому повтор не приведет к двойной отправке.
+            logger.warning("⚠️ Fragment отклонил токен (401), повторная авторизация...")
+            token = token_manager.refresh(token)
+            if not token:
+                return False, TOKEN_ERROR
+            res = _post_order(token, data)
 
         if res.status_code == 200:
-            bot.send_message(config.ADMIN_ID, f"✅ Отправлены {quantity} ⭐ пользователю @{username}...")
             logger.info("✅ Звезды успешно отправлены!")
             return True, "Успешно"
         else:
-            bot.send_message(config.ADMIN_ID, f"❌ Ошибка отправки {quantity} ⭐ пользователю @{username}. \n\nТекст ошибки: {res.text}")
             error_msg = f"❌ Ошибка отправки: {res.text}"
             logger.error(error_msg)
             return False, res.text
 
+    except FragmentOrderUnknown as e:
+        logger.error(f"⚠️ Результат заказа {quantity} ⭐ для @{username} неизвестен: {e}")
+        raise
+
     except Exception as e:
         error_msg = f"❌ Исключение при отправке: {e}"
         logger.error(error_msg)
-        return False, str(e)
\ No newline at end of file
+        return False, str(e)
+
+
+async def send_stars_async(username, quantity):
+    """Асинхронная обертка над send_stars для очереди заказов.
+
+    Запрос выполняется в пуле потоков поверх общего keep-alive пула соединений,
+    event loop при этом не блокируется.
+    """
+    return await asyncio.to_thread(send_stars, username, quantity)
@@ -0,0 +1,95 @@
+import threading
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+from config import logger
+
+# Настройки для каждого внешнего API: размер пула keep-alive соединений
+# (он же лимит одновременных соединений к хосту), таймауты (connect, read)
+# и методы, которые безопасно повторять.
+UPSTREAMS = {
+    'fragment': {
+        'pool_maxsize': 8,
+        'timeout': (5, 60),  # заказ звезд может выполняться долго
+        'retry_methods': ('GET',)  # POST /order/stars/ не идемпотентен
+    },
+    'yookassa': {
+        'pool_maxsize': 8,
+        'timeout': (5, 30),
+        'retry_methods': ('GET', 'POST')  # POST защищен заголовком Idempotence-Key
+    },
+    'toncenter': {
+        'pool_maxsize': 2,
+        'timeout': (5, 10),
+        'retry_methods': ('GET',)
+    },
+    'coingecko': {
+        'pool_maxsize': 2,
+        'timeout': (5, 5),
+        'retry_methods': ('GET',)
+    },
+}
+
+RETRY_TOTAL = 3
+RETRY_BACKOFF = 0.5  # 0.5, 1, 2 секунды между попытками
+RETRY_STATUSES = (429, 500, 502, 503, 504)
+
+_sessions = {}
+_sessions_lock = threading.Lock()
+
+
+class _UpstreamSession(requests.Session):
+    """requests.Session с таймаутом по умолчанию для всех запросов."""
+
+    def __init__(self, timeout):
+        super().__init__()
+        self.timeout = timeout
+
+    def request(self, method, url, **kwargs):
+        kwargs.setdefault('timeout', self.timeout)
+        return super().request(method, url, **kwargs)
+
+
+def _create_session(name):
+    settings = UPSTREAMS[name]
+    retry = Retry(
+        total=RETRY_TOTAL,
+        backoff_factor=RETRY_BACKOFF,
+        status_forcelist=RETRY_STATUSES,
+        allowed_methods=frozenset(settings['retry_methods']),
+        respect_retry_after_header=True,
+        raise_on_status=False
+    )
+    adapter = HTTPAdapter(
+        pool_connections=1,
+        pool_maxsize=settings['pool_maxsize'],
+        pool_block=True,  # не больше pool_maxsize соединений к хосту
+        max_retries=retry
+    )
+    session = _UpstreamSession(settings['timeout'])
+    session.mount('https://', adapter)
+    session.mount('http://', adapter)
+    return session
+
+
+def get_session(name):
+    """Возвращает общий пул соединений для внешнего API ('fragment', 'yookassa', ...)."""
+    session = _sessions.get(name)
+    if session is None:
+        with _sessions_lock:
+            session = _sessions.get(name)
+            if session is None:
+                session = _create_session(name)
+                _sessions[name] = session
+                logger.info(f"🌐 Создан HTTP-пул для {name}")
+    return session
+
+
+def close_sessions():
+    """Закрывает все пулы соединений (при остановке бота)."""
+    with _sessions_lock:
+        for session in _sessions.values():
+            session.close()
+        _sessions.clear()
@@ -1,4 +1,8 @@
 # keyboards.py
+# Клавиатуры собираются один раз и отдаются готовой JSON-строкой: telebot передает
+# строковый reply_markup в Telegram как есть, без повторной сериализации.
+
+from functools import lru_cache
 
 from telebot.types import *
 
@@ -7,6 +11,7 @@ from config import *
 from db import *
 
 
+@lru_cache(maxsize=None)
 def main_menu_keyboard():
     keyboard = InlineKeyboardMarkup()
     keyboard.row(
@@ -17,9 +22,10 @@ def main_menu_keyboard():
         InlineKeyboardButton("👤 Профиль", callback_data='profile'),
         InlineKeyboardButton("🔗 Рефералы", callback_data='referrals_menu') # НОВАЯ КНОПКА
     )
-    return keyboard
+    return keyboard.to_json()
 
 
+@lru_cache(maxsize=None)
 def buy_stars_options_keyboard():
     keyboard = InlineKeyboardMarkup()
     keyboard.row(
@@ -27,14 +33,17 @@ def buy_stars_options_keyboard():
         InlineKeyboardButton("Другу", callback_data='buy_stars_friend')
     )
     keyboard.row(InlineKeyboardButton("↩️ Назад", callback_data='main_menu'))
-    return keyboard
+    return keyboard.to_json()
 
 
 def buy_stars_quantity_keyboard(user_data):
-    keyboard = InlineKeyboardMarkup()
+    # Цены зависят только от STAR_PRICE: клавиатура пересобирается, когда цена меняется
+    return _quantity_keyboard(config.STAR_PRICE)
 
-    # Получаем актуальную цену из БД
-    star_price = config.STAR_PRICE
+
+@lru_cache(maxsize=8)
+def _quantity_keyboard(star_price):
+    keyboard = InlineKeyboardMarkup()
 
     options = [
         (50, f"50 звезд - {star_price * 50:.2f} руб"),
@@ -47,25 +56,33 @@ def buy_stars_quantity_keyboard(user_data):
         keyboard.row(InlineKeyboardButton(text, callback_data=f'buy_{stars}'))
 
     keyboard.row(InlineKeyboardButton("↩️ Назад", callback_data='main_menu'))
-    return keyboard
+    return keyboard.to_json()
 
 
 def deposit_keyboard(user_data):
-    keyboard = InlineKeyboardMarkup()
+    return _deposit_keyboard()
+
 
+@lru_cache(maxsize=None)
+def _deposit_keyboard():
+    keyboard = InlineKeyboardMarkup()
     amounts = [50, 100, 500, 1000]
     for amount in amounts:
-        keyboard.row(InlineKeyboardButton(f"{amount} руб", callback_data=f'deposit_{amount}'))
+        keyboard.row(InlineKeyboardButton(f"{amount} руб (ЮKassa)", callback_data=f'deposit_{amount}'))
 
-    keyboard.row(InlineKeyboardButton("✍️ Другая сумма", callback_data='deposit_custom'))
+    # Добавляем TON пополнение
+    keyboard.row(InlineKeyboardButton("🪙 Пополнить TON", callback_data='deposit_ton'))
 
+    # Добавляем кнопку для ввода кастомной суммы (ЮKassa)
+    keyboard.row(InlineKeyboardButton("✍️ Другая сумма (ЮKassa)", callback_data='deposit_custom'))
     keyboard.row(InlineKeyboardButton("↩️ Назад", callback_data='main_menu'))
-    return keyboard
+    return keyboard.to_json()
 
 
+@lru_cache(maxsize=None)
 def back_to_main_keyboard():
     keyboard = InlineKeyboardMarkup()
     keyboard.row(InlineKeyboardButton("↩️ Назад", callback_data='main_menu'))
 
-    return keyboard
+    return keyboard.to_json()
 
@@ -0,0 +1,109 @@
+import asyncio
+import threading
+import time
+
+from config import FRAGMENT_CONCURRENCY, FRAGMENT_RATE_LIMIT, logger
+from db import create_star_order, claim_star_orders, finish_star_order, mark_star_order_unknown, recover_star_orders
+from fragment_api import send_stars_async
+
+IDLE_POLL_INTERVAL = 5  # секунд; страховка на случай пропущенного сигнала
+
+
+class StarOrderQueue:
+    """Очередь заказов звезд, сохраняемая в таблице star_orders.
+
+    Обработчики колбэков только ставят заказ в очередь и сразу возвращаются.
+    Воркеры в отдельном event loop отправляют заказы в Fragment с ограничением
+    числа одновременных заказов и частоты запросов, а результат передают в
+    on_result(order, success, message), который вызывается в пуле потоков.
+    Заказы, прерванные перезапуском или ошибкой после запроса в Fragment,
+    передаются в on_interrupted(orders): их резерв ждет разбора администратором.
+    """
+
+    def __init__(self, on_result, on_interrupted=None,
+                 concurrency=FRAGMENT_CONCURRENCY, rate_limit=FRAGMENT_RATE_LIMIT):
+        self.on_result = on_result
+        self.on_interrupted = on_interrupted
+        self.concurrency = max(1, concurrency)
+        self.min_interval = 1 / rate_limit if rate_limit > 0 else 0
+        self._wakeup = threading.Event()
+        self._tasks = set()
+        self._next_slot = 0.0
+        self._rate_lock = None  # создается внутри event loop
+
+    def enqueue(self, user_id, cost, stars, target_username, chat_id, message_id):
+        """Резервирует стоимость и ставит заказ в очередь. Возвращает id заказа или None."""
+        order_id = create_star_order(user_id, cost, stars, target_username, chat_id, message_id)
+        if order_id is not None:
+            logger.info(f"📥 Заказ #{order_id}: {stars} ⭐ для @{target_username} поставлен в очередь")
+            self._wakeup.set()
+        return order_id
+
+    def size(self):
+        return len(self._tasks)
+
+    async def _throttle(self):
+        async with self._rate_lock:
+            delay = self._next_slot - time.monotonic()
+            if delay > 0:
+                await asyncio.sleep(delay)
+            self._next_slot = time.monotonic() + self.min_interval
+
+    async def _process(self, order):
+        requested = False
+        try:
+            await self._throttle()
+            requested = True
+            success, message = await send_stars_async(order['target_username'], order['stars'])
+            await asyncio.to_thread(finish_star_order, order['id'], success, None if success else message)
+            logger.info(f"{'✅' if success else '❌'} Заказ #{order['id']} обработан: {message}")
+            await asyncio.to_thread(self.on_result, order, success, message)
+        except Exception as e:
+            logger.error(f"Ошибка обработки заказа #{order['id']}: {e}")
+            await self._recover(order, requested, str(e))
+        finally:
+            self._wakeup.set()
+
+    async def _recover(self, order, requested, error):
+        """Не оставляет заказ в processing после ошибки.
+
+        До запроса в Fragment звезды точно не отправлены - резерв возвращается.
+        После запроса (send_stars бросил FragmentOrderUnknown: таймаут, обрыв, 5xx)
+        результат неизвестен - заказ уходит в unknown на ручной разбор.
+        Если заказ уже закрыт (упал только on_result), ничего не меняется.
+        """
+        try:
+            if not requested:
+                if await asyncio.to_thread(finish_star_order, order['id'], False, error):
+                    await asyncio.to_thread(self.on_result, order, False, error)
+            elif await asyncio.to_thread(mark_star_order_unknown, order['id'], error):
+                logger.warning(f"⚠️ Заказ #{order['id']} требует ручной проверки: {error}")
+                if self.on_interrupted:
+                    await asyncio.to_thread(self.on_interrupted, [order])
+        except Exception as e:
+            logger.error(f"Не удалось закрыть заказ #{order['id']} после ошибки: {e}")
+
+    async def run(self):
+        """Основной цикл: забирает заказы из БД, пока есть свободные воркеры."""
+        self._rate_lock = asyncio.Lock()
+
+        interrupted = recover_star_orders()
+        for order in interrupted:
+            logger.warning(
+                f"⚠️ Заказ #{order['id']} ({order['stars']} ⭐ для @{order['target_username']}) "
+                f"прерван перезапуском и требует ручной проверки"
+            )
+        if interrupted and self.on_interrupted:
+            await asyncio.to_thread(self.on_interrupted, interrupted)
+
+        logger.info(f"Запущена очередь заказов Fragment: до {self.concurrency} одновременно")
+        while True:
+            self._wakeup.clear()
+            free = self.concurrency - len(self._tasks)
+            if free > 0:
+                for order in await asyncio.to_thread(claim_star_orders, free):
+                    task = asyncio.create_task(self._process(order))
+                    self._tasks.add(task)
+                    task.add_done_callback(self._tasks.discard)
+
+            await asyncio.to_thread(self._wakeup.wait, IDLE_POLL_INTERVAL)
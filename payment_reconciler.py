@@ -0,0 +1,155 @@
+import asyncio
+import time
+from datetime import datetime, timezone
+
+from config import YOOKASSA_RECONCILE_CONCURRENCY, YOOKASSA_RECONCILE_INTERVAL, logger
+from db import get_pending_payments_batch, mark_payments_checked, complete_payment, close_payment
+from yookassa import check_payment_status
+
+BATCH_SIZE = 200
+# Как часто перепроверять платеж в зависимости от его возраста: (возраст до, интервал), секунды
+BACKOFF_SCHEDULE = (
+    (10 * 60, 60),
+    (60 * 60, 5 * 60),
+    (6 * 3600, 30 * 60),
+)
+OLD_PAYMENT_INTERVAL = 2 * 3600
+
+
+def _utcnow():
+    # CURRENT_TIMESTAMP в SQLite пишется в UTC без часового пояса
+    return datetime.now(timezone.utc).replace(tzinfo=None)
+
+
+def _seconds_since(timestamp, now):
+    if not timestamp:
+        return None
+    try:
+        return (now - datetime.fromisoformat(str(timestamp))).total_seconds()
+    except ValueError:
+        return None
+
+
+def check_interval(age):
+    for max_age, interval in BACKOFF_SCHEDULE:
+        if age < max_age:
+            return interval
+    return OLD_PAYMENT_INTERVAL
+
+
+def is_due(payment, now):
+    """Пора ли перепроверить платеж: интервал растет с возрастом платежа."""
+    since_check = _seconds_since(payment.get('checked_at'), now)
+    if since_check is None:
+        return True
+    age = _seconds_since(payment['created_at'], now) or 0
+    return since_check >= check_interval(age)
+
+
+class PaymentReconciler:
+    """Фоновая сверка всех ожидающих платежей ЮKassa.
+
+    Раз в interval секунд проходит таблицу payments пачками по id и
+    перепроверяет статус каждого платежа, которому подошло время, не более
+    concurrency запросов к API одновременно. Успешные платежи зачисляются
+    через complete_payment (ровно один раз, даже вместе с уведомлениями и
+    кнопкой «Я оплатил»), отмененные закрываются. Платеж закрывается только
+    по конечному статусу ЮKassa: неоплаченный платеж ЮKassa сама отменяет,
+    а до этого пользователь еще может его оплатить. Колбэки
+    on_credited(payment) и on_closed(payment, status) вызываются в пуле потоков.
+    """
+
+    def __init__(self, on_credited=None, on_closed=None, concurrency=YOOKASSA_RECONCILE_CONCURRENCY,
+                 interval=YOOKASSA_RECONCILE_INTERVAL):
+        self.on_credited = on_credited
+        self.on_closed = on_closed
+        self.concurrency = max(1, concurrency)
+        self.interval = interval
+        self.last_stats = None
+
+    async def _notify(self, callback, *args):
+        if callback:
+            try:
+                await asyncio.to_thread(callback, *args)
+            except Exception as e:
+                logger.error(f"Ошибка уведомления о платеже {args[0]['yookassa_id']}: {e}")
+
+    async def _close(self, payment, status):
+        if await asyncio.to_thread(close_payment, payment['yookassa_id'], status):
+            await self._notify(self.on_closed, payment, status)
+            return status
+        return 'duplicate'
+
+    async def _reconcile_payment(self, payment, semaphore):
+        """Возвращает итог проверки: credited, canceled, pending, duplicate или error."""
+        async with semaphore:
+            payment_info = await asyncio.to_thread(check_payment_status, payment['yookassa_id'])
+        if not payment_info:
+            return 'error'
+
+        status = payment_info.get('status')
+        if status == 'succeeded':
+            credited = await asyncio.to_thread(complete_payment, payment['yookassa_id'])
+            if not credited:
+                return 'duplicate'
+            logger.info(f"✅ Платеж {payment['yookassa_id']} зачислен фоновой сверкой")
+            await self._notify(self.on_credited, credited)
+            return 'credited'
+        if status == 'canceled':
+            return await self._close(payment, 'canceled')
+        return 'pending'
+
+    async def reconcile_once(self):
+        """Один проход по всем ожидающим платежам. Возвращает счетчики и длительность."""
+        started = time.monotonic()
+        now = _utcnow()
+        semaphore = asyncio.Semaphore(self.concurrency)
+        stats = dict.fromkeys(
+            ('scanned', 'checked', 'credited', 'canceled', 'pending', 'duplicate', 'error'), 0
+        )
+
+        after_id = 0
+        while True:
+            batch = await asyncio.to_thread(get_pending_payments_batch, after_id, BATCH_SIZE)
+            if not batch:
+                break
+            after_id = batch[-1]['id']
+            stats['scanned'] += len(batch)
+
+            due = [payment for payment in batch if is_due(payment, now)]
+            if not due:
+                continue
+            results = await asyncio.gather(
+                *(self._reconcile_payment(payment, semaphore) for payment in due)
+            )
+            # Отметка ставится и при ошибке API, чтобы недоступный платеж проверялся по расписанию
+            await asyncio.to_thread(mark_payments_checked, [payment['yookassa_id'] for payment in due])
+            stats['checked'] += len(due)
+            for result in results:
+                stats[result] += 1
+
+        stats['duration'] = round(time.monotonic() - started, 3)
+        self.last_stats = stats
+        return stats
+
+    async def run(self):
+        logger.info(
+            f"Запущена сверка платежей ЮKassa: каждые {self.interval} с, до {self.concurrency} запросов одновременно"
+        )
+        while True:
+            try:
+                stats = await self.reconcile_once()
+                if stats['checked']:
+                    logger.info(
+                        f"🔁 Сверка платежей: в ожидании {stats['scanned']}, проверено {stats['checked']}, "
+                        f"зачислено {stats['credited']}, отменено {stats['canceled']}, "
+                        f"ошибок {stats['error']} "
+                        f"за {stats['duration']:.2f} с"
+                    )
+                else:
+                    logger.debug(f"Сверка платежей: в ожидании {stats['scanned']}, "
+                                 f"проверять пока нечего ({stats['duration']:.2f} с)")
+            except Exception as e:
+                logger.error(f"Ошибка сверки платежей ЮKassa: {e}")
+
+            await asyncio.sleep(self.interval)
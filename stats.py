@@ -0,0 +1,179 @@
+import re
+from datetime import datetime, timedelta, timezone
+
+from db import ROLLUP_METRICS, get_connection, get_stats_counters, get_stats_rollups
+
+TOP_USERS_LIMIT = 5
+
+# Ограничения /report: почасовой отчет - до 3 суток, посуточный - до 90 дней
+REPORT_MAX_HOURS = 72
+REPORT_MAX_DAYS = 90
+BUCKET_FORMATS = {'hour': '%Y-%m-%d %H:00', 'day': '%Y-%m-%d'}
+SPARK_BARS = '▁▂▃▄▅▆▇█'
+
+
+def collect_summary(conn=None):
+    """Показатели команды /stats из счетчиков stats_counters - без проходов по таблицам."""
+    conn = conn or get_connection()
+    totals = get_stats_counters(conn=conn)
+    today = get_stats_counters(datetime.now(timezone.utc).strftime('%Y-%m-%d'), conn)
+
+    cursor = conn.execute("SELECT key, value FROM settings WHERE key IN ('ton_rub_rate', 'ton_rate_updated_at')")
+    settings = dict(cursor.fetchall())
+
+    return {
+        'total_users': int(totals['users_total']),
+        'users_with_referrer': int(totals['users_with_referrer']),
+        'total_balance': totals['balance_total'],
+        'stars_purchases': int(totals['stars_purchases']),
+        'successful_payments': int(totals['payments_succeeded']),
+        'payments_amount': totals['payments_succeeded_amount'],
+        'today': {
+            'new_users': int(today['users_total']),
+            'stars_purchases': int(today['stars_purchases']),
+            'successful_payments': int(today['payments_succeeded']),
+            'payments_amount': today['payments_succeeded_amount']
+        },
+        'ton_rate': settings.get('ton_rub_rate'),
+        'ton_rate_updated_at': settings.get('ton_rate_updated_at')
+    }
+
+
+def collect_statistics(conn=None):
+    """Полная сводка для листа «Статистика» экспорта: один агрегирующий проход на таблицу.
+
+    conn - соединение для запросов (экспорт передает свое, со снимком БД).
+    """
+    conn = conn or get_connection()
+    cursor = conn.cursor()
+
+    cursor.execute('SELECT COUNT(*), COUNT(referrer_id), SUM(balance), AVG(balance) FROM users')
+    total, with_referrer, total_balance, avg_balance = cursor.fetchone()
+    # Число пригласивших считается по индексу idx_users_referrer_id, без прохода по таблице
+    cursor.execute('SELECT COUNT(*) FROM (SELECT DISTINCT referrer_id FROM users WHERE referrer_id IS NOT NULL)')
+    users = {
+        'total': total,
+        'with_referrer': with_referrer,      # пришли по реферальной ссылке
+        'referrers': cursor.fetchone()[0],   # пригласили хотя бы одного
+        'total_balance': total_balance or 0,
+        'avg_balance': avg_balance or 0
+    }
+
+    # {тип: {статус: {'count', 'amount'}}}
+    transactions = {}
+    cursor.execute('SELECT type, status, COUNT(*), SUM(amount) FROM transactions GROUP BY type, status')
+    for tx_type, status, count, amount in cursor.fetchall():
+        transactions.setdefault(tx_type, {})[status] = {'count': count, 'amount': amount or 0}
+
+    # {статус: {'count', 'amount'}}
+    payments = {}
+    cursor.execute('SELECT status, COUNT(*), SUM(amount) FROM payments GROUP BY status')
+    for status, count, amount in cursor.fetchall():
+        payments[status] = {'count': count, 'amount': amount or 0}
+
+    cursor.execute(
+        'SELECT username, balance FROM users WHERE balance > 0 ORDER BY balance DESC LIMIT ?',
+        (TOP_USERS_LIMIT,)
+    )
+    top_users = cursor.fetchall()
+
+    return {
+        'users': users,
+        'transactions': transactions,
+        'payments': payments,
+        'top_users': top_users
+    }
+
+
+def count_of(group, status):
+    return group.get(status, {}).get('count', 0)
+
+
+def amount_of(group, status):
+    return group.get(status, {}).get('amount', 0)
+
+
+def statistics_sheet(stats):
+    """Плоский словарь «показатель -> значение» для листа «Статистика» экспорта."""
+    users = stats['users']
+    sheet = {
+        'Всего пользователей': users['total'],
+        'Пользователей с рефералами': users['referrers'],
+        'Общий баланс': round(users['total_balance'], 2),
+        'Средний баланс': round(users['avg_balance'], 2),
+    }
+
+    for tx_type, by_status in stats['transactions'].items():
+        if 'completed' not in by_status:
+            continue
+        sheet[f'Транзакций {tx_type}'] = count_of(by_status, 'completed')
+        sheet[f'Сумма {tx_type}'] = round(amount_of(by_status, 'completed'), 2)
+
+    for status, totals in stats['payments'].items():
+        sheet[f'Платежей {status}'] = totals['count']
+        sheet[f'Сумма платежей {status}'] = round(totals['amount'], 2)
+
+    for i, (username, balance) in enumerate(stats['top_users'], 1):
+        sheet[f'Топ {i} ({username})'] = round(balance, 2)
+
+    # Дата последнего обновления
+    sheet['Дата экспорта'] = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+    return sheet
+
+
+def parse_report_period(text):
+    """Разбирает период /report: 'today', 'Nh' или 'Nd'. Возвращает (срез, число корзин).
+
+    Бросает ValueError, если период не распознан или слишком длинный.
+    """
+    text = (text or '24h').strip().lower()
+    if text == 'today':
+        return 'hour', datetime.now(timezone.utc).hour + 1
+    match = re.fullmatch(r'(\d+)\s*([hd])', text)
+    if not match:
+        raise ValueError(f"неизвестный период: {text}")
+    count, unit = int(match.group(1)), match.group(2)
+    grain, limit = ('hour', REPORT_MAX_HOURS) if unit == 'h' else ('day', REPORT_MAX_DAYS)
+    if not 1 <= count <= limit:
+        raise ValueError(f"период должен быть от 1 до {limit}{unit}")
+    return grain, count
+
+
+def collect_report(grain, buckets, conn=None):
+    """Отчет /report по срезам stats_rollups за последние buckets корзин (включая текущую).
+
+    Пустые корзины заполняются нулями, чтобы тренд не сжимался.
+    """
+    now = datetime.now(timezone.utc)
+    if grain == 'hour':
+        start, step = now.replace(minute=0, second=0, microsecond=0), timedelta(hours=1)
+    else:
+        start, step = now.replace(hour=0, minute=0, second=0, microsecond=0), timedelta(days=1)
+    keys = [(start - step * i).strftime(BUCKET_FORMATS[grain]) for i in reversed(range(buckets))]
+
+    stored = dict(get_stats_rollups(grain, keys[0], conn=conn))
+    series = [(key, stored.get(key) or dict.fromkeys(ROLLUP_METRICS, 0)) for key in keys]
+    totals = {metric: round(sum(values[metric] for _, values in series), 2) for metric in ROLLUP_METRICS}
+
+    deposits_amount = totals['deposits_yookassa_amount'] + totals['deposits_ton_amount']
+    return {
+        'grain': grain,
+        'series': series,
+        'totals': totals,
+        'deposits_amount': deposits_amount,
+        # Доля пополнений, потраченная на звезды за период
+        'spend_ratio': totals['stars_revenue'] / deposits_amount if deposits_amount else None,
+        'ton_share': totals['deposits_ton_amount'] / deposits_amount if deposits_amount else None,
+        # Доля созданных счетов ЮKassa, которые были оплачены
+        'checkout_ratio': (totals['payments_succeeded'] / totals['payments_created']
+                           if totals['payments_created'] else None)
+    }
+
+
+def sparkline(values):
+    """Строка-график из символов ▁..█ для ряда значений."""
+    values = list(values)
+    peak = max(values, default=0)
+    if peak <= 0:
+        return SPARK_BARS[0] * len(values)
+    return ''.join(SPARK_BARS[min(len(SPARK_BARS) - 1, max(0, int(v / peak * len(SPARK_BARS))))] for v in values)
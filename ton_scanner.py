@@ -0,0 +1,325 @@
+import asyncio
+import threading
+import time
+from datetime import datetime, timezone
+
+from config import (
+    TON_API_BASE_URL, TON_POLL_INTERVAL, TON_POLL_FAST_INTERVAL, TON_POLL_MAX_INTERVAL, TON_EXPECT_WINDOW,
+    TON_SCAN_PAGE_SIZE, logger
+)
+from db import credit_ton_deposits, get_setting
+from http_client import get_session
+
+MIN_DEPOSIT_RUB = 1.0  # Слишком маленькие суммы не зачисляем
+NOTIFY_WORKERS = 3  # Одновременных отправок уведомлений о депозитах
+
+
+class TonApiError(Exception):
+    """toncenter вернул ok=false."""
+
+
+class TonRateLimited(TonApiError):
+    """toncenter ответил 429; retry_after - пауза из заголовка Retry-After (секунды) или None."""
+
+    def __init__(self, retry_after=None):
+        super().__init__(f"превышен лимит запросов (Retry-After: {retry_after})")
+        self.retry_after = retry_after
+
+
+def _retry_after(response):
+    try:
+        return max(0.0, float(response.headers.get('Retry-After')))
+    except (TypeError, ValueError):
+        return None  # заголовка нет или в нем дата
+
+
+def parse_deposit(tx, ton_rub_rate):
+    """Депозит из транзакции getTransactions или None, если это не пополнение.
+
+    В комментарии (in_msg.message) ожидается user_id получателя; если там не
+    число, user_id будет None - такой депозит сопоставляется по адресу
+    отправителя или попадает в неопознанные.
+    """
+    in_msg = tx.get('in_msg')
+    if not in_msg:
+        return None
+
+    value_nano = int(in_msg.get('value') or 0)
+    if value_nano <= 0:
+        return None
+
+    ton_amount = value_nano / 1e9
+    # Конвертация TON в RUB
+    rub_amount = round(ton_amount * ton_rub_rate, 2)
+    if rub_amount < MIN_DEPOSIT_RUB:
+        return None
+
+    comment = (in_msg.get('message') or '').strip()
+    utime = tx.get('utime')
+    return {
+        'lt': int(tx['transaction_id']['lt']),
+        'hash': tx['transaction_id']['hash'],
+        'sender': in_msg.get('source') or None,
+        'comment': comment,
+        'user_id': int(comment) if comment.isdigit() else None,
+        'ton_amount': ton_amount,
+        'rub_amount': rub_amount,
+        'tx_time': datetime.fromtimestamp(utime, timezone.utc).strftime('%Y-%m-%d %H:%M:%S') if utime else None
+    }
+
+
+class TonDepositScanner:
+    """Мониторинг входящих TON по курсору last_lt.
+
+    За один опрос читает getTransactions страницами от самой новой транзакции
+    назад (lt/hash последней полученной) до сохраненного last_lt (to_lt), так
+    что ни одна транзакция не выпадает из окна, сколько бы их ни пришло между
+    опросами, а уже обработанные не скачиваются повторно. Все новые депозиты
+    опроса зачисляются одним пакетным коммитом вместе с записями ton_deposits
+    и новым last_lt (credit_ton_deposits). Если опрос прервется, транзакции
+    будут обработаны в следующий раз, а уже зачисленные отсеет уникальный хэш.
+    Депозиты без подходящего user_id в комментарии зачисляются по выученному
+    адресу отправителя или сохраняются в unmatched_deposits.
+
+    Колбэк on_credited(deposit) вызывается после коммита: внутри run() - из
+    очереди уведомлений, которую разбирают NOTIFY_WORKERS задач, поэтому
+    отправка сообщений в Telegram не задерживает следующий опрос.
+
+    Интервал опроса подстраивается под нагрузку: после новых транзакций -
+    interval, каждый пустой опрос или ошибка удваивает его до max_interval.
+    Пока кто-то ждет депозит (expect_deposit, expect_window секунд или до
+    зачисления), опрос идет каждые fast_interval секунд. На 429 сканер молчит
+    столько, сколько просит Retry-After, и не просыпается раньше даже ради
+    ожидаемого депозита.
+    """
+
+    def __init__(self, address, api_key, get_rate, on_credited=None, base_url=TON_API_BASE_URL,
+                 page_size=TON_SCAN_PAGE_SIZE, interval=TON_POLL_INTERVAL, fast_interval=TON_POLL_FAST_INTERVAL,
+                 max_interval=TON_POLL_MAX_INTERVAL, expect_window=TON_EXPECT_WINDOW):
+        self.address = address
+        self.api_key = api_key
+        self.get_rate = get_rate
+        self.on_credited = on_credited
+        self.base_url = base_url
+        self.page_size = page_size
+        self.interval = interval
+        self.fast_interval = min(fast_interval, interval)
+        self.max_interval = max(max_interval, interval)
+        self.expect_window = expect_window
+        self.last_stats = None
+
+        self._idle_delay = interval
+        self._blocked_until = 0.0  # monotonic-время конца паузы по 429
+        self._expected = {}  # user_id -> monotonic-время, до которого ждем депозит
+        self._expected_lock = threading.Lock()
+        self._loop = None
+        self._wakeup = None
+        self._outbox = None  # asyncio.Queue уведомлений, пока работает run()
+
+    def expect_deposit(self, user_id):
+        """Пользователь открыл экран пополнения TON: ближайшее время опрашивать чаще.
+
+        Вызывается из потоков бота; будит цикл опроса, если он спит дольше fast_interval.
+        """
+        with self._expected_lock:
+            self._expected[user_id] = time.monotonic() + self.expect_window
+        loop, wakeup = self._loop, self._wakeup
+        if loop is not None:
+            loop.call_soon_threadsafe(wakeup.set)
+
+    def expected_count(self):
+        now = time.monotonic()
+        with self._expected_lock:
+            for user_id in [uid for uid, deadline in self._expected.items() if deadline <= now]:
+                del self._expected[user_id]
+            return len(self._expected)
+
+    def next_delay(self, fetched):
+        """Пауза до следующего опроса по итогу текущего (fetched=None - опрос завершился ошибкой)."""
+        if fetched:
+            self._idle_delay = self.interval
+        else:
+            self._idle_delay = min(self._idle_delay * 2, self.max_interval)
+        if self.expected_count():
+            return min(self.fast_interval, self._idle_delay)
+        return self._idle_delay
+
+    def on_rate_limited(self, retry_after):
+        """Пауза после 429: сколько просит Retry-After, иначе - удвоенный интервал."""
+        self._idle_delay = min(self._idle_delay * 2, self.max_interval)
+        pause = retry_after if retry_after is not None else self._idle_delay
+        self._blocked_until = time.monotonic() + pause
+        return pause
+
+    def load_last_lt(self):
+        last_lt_str = get_setting('last_lt', '0')
+        try:
+            return int(last_lt_str)
+        except ValueError:
+            logger.error(f"Некорректное значение last_lt в БД: '{last_lt_str}'. Используется 0.")
+            return 0
+
+    def fetch_page(self, to_lt, lt=None, tx_hash=None):
+        """Страница транзакций от (lt, hash) включительно к более старым, но новее to_lt."""
+        params = {
+            'address': self.address,
+            'limit': self.page_size,
+            'to_lt': to_lt,
+            'archival': 'true'
+        }
+        if self.api_key:
+            params['api_key'] = self.api_key
+        if lt is not None:
+            params['lt'] = lt
+            params['hash'] = tx_hash
+
+        # Повторы при 429 с учетом Retry-After делает пул http_client; сюда 429 доходит, когда они исчерпаны
+        response = get_session('toncenter').get(f'{self.base_url}/api/v2/getTransactions', params=params)
+        if response.status_code == 429:
+            raise TonRateLimited(_retry_after(response))
+        resp = response.json()
+        if not resp.get('ok'):
+            if resp.get('code') == 429:
+                raise TonRateLimited(_retry_after(response))
+            raise TonApiError(resp.get('error', 'Неизвестная ошибка'))
+        return resp.get('result', [])
+
+    def fetch_new_transactions(self, last_lt):
+        """Все транзакции новее last_lt, от старых к новым."""
+        transactions = []
+        cursor = None  # (lt, hash) самой старой уже полученной транзакции
+        while True:
+            page = self.fetch_page(last_lt, *(cursor or ()))
+            # Страница начинается с транзакции курсора включительно - отбрасываем повтор
+            fresh = [
+                tx for tx in page
+                if int(tx['transaction_id']['lt']) > last_lt
+                and (cursor is None or int(tx['transaction_id']['lt']) < cursor[0])
+            ]
+            transactions.extend(fresh)
+            if len(page) < self.page_size or not fresh:
+                break
+            oldest = fresh[-1]['transaction_id']
+            cursor = (int(oldest['lt']), oldest['hash'])
+
+        transactions.sort(key=lambda tx: int(tx['transaction_id']['lt']))
+        return transactions
+
+    def scan_once(self):
+        """Один опрос: скачивает и зачисляет все новые транзакции. Возвращает счетчики."""
+        started = time.monotonic()
+        stats = dict.fromkeys(('fetched', 'credited', 'by_sender', 'unmatched', 'duplicate'), 0)
+
+        ton_rub_rate = self.get_rate()
+        if not ton_rub_rate:
+            # Без курса не зачисляем и не двигаем курсор: транзакции дождутся следующего опроса
+            logger.warning("Нет курса TON, проверка депозитов отложена")
+            return None
+
+        last_lt = self.load_last_lt()
+        transactions = self.fetch_new_transactions(last_lt)
+        stats['fetched'] = len(transactions)
+
+        if transactions:
+            deposits = [deposit for deposit in (parse_deposit(tx, ton_rub_rate) for tx in transactions) if deposit]
+            last_lt = int(transactions[-1]['transaction_id']['lt'])
+            credited, unmatched, duplicates = credit_ton_deposits(deposits, last_lt)
+            stats['credited'] = len(credited)
+            stats['by_sender'] = sum(deposit['matched_by'] == 'sender' for deposit in credited)
+            stats['unmatched'] = len(unmatched)
+            stats['duplicate'] = len(duplicates)
+
+            for deposit in unmatched:
+                logger.warning(f"❓ Неопознанный депозит TON {deposit['lt']}: {deposit['ton_amount']} TON "
+                               f"от {deposit['sender']}, комментарий '{deposit['comment']}' - сохранен для /unmatched")
+            for deposit in duplicates:
+                logger.warning(f"Транзакция {deposit['lt']} ({deposit['hash']}) уже зачислена, повтор пропущен.")
+            with self._expected_lock:
+                for deposit in credited:
+                    self._expected.pop(deposit['user_id'], None)
+            for deposit in credited:
+                logger.info(f"✅ Депозит TON подтвержден! User: {deposit['user_id']}, "
+                            f"TON: {deposit['ton_amount']}, RUB: {deposit['rub_amount']}"
+                            f"{' (по адресу отправителя)' if deposit['matched_by'] == 'sender' else ''}")
+            self._notify(credited)
+
+        stats['last_lt'] = last_lt
+        stats['duration'] = round(time.monotonic() - started, 3)
+        self.last_stats = stats
+        return stats
+
+    def _notify(self, deposits):
+        if not self.on_credited:
+            return
+        if self._outbox is None:
+            # Вне run() (инструменты, разовый опрос) - уведомляем сразу
+            for deposit in deposits:
+                self._deliver(deposit)
+            return
+        # scan_once выполняется в потоке, очередь принадлежит циклу событий
+        for deposit in deposits:
+            self._loop.call_soon_threadsafe(self._outbox.put_nowait, deposit)
+
+    def _deliver(self, deposit):
+        try:
+            self.on_credited(deposit)
+        except Exception as e:
+            logger.error(f"Ошибка уведомления о депозите TON {deposit['lt']}: {e}")
+
+    async def _notify_worker(self):
+        while True:
+            deposit = await self._outbox.get()
+            try:
+                await asyncio.to_thread(self._deliver, deposit)
+            finally:
+                self._outbox.task_done()
+
+    async def _sleep(self, delay):
+        """Спит delay секунд; expect_deposit сокращает сон до fast_interval, но не пауза по 429."""
+        deadline = time.monotonic() + delay
+        while True:
+            timeout = max(deadline, self._blocked_until) - time.monotonic()
+            if timeout <= 0:
+                return
+            self._wakeup.clear()
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout)
+            except asyncio.TimeoutError:
+                continue
+            deadline = min(deadline, time.monotonic() + self.fast_interval)
+
+    async def run(self):
+        self._loop = asyncio.get_running_loop()
+        self._wakeup = asyncio.Event()
+        self._outbox = asyncio.Queue()
+        workers = [asyncio.create_task(self._notify_worker()) for _ in range(NOTIFY_WORKERS)]
+        logger.info(f"Запуск мониторинга TON. Последний LT: {self.load_last_lt()}")
+        try:
+            await self._poll_forever()
+        finally:
+            for worker in workers:
+                worker.cancel()
+            self._outbox = None
+
+    async def _poll_forever(self):
+        delay = self.interval
+        while True:
+            await self._sleep(delay)
+            try:
+                stats = await asyncio.to_thread(self.scan_once)
+                delay = self.next_delay(stats and stats['fetched'])
+                if stats and stats['fetched']:
+                    logger.info(
+                        f"🪙 TON: новых транзакций {stats['fetched']}, зачислено {stats['credited']} "
+                        f"(по адресу {stats['by_sender']}), неопознанных {stats['unmatched']}, "
+                        f"last_lt {stats['last_lt']} за {stats['duration']:.2f} с"
+                    )
+            except TonRateLimited as e:
+                delay = self.on_rate_limited(e.retry_after)
+                logger.warning(f"⏳ TON API: {e}, следующий запрос через {delay:.0f} с")
+            except TonApiError as e:
+                delay = self.next_delay(None)
+                logger.error(f"Ошибка ответа TON API: {e}")
+            except Exception as e:
+                delay = self.next_delay(None)
+                logger.error(f"Критическая ошибка в TON мониторинге: {e}")
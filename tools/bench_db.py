@@ -0,0 +1,127 @@
+"""Бенчмарк слоя БД: соединение на каждый вызов против долгоживущих соединений.
+
+Запуск: python tools/bench_db.py [количество_итераций]
+
+Синтетическая нагрузка повторяет покупку звезд: чтение пользователя,
+сессии, списание баланса, запись транзакции и удаление сессии.
+Ускорение считается на одних и тех же SQL-запросах с commit на каждую запись,
+поэтому в нем только переиспользование соединения потока и WAL. Функции db.py
+(с кэшем пользователей и сессий в памяти) замеряются отдельной строкой.
+"""
+import os
+import sqlite3
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import db  # noqa: E402
+
+USERS = 1000
+
+
+def legacy_workload(path, iterations):
+    """Старое поведение: новое соединение и commit с полным fsync на каждый вызов."""
+    def call(sql, params, write=False):
+        conn = sqlite3.connect(path)
+        cursor = conn.cursor()
+        cursor.execute(sql, params)
+        row = cursor.fetchone()
+        if write:
+            conn.commit()
+        conn.close()
+        return row
+
+    for i in range(iterations):
+        uid = i % USERS
+        call('SELECT * FROM users WHERE user_id = ?', (uid,))
+        call('SELECT state, target_username, message_id FROM sessions WHERE user_id = ?', (uid,))
+        call('UPDATE users SET balance = ROUND(balance + ?, 2) WHERE user_id = ?', (-1.5, uid), write=True)
+        call('INSERT INTO transactions (user_id, amount, type, status, target_user) VALUES (?, ?, ?, ?, ?)',
+             (uid, 1, 'stars_purchase', 'completed', 'bench'), write=True)
+        call('SELECT * FROM users WHERE user_id = ?', (uid,))
+        call('DELETE FROM sessions WHERE user_id = ?', (uid,), write=True)
+
+
+def pooled_workload(iterations):
+    """Те же запросы и коммиты, что в legacy_workload, через соединение потока (WAL)."""
+    def call(sql, params, write=False):
+        conn = db.get_connection()
+        cursor = conn.cursor()
+        cursor.execute(sql, params)
+        row = cursor.fetchone()
+        if write:
+            conn.commit()
+        return row
+
+    for i in range(iterations):
+        uid = i % USERS
+        call('SELECT * FROM users WHERE user_id = ?', (uid,))
+        call('SELECT state, target_username, message_id FROM sessions WHERE user_id = ?', (uid,))
+        call('UPDATE users SET balance = ROUND(balance + ?, 2) WHERE user_id = ?', (-1.5, uid), write=True)
+        call('INSERT INTO transactions (user_id, amount, type, status, target_user) VALUES (?, ?, ?, ?, ?)',
+             (uid, 1, 'stars_purchase', 'completed', 'bench'), write=True)
+        call('SELECT * FROM users WHERE user_id = ?', (uid,))
+        call('DELETE FROM sessions WHERE user_id = ?', (uid,), write=True)
+
+
+def db_functions_workload(iterations):
+    """Функции db.py поверх соединения потока - вместе с кэшами пользователей и сессий."""
+    for i in range(iterations):
+        uid = i % USERS
+        db.get_user(uid)
+        db.get_session_data(uid)
+        db.update_balance(uid, -1.5)
+        db.add_transaction(uid, 1, 'stars_purchase', target_user='bench')
+        db.get_user(uid)
+        db.delete_session_data(uid)
+
+
+def prepare(path):
+    db.close_connections()
+    db.DB_NAME = path
+    db.init_db()
+    conn = db.get_connection()
+    with conn:
+        conn.executemany(
+            'INSERT INTO users (user_id, username, balance) VALUES (?, ?, ?)',
+            [(uid, f'user{uid}', 1000.0) for uid in range(USERS)]
+        )
+
+
+def run(label, func, iterations):
+    ops = iterations * 6
+    start = time.perf_counter()
+    func()
+    elapsed = time.perf_counter() - start
+    print(f"{label:<28} {elapsed:8.3f} с  {ops / elapsed:12.0f} оп/с")
+    return ops / elapsed
+
+
+def main():
+    iterations = int(sys.argv[1]) if len(sys.argv) > 1 else 2000
+    with tempfile.TemporaryDirectory() as tmp:
+        legacy_path = os.path.join(tmp, 'legacy.db')
+        prepare(legacy_path)
+        db.close_connections()
+        # Старая БД работала в режиме rollback-журнала
+        conn = sqlite3.connect(legacy_path)
+        conn.execute('PRAGMA journal_mode=DELETE')
+        conn.close()
+
+        pooled_path = os.path.join(tmp, 'pooled.db')
+
+        print(f"Итераций: {iterations} (по 6 операций)")
+        before = run("connect на каждый вызов", lambda: legacy_workload(legacy_path, iterations), iterations)
+        prepare(pooled_path)
+        after = run("соединение потока + WAL", lambda: pooled_workload(iterations), iterations)
+        prepare(os.path.join(tmp, 'functions.db'))
+        with_caches = run("функции db.py (с кэшами)", lambda: db_functions_workload(iterations), iterations)
+        db.close_connections()
+        print(f"Ускорение от соединения потока и WAL: x{after / before:.1f}")
+        print(f"Вместе с кэшами пользователей и сессий: x{with_caches / before:.1f}")
+
+
+if __name__ == '__main__':
+    main()
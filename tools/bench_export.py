@@ -0,0 +1,116 @@
+"""Бенчмарк /export: пиковая память (RSS) и время в зависимости от числа строк.
+
+Запуск: python tools/bench_export.py [строк_транзакций ...]
+        (по умолчанию 10000 50000 200000)
+
+Для каждого размера создается временная БД с синтетическими транзакциями и
+платежами, затем в отдельном процессе выполняется старый экспорт (pandas
+read_sql + to_excel) и новый потоковый (xlsx и csv). Пиковый RSS замеряется
+внутри процесса экспорта, поэтому измерения не влияют друг на друга.
+"""
+import os
+import random
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+MODES = ('legacy', 'xlsx', 'csv')
+
+
+def peak_rss_mb():
+    # На Linux ru_maxrss в килобайтах, на macOS - в байтах
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return rss / (1024 * 1024) if sys.platform == 'darwin' else rss / 1024
+
+
+def build_db(path, rows):
+    import sqlite3
+
+    import db
+    db.DB_NAME = path
+    db.init_db()
+    db.close_connections()
+
+    conn = sqlite3.connect(path)
+    users = max(1, rows // 20)
+    conn.executemany('INSERT INTO users (user_id, username, balance) VALUES (?, ?, ?)',
+                     ((uid, f'user{uid}', round(random.uniform(0, 1000), 2)) for uid in range(users)))
+    conn.executemany(
+        'INSERT INTO transactions (user_id, amount, type, status, target_user) VALUES (?, ?, ?, ?, ?)',
+        ((i % users, round(random.uniform(1, 1500), 2), random.choice(('deposit', 'stars_purchase')),
+          'completed', f'target{i % 997}') for i in range(rows))
+    )
+    conn.executemany(
+        'INSERT INTO payments (user_id, amount, yookassa_id, status) VALUES (?, ?, ?, ?)',
+        ((i % users, 100.0, f'payment-{i}', 'succeeded') for i in range(rows // 4))
+    )
+    conn.commit()
+    conn.close()
+
+
+def legacy_export(path, filename):
+    """Прежняя реализация: каждая таблица целиком в DataFrame."""
+    import sqlite3
+
+    import pandas as pd
+
+    from excel_export import EXPORT_TABLES, generate_statistics
+    conn = sqlite3.connect(path)
+    with pd.ExcelWriter(filename, engine='openpyxl') as writer:
+        for table, title in EXPORT_TABLES:
+            df = pd.read_sql_query(f"SELECT * FROM {table}", conn)
+            if not df.empty:
+                df.to_excel(writer, sheet_name=title, index=False)
+        pd.DataFrame([generate_statistics(conn)]).to_excel(writer, sheet_name='Статистика', index=False)
+    conn.close()
+
+
+def worker(mode, path):
+    """Выполняется в дочернем процессе; печатает «базовый_RSS пиковый_RSS секунды».
+
+    Базовый RSS берется после импортов, поэтому разница показывает память
+    самого экспорта."""
+    import excel_export  # noqa: F401
+    import openpyxl  # noqa: F401
+    import pandas  # noqa: F401
+
+    workdir = tempfile.mkdtemp()
+    os.chdir(workdir)
+    baseline = peak_rss_mb()
+    start = time.perf_counter()
+    if mode == 'legacy':
+        legacy_export(path, os.path.join(workdir, 'legacy.xlsx'))
+    else:
+        if not excel_export.export_database_to_excel(mode, db_path=path)[0]:
+            raise SystemExit(1)
+    elapsed = time.perf_counter() - start
+    print(f"{baseline:.1f} {peak_rss_mb():.1f} {elapsed:.2f}")
+
+
+def main():
+    if len(sys.argv) == 4 and sys.argv[1] == '--worker':
+        worker(sys.argv[2], sys.argv[3])
+        return
+
+    sizes = [int(arg) for arg in sys.argv[1:]] or [10000, 50000, 200000]
+    print(f"{'строк':>8} {'режим':>7} {'RSS, МБ':>9} {'прирост':>9} {'время, с':>9}")
+    for rows in sizes:
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, 'bench.db')
+            build_db(path, rows)
+            for mode in MODES:
+                output = subprocess.run(
+                    [sys.executable, os.path.abspath(__file__), '--worker', mode, path],
+                    check=True, capture_output=True, text=True
+                ).stdout.split()
+                baseline, peak, elapsed = map(float, output[-3:])
+                print(f"{rows:>8} {mode:>7} {peak:>9.1f} {peak - baseline:>9.1f} {elapsed:>9.2f}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,102 @@
+"""Планы запросов и время выполнения до и после миграций с индексами.
+
+Запуск: python tools/bench_indexes.py [количество_строк]
+
+Строит синтетическую БД (по умолчанию 1 000 000 строк в users, transactions
+и payments), снимает EXPLAIN QUERY PLAN и время горячих запросов без индексов,
+затем применяет миграции из db.MIGRATIONS и повторяет замеры.
+"""
+import os
+import random
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import db  # noqa: E402
+
+REPEATS = 50
+
+QUERIES = [
+    ("get_pending_payment",
+     'SELECT yookassa_id, amount FROM payments '
+     'WHERE user_id = ? AND status = "pending" ORDER BY created_at DESC LIMIT 1',
+     lambda rows: (random.randrange(rows),)),
+    ("get_referral_count",
+     'SELECT COUNT(*) FROM users WHERE referrer_id = ?',
+     lambda rows: (random.randrange(rows),)),
+    ("update_payment_status (поиск)",
+     'SELECT id FROM payments WHERE yookassa_id = ?',
+     lambda rows: (f'pay-{random.randrange(rows)}',)),
+    ("/stats: покупки звезд",
+     "SELECT COUNT(*) FROM transactions WHERE type = 'stars_purchase' AND status = 'completed'",
+     lambda rows: ()),
+]
+
+
+def populate(conn, rows):
+    rnd = random.Random(42)
+    with conn:
+        conn.executemany(
+            'INSERT INTO users (user_id, username, balance, referrer_id) VALUES (?, ?, ?, ?)',
+            ((i, f'user{i}', rnd.random() * 1000, rnd.randrange(rows) if rnd.random() < 0.3 else None)
+             for i in range(rows))
+        )
+        conn.executemany(
+            'INSERT INTO transactions (user_id, amount, type, status, target_user) VALUES (?, ?, ?, ?, ?)',
+            ((rnd.randrange(rows), rnd.choice((50, 100, 500)),
+              rnd.choice(('stars_purchase', 'deposit', 'deposit_ton', 'referral_reward')),
+              rnd.choice(('completed', 'completed', 'completed', 'failed')), None)
+             for _ in range(rows))
+        )
+        conn.executemany(
+            'INSERT INTO payments (user_id, amount, yookassa_id, status, created_at) '
+            "VALUES (?, ?, ?, ?, datetime('now', ?))",
+            ((rnd.randrange(rows), 100.0, f'pay-{i}', rnd.choice(('pending', 'succeeded', 'canceled')),
+              f'-{rnd.randrange(86400 * 30)} seconds')
+             for i in range(rows))
+        )
+
+
+def measure(conn, rows, title):
+    print(f"\n=== {title} (схема v{db.get_schema_version(conn)}) ===")
+    for name, sql, params in QUERIES:
+        plan = conn.execute(f'EXPLAIN QUERY PLAN {sql}', params(rows)).fetchall()
+        start = time.perf_counter()
+        for _ in range(REPEATS):
+            conn.execute(sql, params(rows)).fetchall()
+        elapsed_ms = (time.perf_counter() - start) / REPEATS * 1000
+        print(f"{name:<32} {elapsed_ms:10.3f} мс/запрос")
+        for row in plan:
+            print(f"    {row[-1]}")
+
+
+def main():
+    rows = int(sys.argv[1]) if len(sys.argv) > 1 else 1_000_000
+    with tempfile.TemporaryDirectory() as tmp:
+        db.DB_NAME = os.path.join(tmp, 'bench.db')
+        conn = db.get_connection()
+        # Таблицы без индексов: схема до миграций
+        migrations, db.MIGRATIONS = db.MIGRATIONS, []
+        db.init_db()
+        db.MIGRATIONS = migrations
+
+        start = time.perf_counter()
+        populate(conn, rows)
+        conn.execute('ANALYZE')
+        print(f"Сгенерировано {rows} строк на таблицу за {time.perf_counter() - start:.1f} с")
+
+        measure(conn, rows, "Без индексов")
+
+        start = time.perf_counter()
+        db.apply_migrations(conn)
+        conn.execute('ANALYZE')
+        print(f"\nМиграции применены за {time.perf_counter() - start:.1f} с")
+
+        measure(conn, rows, "После миграций")
+        db.close_connections()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,88 @@
+"""Микробенчмарк клавиатур: сборка InlineKeyboardMarkup на каждый колбэк против кэша.
+
+Запуск: python tools/bench_keyboards.py [количество_итераций]
+
+Замеряется то, что происходит с клавиатурой при обработке колбэка до отправки
+запроса: вызов функции клавиатуры и сериализация reply_markup в telebot.
+"""
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from telebot.apihelper import _convert_markup  # noqa: E402
+from telebot.types import InlineKeyboardMarkup, InlineKeyboardButton  # noqa: E402
+
+import config  # noqa: E402
+import keyboards  # noqa: E402
+
+
+def legacy_main_menu():
+    keyboard = InlineKeyboardMarkup()
+    keyboard.row(
+        InlineKeyboardButton("⭐ Купить звезды", callback_data='buy_stars'),
+        InlineKeyboardButton("💰 Пополнить баланс", callback_data='deposit')
+    )
+    keyboard.row(
+        InlineKeyboardButton("👤 Профиль", callback_data='profile'),
+        InlineKeyboardButton("🔗 Рефералы", callback_data='referrals_menu')
+    )
+    return keyboard
+
+
+def legacy_quantity(user_data):
+    keyboard = InlineKeyboardMarkup()
+    star_price = config.STAR_PRICE
+    for stars in (50, 100, 500, 1000):
+        keyboard.row(InlineKeyboardButton(f"{stars} звезд - {star_price * stars:.2f} руб",
+                                          callback_data=f'buy_{stars}'))
+    keyboard.row(InlineKeyboardButton("↩️ Назад", callback_data='main_menu'))
+    return keyboard
+
+
+def legacy_deposit(user_data):
+    keyboard = InlineKeyboardMarkup()
+    for amount in (50, 100, 500, 1000):
+        keyboard.row(InlineKeyboardButton(f"{amount} руб (ЮKassa)", callback_data=f'deposit_{amount}'))
+    keyboard.row(InlineKeyboardButton("🪙 Пополнить TON", callback_data='deposit_ton'))
+    keyboard.row(InlineKeyboardButton("✍️ Другая сумма (ЮKassa)", callback_data='deposit_custom'))
+    keyboard.row(InlineKeyboardButton("↩️ Назад", callback_data='main_menu'))
+    return keyboard
+
+
+def legacy_back():
+    keyboard = InlineKeyboardMarkup()
+    keyboard.row(InlineKeyboardButton("↩️ Назад", callback_data='main_menu'))
+    return keyboard
+
+
+CASES = [
+    ('main_menu', legacy_main_menu, keyboards.main_menu_keyboard, ()),
+    ('buy_stars_quantity', legacy_quantity, keyboards.buy_stars_quantity_keyboard, ({},)),
+    ('deposit', legacy_deposit, keyboards.deposit_keyboard, ({},)),
+    ('back_to_main', legacy_back, keyboards.back_to_main_keyboard, ()),
+]
+
+
+def measure(func, args, iterations):
+    start = time.perf_counter()
+    for _ in range(iterations):
+        _convert_markup(func(*args))
+    return (time.perf_counter() - start) / iterations * 1e6
+
+
+def main():
+    iterations = int(sys.argv[1]) if len(sys.argv) > 1 else 20000
+
+    print(f"Итераций: {iterations}, мкс на колбэк")
+    print(f"{'клавиатура':<20} {'сборка':>10} {'кэш':>10} {'ускорение':>10}")
+    for name, legacy, cached, args in CASES:
+        assert _convert_markup(legacy(*args)) == _convert_markup(cached(*args)), name
+        legacy_us = measure(legacy, args, iterations)
+        cached_us = measure(cached, args, iterations)
+        print(f"{name:<20} {legacy_us:>10.2f} {cached_us:>10.2f} {legacy_us / cached_us:>9.0f}x")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,169 @@
+"""Бенчмарк статистики: прежние /stats и generate_statistics против stats.collect_statistics.
+
+Запуск: python tools/bench_stats.py [строк_транзакций] [повторов]
+        (по умолчанию 1000000 транзакций, 5 повторов)
+
+Создается временная БД: пользователей в 10 раз меньше, чем транзакций,
+платежей - в 4 раза меньше. Прежний вариант - отдельные COUNT/SUM-запросы
+/stats и запросы pandas из generate_statistics на схеме без покрывающих
+индексов статистики; новый - stats.collect_summary (чтение счетчиков
+stats_counters) и stats.collect_statistics (один агрегирующий запрос на
+таблицу) после всех миграций. Для /report 30d прежний вариант - группировка
+сырых таблиц по дням, новый - stats.collect_report по срезам stats_rollups.
+"""
+import os
+import random
+import sqlite3
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import pandas as pd  # noqa: E402
+
+import db  # noqa: E402
+from stats import collect_report, collect_statistics, collect_summary, statistics_sheet  # noqa: E402
+
+
+def build_db(path, rows):
+    """Создает БД на схеме до покрывающих индексов статистики (миграция #6)."""
+    db.DB_NAME = path
+    all_migrations = db.MIGRATIONS[:]
+    db.MIGRATIONS[:] = all_migrations[:5]
+    try:
+        db.init_db()
+    finally:
+        db.MIGRATIONS[:] = all_migrations
+    db.close_connections()
+
+    conn = sqlite3.connect(path)
+    users = max(1, rows // 10)
+    conn.executemany(
+        'INSERT INTO users (user_id, username, balance, referrer_id) VALUES (?, ?, ?, ?)',
+        ((uid, f'user{uid}', round(random.uniform(0, 1000), 2), uid - 1 if uid % 3 == 0 else None)
+         for uid in range(1, users + 1))
+    )
+    conn.executemany(
+        'INSERT INTO transactions (user_id, amount, type, status, target_user) VALUES (?, ?, ?, ?, ?)',
+        ((i % users + 1, round(random.uniform(1, 1500), 2),
+          random.choice(('deposit', 'stars_purchase', 'referral_bonus')),
+          random.choice(('completed', 'completed', 'completed', 'failed')), None) for i in range(rows))
+    )
+    conn.executemany(
+        'INSERT INTO payments (user_id, amount, yookassa_id, status) VALUES (?, ?, ?, ?)',
+        ((i % users + 1, 100.0, f'payment-{i}', random.choice(('succeeded', 'pending', 'canceled')))
+         for i in range(rows // 4))
+    )
+    conn.executemany('INSERT INTO settings (key, value) VALUES (?, ?)',
+                     [('ton_rub_rate', '250.0'), ('ton_rate_updated_at', '2025-01-01T00:00:00')])
+    conn.commit()
+    conn.close()
+
+
+def legacy_stats_command(conn):
+    cursor = conn.cursor()
+    queries = [
+        "SELECT COUNT(*) FROM users",
+        "SELECT COUNT(*) FROM users WHERE referrer_id IS NOT NULL",
+        "SELECT SUM(balance) FROM users",
+        "SELECT COUNT(*) FROM transactions WHERE type = 'stars_purchase' AND status = 'completed'",
+        "SELECT COUNT(*) FROM payments WHERE status = 'succeeded'",
+        "SELECT SUM(amount) FROM payments WHERE status = 'succeeded'",
+    ]
+    result = [cursor.execute(sql).fetchone()[0] for sql in queries]
+    # get_setting раньше открывал новое соединение на каждый вызов
+    for key in ('ton_rub_rate', 'ton_rate_updated_at'):
+        settings_conn = sqlite3.connect(db.DB_NAME)
+        result.append(settings_conn.execute("SELECT value FROM settings WHERE key = ?", (key,)).fetchone())
+        settings_conn.close()
+    return result
+
+
+def legacy_generate_statistics(conn):
+    stats = {}
+    users_stats = pd.read_sql_query("""
+        SELECT COUNT(*) as total_users, COUNT(DISTINCT referrer_id) as users_with_referrals,
+               SUM(balance) as total_balance, AVG(balance) as avg_balance
+        FROM users
+    """, conn)
+    stats['Всего пользователей'] = users_stats.iloc[0]['total_users']
+    transactions_stats = pd.read_sql_query("""
+        SELECT type, COUNT(*) as count, SUM(amount) as total_amount
+        FROM transactions WHERE status = 'completed' GROUP BY type
+    """, conn)
+    for _, row in transactions_stats.iterrows():
+        stats[f'Транзакций {row["type"]}'] = row['count']
+    payments_stats = pd.read_sql_query("""
+        SELECT status, COUNT(*) as count, SUM(amount) as total_amount FROM payments GROUP BY status
+    """, conn)
+    for _, row in payments_stats.iterrows():
+        stats[f'Платежей {row["status"]}'] = row['count']
+    top_users = pd.read_sql_query(
+        "SELECT username, balance FROM users WHERE balance > 0 ORDER BY balance DESC LIMIT 5", conn
+    )
+    for i, (_, row) in enumerate(top_users.iterrows(), 1):
+        stats[f'Топ {i} ({row["username"]})'] = row['balance']
+    return stats
+
+
+def legacy_report(conn):
+    """То, что пришлось бы считать для /report 30d без срезов: группировка сырых таблиц по дням."""
+    since = "date('now', '-29 days')"
+    return (
+        conn.execute(f"""
+            SELECT date(created_at), type, COUNT(*), SUM(amount) FROM transactions
+            WHERE status = 'completed' AND created_at >= {since} GROUP BY 1, 2
+        """).fetchall(),
+        conn.execute(f"""
+            SELECT date(created_at), COUNT(*), SUM(status = 'succeeded') FROM payments
+            WHERE created_at >= {since} GROUP BY 1
+        """).fetchall(),
+        conn.execute(f"""
+            SELECT date(created_at), SUM(amount) FROM balance_holds
+            WHERE status = 'settled' AND created_at >= {since} GROUP BY 1
+        """).fetchall()
+    )
+
+
+def measure(func, repeats):
+    best = float('inf')
+    for _ in range(repeats):
+        start = time.perf_counter()
+        func()
+        best = min(best, time.perf_counter() - start)
+    return best * 1000
+
+
+def main():
+    rows = int(sys.argv[1]) if len(sys.argv) > 1 else 1000000
+    repeats = int(sys.argv[2]) if len(sys.argv) > 2 else 5
+
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, 'bench.db')
+        start = time.perf_counter()
+        build_db(path, rows)
+        print(f"БД: {rows} транзакций, {rows // 10} пользователей, {rows // 4} платежей "
+              f"(создана за {time.perf_counter() - start:.1f} с)")
+
+        conn = sqlite3.connect(path)
+        # Прогрев страничного кэша, чтобы первый вариант не платил за чтение с диска
+        legacy_generate_statistics(conn)
+        legacy_stats = measure(lambda: legacy_stats_command(conn), repeats)
+        legacy_sheet = measure(lambda: legacy_generate_statistics(conn), repeats)
+        legacy_report_ms = measure(lambda: legacy_report(conn), repeats)
+
+        db.apply_migrations(conn)
+        collect_statistics(conn)
+        new_stats = measure(lambda: collect_summary(conn), repeats)
+        new_sheet = measure(lambda: statistics_sheet(collect_statistics(conn)), repeats)
+        new_report = measure(lambda: collect_report('day', 30, conn), repeats)
+        conn.close()
+
+    print(f"/stats:                было {legacy_stats:8.1f} мс, стало {new_stats:8.1f} мс")
+    print(f"лист «Статистика»:     было {legacy_sheet:8.1f} мс, стало {new_sheet:8.1f} мс")
+    print(f"/report 30d:           было {legacy_report_ms:8.1f} мс, стало {new_report:8.1f} мс")
+
+
+if __name__ == '__main__':
+    main()
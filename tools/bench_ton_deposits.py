@@ -0,0 +1,133 @@
+"""Бенчмарк зачисления TON: долг из 1000 депозитов, прежний цикл против пакета с очередью.
+
+Запуск: python tools/bench_ton_deposits.py [депозитов] [--send-ms 25]
+
+Прежний цикл на каждый депозит делает get_user, update_balance,
+add_transaction, еще один get_user и две отправки в Telegram прямо в цикле.
+Новый - TonDepositScanner.run() на локальной замене toncenter
+(tools/toncenter_stub.py): постраничное чтение, одно пакетное зачисление
+за опрос и очередь уведомлений. Отправка в Telegram имитируется паузой
+--send-ms на сообщение. Замеряется время до зачисления всех депозитов и
+до отправки всех уведомлений.
+"""
+import argparse
+import asyncio
+import contextlib
+import logging
+import os
+import sys
+import tempfile
+import threading
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import db  # noqa: E402
+from config import logger  # noqa: E402
+from toncenter_stub import SyntheticChain, start_server  # noqa: E402
+from ton_scanner import TonDepositScanner, parse_deposit  # noqa: E402
+
+USERS = 200
+RATE = 250.0
+
+
+def prepare_db(path):
+    db.close_connections()
+    db.DB_NAME = path
+    db.init_db()
+    for uid in range(1, USERS + 1):
+        db.create_user(uid, f'user{uid}')
+
+
+def credited_count():
+    return db.get_connection().execute(
+        "SELECT COUNT(*) FROM transactions WHERE type = 'deposit_ton'"
+    ).fetchone()[0]
+
+
+def legacy(deposits, send_seconds):
+    """Прежний check_deposits: отдельные коммиты и отправки на каждый депозит."""
+    started = time.perf_counter()
+    for deposit in deposits:
+        uid = deposit['user_id']
+        user_data = db.get_user(uid)
+        if not user_data:
+            continue
+        db.update_balance(uid, deposit['rub_amount'])
+        db.add_transaction(uid, deposit['rub_amount'], 'deposit_ton', 'completed',
+                           target_user=f"{deposit['ton_amount']:.4f} TON")
+        time.sleep(send_seconds)  # send_admin_deposit_notification
+        db.get_user(uid)
+        time.sleep(send_seconds)  # bot.send_message пользователю
+    elapsed = time.perf_counter() - started
+    return elapsed, elapsed
+
+
+def batched(chain, send_seconds):
+    server = start_server(chain)
+    notified = []
+    notified_all = threading.Event()
+
+    def on_credited(deposit):
+        time.sleep(send_seconds * 2)  # администратору и пользователю
+        notified.append(deposit)
+        if len(notified) == len(chain.transactions):
+            notified_all.set()
+
+    scanner = TonDepositScanner('EQstub', 'key', lambda: RATE, on_credited=on_credited,
+                                base_url=f'http://127.0.0.1:{server.server_port}', interval=0.001)
+    stop = threading.Event()
+
+    async def run_until_stopped():
+        runner = asyncio.ensure_future(scanner.run())
+        await asyncio.to_thread(stop.wait)
+        runner.cancel()
+        with contextlib.suppress(asyncio.CancelledError):
+            await runner
+
+    started = time.perf_counter()
+    thread = threading.Thread(target=asyncio.run, args=(run_until_stopped(),), daemon=True)
+    thread.start()
+    while credited_count() < len(chain.transactions):
+        time.sleep(0.001)
+    credit_time = time.perf_counter() - started
+    notified_all.wait()
+    notify_time = time.perf_counter() - started
+
+    stop.set()
+    thread.join(timeout=10)
+    server.shutdown()
+    return credit_time, notify_time
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('deposits', type=int, nargs='?', default=1000)
+    parser.add_argument('--send-ms', type=float, default=25, help='имитация отправки одного сообщения, мс')
+    args = parser.parse_args()
+    send_seconds = args.send_ms / 1000
+    logger.setLevel(logging.WARNING)
+
+    chain = SyntheticChain(USERS)
+    for i in range(args.deposits):
+        chain.append(1, user_id=i % USERS + 1)
+    deposits = [parse_deposit(tx, RATE) for tx in chain.transactions]
+
+    results = {}
+    with tempfile.TemporaryDirectory() as tmp:
+        prepare_db(os.path.join(tmp, 'legacy.db'))
+        results['прежний цикл'] = legacy(deposits, send_seconds)
+        assert credited_count() == args.deposits
+
+        prepare_db(os.path.join(tmp, 'batched.db'))
+        results['пакет + очередь'] = batched(chain, send_seconds)
+        db.close_connections()
+
+    print(f"Депозитов: {args.deposits}, отправка сообщения: {args.send_ms:g} мс")
+    print(f"{'вариант':<18} {'зачислены, с':>14} {'уведомлены, с':>14}")
+    for name, (credit_time, notify_time) in results.items():
+        print(f"{name:<18} {credit_time:>14.2f} {notify_time:>14.2f}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,51 @@
+"""Отправляет записанные апдейты Telegram на локальный webhook.
+
+Запуск: python tools/post_updates.py updates.json [http://127.0.0.1:8080/telegram] [--secret SECRET]
+
+Файл может содержать один апдейт, JSON-массив апдейтов или JSONL (по апдейту
+в строке). После отправки печатает метрики очереди с GET /metrics.
+"""
+import argparse
+import json
+import time
+from urllib.parse import urljoin
+
+import requests
+
+
+def load_updates(path):
+    with open(path, encoding='utf-8') as f:
+        text = f.read().strip()
+    try:
+        data = json.loads(text)
+        return data if isinstance(data, list) else [data]
+    except ValueError:
+        return [json.loads(line) for line in text.splitlines() if line.strip()]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('file')
+    parser.add_argument('url', nargs='?', default='http://127.0.0.1:8080/telegram')
+    parser.add_argument('--secret', help='значение WEBHOOK_SECRET')
+    args = parser.parse_args()
+
+    headers = {'X-Telegram-Bot-Api-Secret-Token': args.secret} if args.secret else {}
+    updates = load_updates(args.file)
+
+    session = requests.Session()
+    start = time.perf_counter()
+    for update in updates:
+        response = session.post(args.url, json=update, headers=headers, timeout=10)
+        if response.status_code != 200:
+            print(f"update_id={update.get('update_id')}: HTTP {response.status_code}")
+    elapsed = time.perf_counter() - start
+    print(f"Отправлено апдейтов: {len(updates)} за {elapsed:.2f} с")
+
+    time.sleep(1)
+    metrics = session.get(urljoin(args.url, '/metrics'), headers=headers, timeout=10).json()
+    print(json.dumps(metrics, ensure_ascii=False, indent=2))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,62 @@
+"""Локальная замена ЮKassa: отправляет HTTP-уведомления о платежах на бота.
+
+Запуск:
+    python tools/replay_yookassa.py --payment ID:СУММА [--payment ...] [--event payment.canceled]
+    python tools/replay_yookassa.py --file notifications.jsonl
+
+Без реальной ЮKassa запускайте бота с YOOKASSA_WEBHOOK_VERIFY=0, иначе он
+перепроверит статус платежа через API. Повторная отправка того же
+уведомления должна вернуть result=duplicate: платеж зачисляется один раз.
+"""
+import argparse
+import json
+
+import requests
+
+
+def build_notification(event, payment_id, amount):
+    status = 'succeeded' if event == 'payment.succeeded' else 'canceled'
+    return {
+        'type': 'notification',
+        'event': event,
+        'object': {
+            'id': payment_id,
+            'status': status,
+            'paid': status == 'succeeded',
+            'amount': {'value': f"{float(amount):.2f}", 'currency': 'RUB'}
+        }
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--url', default='http://127.0.0.1:8080/yookassa')
+    parser.add_argument('--payment', action='append', default=[], help='ID:СУММА из таблицы payments')
+    parser.add_argument('--event', default='payment.succeeded', choices=('payment.succeeded', 'payment.canceled'))
+    parser.add_argument('--file', help='JSON или JSONL с записанными уведомлениями')
+    parser.add_argument('--repeat', type=int, default=1, help='сколько раз повторить каждое уведомление')
+    args = parser.parse_args()
+
+    notifications = []
+    for item in args.payment:
+        payment_id, amount = item.rsplit(':', 1)
+        notifications.append(build_notification(args.event, payment_id, amount))
+    if args.file:
+        with open(args.file, encoding='utf-8') as f:
+            text = f.read().strip()
+        try:
+            data = json.loads(text)
+            notifications.extend(data if isinstance(data, list) else [data])
+        except ValueError:
+            notifications.extend(json.loads(line) for line in text.splitlines() if line.strip())
+
+    session = requests.Session()
+    for notification in notifications:
+        for _ in range(args.repeat):
+            response = session.post(args.url, json=notification, timeout=30)
+            print(f"{notification['event']} {notification['object']['id']}: "
+                  f"HTTP {response.status_code} {response.text}")
+
+
+if __name__ == '__main__':
+    main()
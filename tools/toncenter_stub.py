@@ -0,0 +1,444 @@
+"""Локальная замена toncenter: getTransactions по синтетической цепочке транзакций.
+
+Запуск:
+    python tools/toncenter_stub.py [--port 8081] [--count 10000] [--rate 5] [--rps 1]
+        сервер для бота: TON_API_BASE_URL=http://127.0.0.1:8081, новые
+        транзакции появляются со скоростью --rate в секунду, запросы сверх
+        --rps в секунду получают 429 с Retry-After, как у toncenter без ключа
+    python tools/toncenter_stub.py --check [--count 10000]
+        самопроверка ton_scanner на временной БД
+
+Цепочка ведет себя как toncenter: транзакции от новых к старым, страница
+начинается с (lt, hash) включительно, to_lt - исключающая нижняя граница,
+limit не больше 100. В комментарии большинства входящих - user_id, часть
+транзакций исходящие, с мусором в комментарии или для неизвестного пользователя.
+
+--check проверяет, что сканер зачисляет каждый депозит ровно один раз:
+начальный долг в --count транзакций, пачки больше страницы между опросами,
+обрыв API посреди постраничного чтения, откат last_lt. Затем в уменьшенном масштабе времени
+проверяется адаптивный опрос: число запросов в простое, задержка зачисления
+с expect_deposit и без него, пауза после 429.
+"""
+import argparse
+import base64
+import contextlib
+import hashlib
+import json
+import os
+import random
+import sys
+import tempfile
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+MAX_LIMIT = 100
+FIRST_LT = 40_000_000_000_000
+UNKNOWN_USER = 999_999_999
+
+
+class SyntheticChain:
+    """Транзакции одного кошелька, по возрастанию lt."""
+
+    def __init__(self, users, seed=1):
+        self.users = users
+        self.random = random.Random(seed)
+        self.transactions = []
+        self.lock = threading.Lock()
+        self.requests = 0
+        self.request_times = []
+        self.fail_requests = set()  # номера запросов, на которые ответить ошибкой
+        self.rps = 0  # лимит запросов в секунду, 0 - без лимита
+        self.reject_requests = 0  # сколько следующих запросов отклонить с 429
+        self.reject_retry_after = 1
+        self.rejected = 0
+
+    def _make_transaction(self, lt):
+        kind = self.random.random()
+        if kind < 0.05:
+            in_msg = {'source': '', 'value': '0', 'message': ''}  # исходящая
+        elif kind < 0.08:
+            in_msg = {'source': 'EQsender', 'value': str(10 ** 9), 'message': 'спасибо'}
+        elif kind < 0.10:
+            in_msg = {'source': 'EQsender', 'value': str(10 ** 9), 'message': str(UNKNOWN_USER)}
+        else:
+            in_msg = {
+                'source': f'EQsender{self.random.randint(1, 50)}',
+                'value': str(self.random.randint(1, 50) * 10 ** 8),
+                'message': str(self.random.randint(1, self.users))
+            }
+        tx_hash = base64.b64encode(hashlib.sha256(str(lt).encode()).digest()).decode()
+        return {
+            'utime': int(time.time()),
+            'transaction_id': {'@type': 'internal.transactionId', 'lt': str(lt), 'hash': tx_hash},
+            'in_msg': in_msg,
+            'out_msgs': []
+        }
+
+    def append(self, count, user_id=None, comment=None, sender='EQsender'):
+        """Добавляет count транзакций.
+
+        С user_id или comment - депозиты по 1 TON с этим комментарием от sender.
+        """
+        if user_id is not None:
+            comment = str(user_id)
+        with self.lock:
+            lt = int(self.transactions[-1]['transaction_id']['lt']) if self.transactions else FIRST_LT
+            for _ in range(count):
+                lt += self.random.randint(1, 5) * 1000
+                tx = self._make_transaction(lt)
+                if comment is not None:
+                    tx['in_msg'] = {'source': sender, 'value': str(10 ** 9), 'message': comment}
+                self.transactions.append(tx)
+
+    def check_rate_limit(self):
+        """Retry-After в секундах, если запрос нужно отклонить с 429, иначе None."""
+        with self.lock:
+            now = time.monotonic()
+            self.request_times.append(now)
+            retry_after = None
+            if self.reject_requests > 0:
+                self.reject_requests -= 1
+                retry_after = self.reject_retry_after
+            elif self.rps:
+                recent = [t for t in self.request_times[-self.rps - 1:-1] if now - t < 1]
+                if len(recent) >= self.rps:
+                    retry_after = 1
+            if retry_after is not None:
+                self.rejected += 1
+            return retry_after
+
+    def get_transactions(self, limit, lt=None, tx_hash=None, to_lt=0):
+        with self.lock:
+            self.requests += 1
+            if self.requests in self.fail_requests:
+                return {'ok': False, 'error': 'LITE_SERVER_UNKNOWN: timeout', 'code': 500}
+
+            index = len(self.transactions) - 1
+            if lt is not None:
+                # Бинарный поиск транзакции курсора
+                lo, hi = 0, len(self.transactions) - 1
+                while lo < hi:
+                    mid = (lo + hi) // 2
+                    if int(self.transactions[mid]['transaction_id']['lt']) < lt:
+                        lo = mid + 1
+                    else:
+                        hi = mid
+                found = self.transactions[lo] if self.transactions else None
+                if not found or int(found['transaction_id']['lt']) != lt or found['transaction_id']['hash'] != tx_hash:
+                    return {'ok': False, 'error': 'cannot find transaction by lt and hash', 'code': 500}
+                index = lo
+
+            result = []
+            while index >= 0 and len(result) < min(limit, MAX_LIMIT):
+                tx = self.transactions[index]
+                if int(tx['transaction_id']['lt']) <= to_lt:
+                    break
+                result.append(tx)
+                index -= 1
+            return {'ok': True, 'result': result}
+
+
+def make_handler(chain):
+    class Handler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            url = urlparse(self.path)
+            if url.path != '/api/v2/getTransactions':
+                self.send_error(404)
+                return
+            retry_after = chain.check_rate_limit()
+            if retry_after is not None:
+                body = json.dumps({'ok': False, 'error': 'Ratelimit exceed', 'code': 429}).encode()
+                self.send_response(429)
+                self.send_header('Retry-After', str(retry_after))
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+                return
+
+            query = {key: values[0] for key, values in parse_qs(url.query).items()}
+            body = json.dumps(chain.get_transactions(
+                int(query.get('limit', 10)),
+                int(query['lt']) if 'lt' in query else None,
+                query.get('hash'),
+                int(query.get('to_lt', 0))
+            )).encode()
+            self.send_response(200)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            pass
+
+    return Handler
+
+
+def start_server(chain, port=0):
+    server = ThreadingHTTPServer(('127.0.0.1', port), make_handler(chain))
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def expected_credits(chain, rate, users):
+    """Сколько депозитов и рублей должен зачислить сканер по всей цепочке и сколько останется неопознанными.
+
+    Мусорные комментарии в цепочке приходят с адреса EQsender, который никогда
+    не пополнял известного пользователя, поэтому по адресу они не сопоставляются.
+    """
+    from ton_scanner import parse_deposit
+
+    count, total, unmatched = 0, 0.0, 0
+    for tx in chain.transactions:
+        deposit = parse_deposit(tx, rate)
+        if not deposit:
+            continue
+        if deposit['user_id'] is not None and deposit['user_id'] <= users:
+            count += 1
+            total += deposit['rub_amount']
+        else:
+            unmatched += 1
+    return count, round(total, 2), unmatched
+
+
+def run_unmatched_check(chain, scanner):
+    """Сопоставление по подтвержденному адресу и ручное зачисление неопознанных (/assign)."""
+    import db
+
+    def balance(uid):
+        return db.get_connection().execute('SELECT balance FROM users WHERE user_id = ?', (uid,)).fetchone()[0]
+
+    def scan(credited, by_sender, unmatched):
+        stats = scanner.scan_once()
+        assert (stats['credited'], stats['by_sender'], stats['unmatched']) == (credited, by_sender, unmatched), stats
+
+    def assign(sender, uid):
+        return db.assign_unmatched_deposits([row['id'] for row in db.search_unmatched_deposits(sender)], uid)
+
+    # Депозит с комментарием не привязывает адрес: следующий без id ждет админа
+    chain.append(1, user_id=5, sender='EQloyal')
+    chain.append(1, comment='забыл указать id', sender='EQloyal')
+    scan(1, 0, 1)
+
+    # Ручное зачисление подтверждает адрес; повторное - ничего не меняет
+    before = balance(5)
+    assigned, new_balance, learned = assign('EQloyal', 5)
+    assert len(assigned) == 1 and learned == ['EQloyal'] and new_balance == round(before + 250, 2)
+    assert db.assign_unmatched_deposits([row['id'] for row in assigned], 5) == ([], new_balance, [])
+
+    # Теперь депозиты без id с этого адреса зачисляются сами, в уведомлении - баланс после каждого
+    notified = []
+    scanner.on_credited = notified.append
+    chain.append(2, comment='', sender='EQloyal')
+    scan(2, 2, 0)
+    scanner.on_credited = None
+    assert [deposit['balance'] for deposit in notified] == [round(new_balance + 250, 2), round(new_balance + 500, 2)]
+
+    # Депозит другого пользователя с того же адреса делает его общим - сопоставление прекращается
+    chain.append(1, user_id=6, sender='EQloyal')
+    chain.append(1, comment='', sender='EQloyal')
+    scan(1, 0, 1)
+
+    # Общий адрес из TON_SHARED_SENDERS не подтверждается даже ручным зачислением
+    db.TON_SHARED_SENDERS = frozenset({'EQwallet'})
+    chain.append(1, comment='', sender='EQwallet')
+    scan(0, 0, 1)
+    assert assign('EQwallet', 7)[2] == []
+    chain.append(1, comment='', sender='EQwallet')
+    scan(0, 0, 1)
+
+    rows, total, total_ton = db.get_unmatched_deposits()
+    assert db.search_unmatched_deposits('1.0') and total == len(db.search_unmatched_deposits('1.0', limit=total))
+    print(f"✅ Неопознанные: {total} на {total_ton:.4f} TON; по адресу зачисляется только после /assign, "
+          f"общий адрес и адрес разных пользователей не сопоставляются")
+
+
+def run_adaptive_check(chain, base_url):
+    """Адаптивный опрос в масштабе времени 1:100 (интервалы 0.1/0.03/1.2 с вместо 10/3/120)."""
+    import asyncio
+
+    import db
+    from ton_scanner import TonDepositScanner
+
+    scale = 100
+    scanner = TonDepositScanner('EQstub', 'key', lambda: 250.0, base_url=base_url,
+                                interval=0.1, fast_interval=0.03, max_interval=1.2, expect_window=9)
+    stop = threading.Event()
+
+    async def run_until_stopped():
+        runner = asyncio.ensure_future(scanner.run())
+        await asyncio.to_thread(stop.wait)
+        runner.cancel()
+        with contextlib.suppress(asyncio.CancelledError):
+            await runner
+
+    thread = threading.Thread(target=asyncio.run, args=(run_until_stopped(),), daemon=True)
+    thread.start()
+    conn = db.get_connection()
+
+    def balance(uid):
+        return conn.execute('SELECT balance FROM users WHERE user_id = ?', (uid,)).fetchone()[0]
+
+    def credit_latency(uid):
+        before = balance(uid)
+        chain.append(1, user_id=uid)
+        started = time.monotonic()
+        while balance(uid) == before:
+            time.sleep(0.005)
+        return time.monotonic() - started
+
+    def wait_for(condition, timeout=30):
+        deadline = time.monotonic() + timeout
+        while not condition():
+            if time.monotonic() > deadline:
+                raise AssertionError("не дождались")
+            time.sleep(0.005)
+
+    requests_before = chain.requests
+    time.sleep(4)
+    idle_requests = chain.requests - requests_before
+    print(f"простой {4 * scale} с: запросов {idle_requests}, с постоянным интервалом 10 с было бы {4 * scale // 10}")
+
+    scanner.expect_deposit(1)
+    time.sleep(0.3)
+    expected_latency = credit_latency(1)
+    time.sleep(3)  # ожидание снято зачислением, интервал снова растет до предела
+    idle_latency = credit_latency(2)
+    print(f"зачисление после открытия экрана TON: {expected_latency * scale:.1f} с, "
+          f"без ожидания после простоя: {idle_latency * scale:.1f} с")
+
+    # 429 на все повторы http_client и на сам запрос: сканер ждет Retry-After, даже если ждут депозит
+    rejected_before = chain.rejected
+    chain.reject_retry_after = 1
+    chain.reject_requests = 4
+    wait_for(lambda: chain.rejected == rejected_before + 4)
+    last_rejected = chain.request_times[-1]
+    scanner.expect_deposit(3)
+    wait_for(lambda: chain.request_times[-1] > last_rejected)
+    pause = chain.request_times[-1] - last_rejected
+    print(f"после 429 с Retry-After: 1 следующий запрос через {pause:.2f} с")
+
+    stop.set()
+    thread.join(timeout=10)
+    assert idle_requests <= 10, idle_requests
+    assert expected_latency < idle_latency or idle_latency < 0.03
+    assert pause >= 0.95, pause
+
+
+def run_check(count, users):
+    import logging
+
+    import db
+    from config import logger
+    from ton_scanner import TonApiError, TonDepositScanner
+
+    logger.setLevel(logging.ERROR)  # предупреждения о мусорных комментариях не нужны
+    rate = 250.0
+    chain = SyntheticChain(users)
+    chain.append(count)
+    server = start_server(chain)
+
+    with tempfile.TemporaryDirectory() as tmp:
+        db.DB_NAME = os.path.join(tmp, 'check.db')
+        db.init_db()
+        for uid in range(1, users + 1):
+            db.create_user(uid, f'user{uid}')
+
+        scanner = TonDepositScanner('EQstub', 'key', lambda: rate,
+                                    base_url=f'http://127.0.0.1:{server.server_port}')
+
+        def scan(label):
+            requests_before = chain.requests
+            stats = scanner.scan_once()
+            print(f"{label:<38} транзакций {stats['fetched']:>6}, зачислено {stats['credited']:>6}, "
+                  f"повторов {stats['duplicate']:>4}, запросов {chain.requests - requests_before:>4}, "
+                  f"{stats['duration']:.2f} с")
+            return stats
+
+        scan(f"начальный долг ({count})")
+        scan("опрос без новых транзакций")
+
+        missed_by_window = 0
+        for burst in (1, 99, 100, 101, 250, 777):
+            chain.append(burst)
+            missed_by_window += max(0, burst - MAX_LIMIT)
+            scan(f"пришло {burst} между опросами")
+
+        # Обрыв API на второй странице: ничего не зачислено, курсор не сдвинут
+        chain.append(350)
+        chain.fail_requests.add(chain.requests + 2)
+        last_lt = scanner.load_last_lt()
+        try:
+            scanner.scan_once()
+            raise AssertionError("сканер не заметил ошибку API")
+        except TonApiError:
+            assert scanner.load_last_lt() == last_lt, "last_lt сдвинут при ошибке"
+        scan("повтор после обрыва API")
+
+        # Курсор откатился (например, settings восстановили из старой копии): хэши не дают зачислить дважды
+        db.set_setting('last_lt', chain.transactions[-1000]['transaction_id']['lt'])
+        stats = scan("last_lt откатился на 1000 транзакций")
+        assert stats['credited'] == 0 and stats['duplicate'] > 0, stats
+
+        expected_count, expected_total, expected_unmatched = expected_credits(chain, rate, users)
+        conn = db.get_connection()
+        credited_count, credited_total = conn.execute(
+            "SELECT COUNT(*), ROUND(SUM(amount), 2) FROM transactions WHERE type = 'deposit_ton'"
+        ).fetchone()
+        unmatched_count = conn.execute('SELECT COUNT(*) FROM unmatched_deposits').fetchone()[0]
+        balance_total = conn.execute('SELECT ROUND(SUM(balance), 2) FROM users').fetchone()[0]
+        tip = int(chain.transactions[-1]['transaction_id']['lt'])
+        last_lt = scanner.load_last_lt()
+        print(f"депозитов: ожидалось {expected_count} на {expected_total:.2f} руб, "
+              f"зачислено {credited_count} на {credited_total:.2f} руб (балансы {balance_total:.2f})")
+        print(f"неопознанных: ожидалось {expected_unmatched}, сохранено {unmatched_count}")
+        print(f"прежний опрос limit=100 без курсора потерял бы не меньше {missed_by_window} транзакций")
+        assert credited_count == expected_count and abs(credited_total - expected_total) < 0.01
+        assert unmatched_count == expected_unmatched
+        assert abs(balance_total - expected_total) < 0.01
+        assert last_lt == tip, f"last_lt {last_lt} != {tip}"
+        print(f"✅ Каждый депозит зачислен ровно один раз, last_lt = {tip}")
+
+        run_unmatched_check(chain, scanner)
+        run_adaptive_check(chain, f'http://127.0.0.1:{server.server_port}')
+        print("✅ Адаптивный опрос: реже в простое, быстрее при ожидании депозита, пауза по Retry-After")
+        db.close_connections()
+
+    server.shutdown()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--port', type=int, default=8081)
+    parser.add_argument('--count', type=int, default=10000, help='транзакций в цепочке при старте')
+    parser.add_argument('--users', type=int, default=200, help='user_id в комментариях: 1..users')
+    parser.add_argument('--rate', type=int, default=0, help='новых транзакций в секунду')
+    parser.add_argument('--rps', type=int, default=0, help='лимит запросов в секунду (0 - без лимита)')
+    parser.add_argument('--check', action='store_true', help='самопроверка ton_scanner')
+    args = parser.parse_args()
+
+    if args.check:
+        run_check(args.count, args.users)
+        return
+
+    chain = SyntheticChain(args.users)
+    chain.append(args.count)
+    chain.rps = args.rps
+    server = start_server(chain, args.port)
+    print(f"toncenter-заглушка: http://127.0.0.1:{server.server_port} ({args.count} транзакций)")
+    try:
+        while True:
+            time.sleep(1)
+            if args.rate:
+                chain.append(args.rate)
+    except KeyboardInterrupt:
+        server.shutdown()
+
+
+if __name__ == '__main__':
+    main()
@@ -1,29 +1,166 @@
-import time
+import functools
 import threading
-from bot import logger
-
-# Глобальная переменная для управления анимацией.
-# Ее определение остается в bot.py, но лучше, если она будет передаваться или управляться классом.
-# Для простоты, оставим ее глобальной, но будем импортировать.
-# from bot import animation_running # <- Должен быть в bot.py
-
-def animate_caption(bot, call):
-    """Показывает анимацию 'Отправляю звезды...'."""
-    from bot import animation_running # Локальный импорт, чтобы избежать циклической зависимости
-    dots = 1
-    while animation_running:
-        caption = "🔄 Отправляю звезды" + "." * dots
+import time
+from config import logger
+
+ANIMATION_CAPTION = "🔄 Отправляю звезды"
+ANIMATION_INTERVAL = 1.0   # как часто менять кадр одного сообщения
+CHAT_EDIT_INTERVAL = 1.0   # Telegram: не чаще ~1 правки в секунду в один чат
+MAX_EDITS_PER_TICK = 20    # общий лимит правок за такт (глобальный лимит ~30/с)
+TICK = 0.25
+
+
+class CaptionAnimator:
+    """Анимирует подписи «Отправляю звезды...» всех активных покупок в одном потоке.
+
+    Анимации хранятся по ключу (chat_id, message_id) и останавливаются
+    независимо друг от друга. За такт планировщик правит пачку сообщений,
+    у которых подошло время, соблюдая интервал правок в каждом чате.
+    """
+
+    def __init__(self, bot, interval=ANIMATION_INTERVAL, chat_interval=CHAT_EDIT_INTERVAL,
+                 max_edits_per_tick=MAX_EDITS_PER_TICK):
+        self.bot = bot
+        self.interval = interval
+        self.chat_interval = chat_interval
+        self.max_edits_per_tick = max_edits_per_tick
+        self._active = {}      # (chat_id, message_id) -> {'dots': int, 'next_at': float}
+        self._chat_ready = {}  # chat_id -> время, когда в чат снова можно писать
+        self._editing = None   # ключ сообщения, правка которого выполняется сейчас
+        self._cond = threading.Condition()
+        self._thread = None
+
+    def start(self, chat_id, message_id):
+        with self._cond:
+            self._active[(chat_id, message_id)] = {'dots': 1, 'next_at': time.monotonic()}
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, daemon=True, name='caption-animator')
+                self._thread.start()
+            self._cond.notify_all()
+
+    def stop(self, chat_id, message_id):
+        """Останавливает анимацию и дожидается завершения начатой правки.
+
+        После возврата можно писать итоговую подпись: анимация ее не перезапишет.
+        """
+        key = (chat_id, message_id)
+        with self._cond:
+            self._active.pop(key, None)
+            while self._editing == key:
+                self._cond.wait()
+
+    def active_count(self):
+        return len(self._active)
+
+    def _due_batch(self, now):
+        batch = []
+        busy_chats = set()
+        for key, state in sorted(self._active.items(), key=lambda item: item[1]['next_at']):
+            chat_id = key[0]
+            if state['next_at'] > now or chat_id in busy_chats or self._chat_ready.get(chat_id, 0) > now:
+                continue
+            busy_chats.add(chat_id)
+            batch.append(key)
+            if len(batch) >= self.max_edits_per_tick:
+                break
+        return batch
+
+    def _edit(self, key, dots):
+        """Возвращает (продолжать ли анимацию, пауза для чата в секундах)."""
+        chat_id, message_id = key
         try:
-            bot.edit_message_caption(
-                chat_id=call.message.chat.id,
-                message_id=call.message.message_id,
-                caption=caption,
+            self.bot.edit_message_caption(
+                chat_id=chat_id,
+                message_id=message_id,
+                caption=ANIMATION_CAPTION + "." * dots,
                 reply_markup=None
             )
+            return True, self.chat_interval
         except Exception as e:
-            if "message is not modified" not in str(e):
-                logger.warning(f"Ошибка при обновлении сообщения анимации: {e}")
-            break
+            if "message is not modified" in str(e):
+                return True, self.chat_interval
+            retry_after = (getattr(e, 'result_json', None) or {}).get('parameters', {}).get('retry_after')
+            if retry_after:
+                logger.warning(f"Лимит правок Telegram в чате {chat_id}, пауза {retry_after} с")
+                return True, float(retry_after)
+            logger.warning(f"Ошибка при обновлении сообщения анимации: {e}")
+            return False, self.chat_interval
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while not self._active:
+                    self._chat_ready.clear()
+                    self._cond.wait()
+                batch = self._due_batch(time.monotonic())
+
+            for key in batch:
+                with self._cond:
+                    state = self._active.get(key)
+                    if state is None:
+                        continue
+                    self._editing = key
+                    dots = state['dots']
+
+                try:
+                    keep, pause = self._edit(key, dots)
+                finally:
+                    with self._cond:
+                        self._editing = None
+                        self._cond.notify_all()
+
+                now = time.monotonic()
+                with self._cond:
+                    self._chat_ready[key[0]] = now + pause
+                    state = self._active.get(key)
+                    if state is None:
+                        continue
+                    if keep:
+                        state['dots'] = (dots % 3) + 1
+                        state['next_at'] = now + max(self.interval, pause)
+                    else:
+                        del self._active[key]
+
+            time.sleep(TICK)
+
+
+def memoize(ttl=None):
+    """Кэширует результат функции по ее аргументам (для редко меняющихся метаданных Telegram).
+
+    Значение запрашивается один раз и переиспользуется ttl секунд (None - бессрочно).
+    Одновременные вызовы не дублируют запрос. Если обновление не удалось, возвращается
+    прежнее значение, а следующий вызов попробует снова; без прежнего значения
+    исключение пробрасывается. wrapper.invalidate(*args) сбрасывает кэш.
+    """
+    def decorator(func):
+        cache = {}  # args -> (значение, время получения)
+        lock = threading.Lock()
+
+        def fresh(entry):
+            return entry is not None and (ttl is None or time.monotonic() - entry[1] < ttl)
+
+        @functools.wraps(func)
+        def wrapper(*args):
+            entry = cache.get(args)
+            if fresh(entry):
+                return entry[0]
+            with lock:
+                entry = cache.get(args)
+                if fresh(entry):
+                    return entry[0]
+                try:
+                    value = func(*args)
+                except Exception as e:
+                    if entry is None:
+                        raise
+                    logger.warning(f"Не удалось обновить {func.__name__}, используется прежнее значение: {e}")
+                    return entry[0]
+                cache[args] = (value, time.monotonic())
+                return value
+
+        def invalidate(*args):
+            cache.pop(args, None)
 
-        dots = (dots % 3) + 1
-        time.sleep(1)
\ No newline at end of file
+        wrapper.invalidate = invalidate
+        return wrapper
+    return decorator
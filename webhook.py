@@ -0,0 +1,185 @@
+import hmac
+import json
+import queue
+import socketserver
+import threading
+import time
+from collections import deque
+from wsgiref.simple_server import WSGIServer, WSGIRequestHandler, make_server
+
+from telebot.types import Update
+
+from config import logger
+
+LATENCY_WINDOW = 1000  # по скольким последним апдейтам считать задержки
+
+
+class UpdateQueue:
+    """Очередь входящих апдейтов Telegram с пулом воркеров и метриками.
+
+    Апдейты одного чата всегда попадают к одному воркеру, поэтому шаги диалога
+    (например, ввод username после нажатия кнопки) обрабатываются по порядку.
+    """
+
+    def __init__(self, bot, workers):
+        self.bot = bot
+        self.workers = max(1, workers)
+        self._queues = [queue.Queue() for _ in range(self.workers)]
+        self._lock = threading.Lock()
+        self._wait_ms = deque(maxlen=LATENCY_WINDOW)
+        self._total_ms = deque(maxlen=LATENCY_WINDOW)
+        self.received = 0
+        self.processed = 0
+        self.failed = 0
+
+    def start(self):
+        for index, worker_queue in enumerate(self._queues):
+            threading.Thread(
+                target=self._work, args=(worker_queue,), daemon=True, name=f'update-worker-{index}'
+            ).start()
+
+    @staticmethod
+    def _shard_key(update):
+        for field in ('message', 'edited_message', 'callback_query', 'inline_query', 'pre_checkout_query'):
+            obj = update.get(field)
+            if obj:
+                chat = obj.get('chat') or (obj.get('message') or {}).get('chat')
+                if chat:
+                    return chat.get('id', 0)
+                return (obj.get('from') or {}).get('id', 0)
+        return update.get('update_id', 0)
+
+    def put(self, update):
+        """Ставит апдейт (распарсенный JSON) в очередь воркера его чата."""
+        with self._lock:
+            self.received += 1
+        self._queues[hash(self._shard_key(update)) % self.workers].put((time.monotonic(), update))
+
+    def depth(self):
+        return sum(worker_queue.qsize() for worker_queue in self._queues)
+
+    def _work(self, worker_queue):
+        while True:
+            received_at, raw_update = worker_queue.get()
+            started_at = time.monotonic()
+            ok = True
+            try:
+                self.bot.process_new_updates([Update.de_json(raw_update)])
+            except Exception as e:
+                ok = False
+                logger.error(f"Ошибка обработки апдейта {raw_update.get('update_id')}: {e}")
+            finished_at = time.monotonic()
+
+            with self._lock:
+                self.processed += 1
+                if not ok:
+                    self.failed += 1
+                self._wait_ms.append((started_at - received_at) * 1000)
+                self._total_ms.append((finished_at - received_at) * 1000)
+
+    @staticmethod
+    def _summary(values):
+        if not values:
+            return {'avg': 0.0, 'p95': 0.0, 'max': 0.0}
+        ordered = sorted(values)
+        return {
+            'avg': round(sum(ordered) / len(ordered), 2),
+            'p95': round(ordered[min(len(ordered) - 1, int(len(ordered) * 0.95))], 2),
+            'max': round(ordered[-1], 2)
+        }
+
+    def metrics(self):
+        with self._lock:
+            wait_ms, total_ms = list(self._wait_ms), list(self._total_ms)
+            counters = {'received': self.received, 'processed': self.processed, 'failed': self.failed}
+        return {
+            'queue_depth': self.depth(),
+            'workers': self.workers,
+            **counters,
+            'queue_wait_ms': self._summary(wait_ms),
+            'latency_ms': self._summary(total_ms)
+        }
+
+
+# --- WSGI-приложение ---
+# Маршрут: (метод, путь) -> handler(environ, body) -> (HTTP-статус, dict для JSON-ответа)
+_routes = {}
+
+
+def add_route(method, path, handler):
+    _routes[(method, path)] = handler
+
+
+def _json_response(start_response, status, payload):
+    body = json.dumps(payload, ensure_ascii=False).encode('utf-8')
+    start_response(status, [('Content-Type', 'application/json'), ('Content-Length', str(len(body)))])
+    return [body]
+
+
+def application(environ, start_response):
+    handler = _routes.get((environ['REQUEST_METHOD'], environ.get('PATH_INFO', '')))
+    if handler is None:
+        return _json_response(start_response, '404 Not Found', {'ok': False})
+
+    try:
+        length = int(environ.get('CONTENT_LENGTH') or 0)
+    except ValueError:
+        length = 0
+    body = environ['wsgi.input'].read(length) if length else b''
+
+    try:
+        status, payload = handler(environ, body)
+    except Exception as e:
+        logger.error(f"Ошибка обработки HTTP-запроса {environ.get('PATH_INFO')}: {e}")
+        status, payload = '500 Internal Server Error', {'ok': False}
+    return _json_response(start_response, status, payload)
+
+
+def register_telegram_routes(update_queue, path, secret):
+    """Подключает прием апдейтов Telegram и GET /metrics.
+
+    Оба адреса требуют заголовок X-Telegram-Bot-Api-Secret-Token = secret:
+    без него кто угодно мог бы прислать апдейт от имени администратора.
+    """
+    if not secret:
+        raise ValueError("для приема апдейтов через webhook нужен секрет")
+
+    def authorized(environ):
+        return hmac.compare_digest(
+            environ.get('HTTP_X_TELEGRAM_BOT_API_SECRET_TOKEN', '').encode(), secret.encode()
+        )
+
+    def receive_update(environ, body):
+        if not authorized(environ):
+            return '403 Forbidden', {'ok': False}
+        try:
+            update = json.loads(body)
+        except ValueError:
+            return '400 Bad Request', {'ok': False}
+        update_queue.put(update)
+        return '200 OK', {'ok': True}
+
+    def metrics(environ, body):
+        if not authorized(environ):
+            return '403 Forbidden', {'ok': False}
+        return '200 OK', update_queue.metrics()
+
+    add_route('POST', path, receive_update)
+    add_route('GET', '/metrics', metrics)
+
+
+class _ThreadingWSGIServer(socketserver.ThreadingMixIn, WSGIServer):
+    daemon_threads = True
+
+
+class _QuietRequestHandler(WSGIRequestHandler):
+    def log_message(self, format, *args):
+        logger.debug(f"HTTP {self.address_string()} {format % args}")
+
+
+def serve(host, port):
+    """Запускает HTTP-сервер (блокирует текущий поток)."""
+    server = make_server(host, port, application,
+                         server_class=_ThreadingWSGIServer, handler_class=_QuietRequestHandler)
+    logger.info(f"🌐 HTTP-сервер слушает {host}:{port}")
+    server.serve_forever()
@@ -1,11 +1,12 @@
 import base64
 import uuid
 import requests
-from config import YOOKASSA_SHOP_ID, YOOKASSA_SECRET_KEY, YOOKASSA_API_URL, logger
-from db import add_payment
+from config import YOOKASSA_SHOP_ID, YOOKASSA_SECRET_KEY, YOOKASSA_API_URL, YOOKASSA_WEBHOOK_VERIFY, logger
+from db import add_payment, get_payment, complete_payment, close_payment
+from http_client import get_session
 
 
-def create_yookassa_payment(amount, user_id, bot_username):
+def create_yookassa_payment(amount, user_id, bot_username, chat_id=None, message_id=None):
     if not YOOKASSA_SHOP_ID or not YOOKASSA_SECRET_KEY:
         logger.error("❌ Учетные данные ЮKassa отсутствуют.")
         return None
@@ -61,7 +62,7 @@ def create_yookassa_payment(amount, user_id, bot_username):
 
     try:
         logger.info(f"🔄 Создание платежа ЮKassa: {amount} руб для пользователя {user_id}")
-        response = requests.post(YOOKASSA_API_URL, json=payload, headers=headers, timeout=30)
+        response = get_session('yookassa').post(YOOKASSA_API_URL, json=payload, headers=headers)
 
         if response.status_code != 200:
             logger.error(f"❌ Ошибка ЮKassa API: {response.status_code} - {response.text}")
@@ -70,7 +71,7 @@ def create_yookassa_payment(amount, user_id, bot_username):
         payment_data = response.json()
 
         # Сохранение информации о платеже в БД
-        add_payment(user_id, amount, payment_data['id'], 'pending')
+        add_payment(user_id, amount, payment_data['id'], 'pending', chat_id, message_id)
 
         logger.info(f"✅ Платеж создан: {payment_data['id']}")
         return payment_data['confirmation']['confirmation_url']
@@ -102,9 +103,65 @@ def check_payment_status(payment_id):
     }
 
     try:
-        response = requests.get(url, headers=headers, timeout=30)
+        response = get_session('yookassa').get(url, headers=headers)
         response.raise_for_status()
         return response.json()
     except Exception as e:
         logger.error(f"❌ Ошибка проверки платежа: {str(e)}")
-        return None
\ No newline at end of file
+        return None
+
+
+NOTIFICATION_EVENTS = ('payment.succeeded', 'payment.canceled')
+
+
+def process_notification(event, verify=YOOKASSA_WEBHOOK_VERIFY):
+    """Обрабатывает HTTP-уведомление ЮKassa.
+
+    Уведомление сверяется с таблицей payments (платеж должен существовать,
+    ожидать оплаты и совпадать по сумме), а при verify=True статус еще и
+    перепроверяется запросом к API. Возвращает (результат, платеж), где
+    результат - 'credited', 'canceled', 'duplicate', 'pending', 'mismatch',
+    'unknown' или 'ignored'. Если API недоступен, бросает RuntimeError, чтобы
+    ЮKassa повторила уведомление позже.
+    """
+    event_type = event.get('event')
+    payment_object = event.get('object') or {}
+    payment_id = payment_object.get('id')
+    if event_type not in NOTIFICATION_EVENTS or not payment_id:
+        return 'ignored', None
+
+    payment = get_payment(payment_id)
+    if not payment:
+        logger.warning(f"⚠️ Уведомление ЮKassa о неизвестном платеже {payment_id}")
+        return 'unknown', None
+    if payment['status'] != 'pending':
+        return 'duplicate', payment
+
+    try:
+        notified_amount = float((payment_object.get('amount') or {}).get('value'))
+    except (TypeError, ValueError):
+        notified_amount = None
+    if notified_amount is None or abs(notified_amount - payment['amount']) >= 0.01:
+        logger.warning(
+            f"⚠️ Сумма в уведомлении ЮKassa ({notified_amount}) не совпадает с платежом "
+            f"{payment_id} ({payment['amount']})"
+        )
+        return 'mismatch', payment
+
+    status = payment_object.get('status')
+    if verify:
+        payment_info = check_payment_status(payment_id)
+        if not payment_info:
+            raise RuntimeError(f"Не удалось проверить платеж {payment_id} через API ЮKassa")
+        status = payment_info['status']
+
+    if status == 'succeeded':
+        credited = complete_payment(payment_id)
+        if credited:
+            logger.info(f"✅ Платеж {payment_id} зачислен по уведомлению ЮKassa")
+            return 'credited', credited
+        return 'duplicate', payment
+    if status == 'canceled':
+        close_payment(payment_id, 'canceled')
+        return 'canceled', payment
+    return 'pending', payment